@@ -1,10 +1,20 @@
 import dash
 import dash_bootstrap_components as dbc
 from dash import Dash, html, dcc
+import sys
+import os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(current_dir, 'functions'))
+from map_server import register_map_routes
+from metrics import register_metrics
 
 # pip install -r requirements.txt
 
 app = Dash(__name__, use_pages=True)
+register_map_routes(app.server)  # rendered maps are served from /maps/<digest>.html
+register_metrics(app.server, app)  # prometheus text at /metrics
+server = app.server  # for a wsgi server, e.g. gunicorn -w 4 app:server
 
 external_stylesheets = [
     'https://use.fontawesome.com/releases/v5.7.1/css/all.css'
@@ -0,0 +1,149 @@
+// clientside callbacks for the pages that keep their points in the browser (see
+// functions/client_store.py). the page's store update (a whole snapshot or the rows that
+// changed) is decoded and merged here, then the map in the iframe (map_layers.ClientPointLayer)
+// is redrawn for the selected view without asking the server.
+// the iframe finds the state under window.trafficMaps[page] of this window
+
+(function() {
+    var TYPES = {i1: Int8Array, i2: Int16Array, i4: Int32Array};
+
+    function unpack(packed) {
+        var binary = atob(packed.data);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        var values = Array.from(new TYPES[packed.type](bytes.buffer));
+        if (packed.start === undefined) {
+            return values;
+        }
+        // first value, then the steps from each value to the next
+        var out = new Array(values.length + 1);
+        out[0] = packed.start;
+        for (var j = 0; j < values.length; j++) {
+            out[j + 1] = out[j] + values[j];
+        }
+        return out;
+    }
+
+    function decodeColumn(column) {
+        if (column.names) {
+            return unpack(column.codes).map(function(code) { return column.names[code]; });
+        }
+        var values = unpack(column.values).map(function(value) { return value / column.scale; });
+        if (column.missing) {
+            unpack(column.missing).forEach(function(row) { values[row] = NaN; });
+        }
+        return values;
+    }
+
+    function applyDelta(base, remove, insert, rows, count) {
+        // base without the removed rows, with the inserted rows at their new positions
+        var removed = {};
+        remove.forEach(function(row) { removed[row] = true; });
+        var kept = base.filter(function(value, row) { return !removed[row]; });
+        var out = new Array(count);
+        var next = 0, from = 0;
+        for (var i = 0; i < count; i++) {
+            if (next < insert.length && insert[next] === i) {
+                out[i] = rows[next++];
+            } else {
+                out[i] = kept[from++];
+            }
+        }
+        return out;
+    }
+
+    function slot(page) {
+        window.trafficMaps = window.trafficMaps || {};
+        return window.trafficMaps[page] = window.trafficMaps[page] || {};
+    }
+
+    // [iframe src, toggle style] for the selected view, hours is the time filter (null for none)
+    function show(points, view, toggle, hours) {
+        var hidden = {display: "none"};
+        if (!points) {
+            return [window.dash_clientside.no_update, hidden];
+        }
+        if (points.mode === "loading") {
+            return [points.url, hidden];
+        }
+        var spec = points.views[view];
+        if (!spec) {
+            return [points.no_view, hidden];
+        }
+        var showNoise = !!spec.toggle && (toggle || []).indexOf("show_gray") >= 0;
+        var style = {display: spec.toggle ? "block" : "none"};
+        // maps on the server take the time filter as a query string, their points requests pass it on
+        var query = hours === null ? "" : "?hours=" + hours;
+        if (spec.kind === "page") {
+            return [spec.url + query, style];
+        }
+        if (points.mode === "maps") {
+            return [points.maps[showNoise ? view + "-gray" : view] + query, style];
+        }
+        var target = slot(points.page);
+        target.state = {
+            points: points, view: spec, showNoise: showNoise,
+            activeAt: hours === null ? null : points.built_at + hours * 3600
+        };
+        if (target.draw) {
+            try {
+                target.draw(target.state);
+            } catch (e) {
+                target.draw = null;  // the map it belonged to is gone, the next one picks up the state
+            }
+        }
+        return [points.map, style];
+    }
+
+    function timeLabel(points, hours) {
+        var at = new Date((points.built_at + hours * 3600) * 1000).toISOString();
+        return points.active[hours] + " incidents active at " + at.slice(0, 10) + " " + at.slice(11, 16) + " UTC";
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        traffic: {
+            // store update -> [points, version]
+            merge: function(update, points) {
+                var noUpdate = window.dash_clientside.no_update;
+                if (!update) {
+                    return [noUpdate, noUpdate];
+                }
+                if (update.mode !== "points") {
+                    return [update, update.version];
+                }
+                var columns = {};
+                Object.keys(update.columns).forEach(function(name) {
+                    columns[name] = decodeColumn(update.columns[name]);
+                });
+                if (update.base !== undefined) {
+                    if (!points || points.version !== update.base) {
+                        return [noUpdate, null];  // not the version it was made for, ask for everything
+                    }
+                    var remove = unpack(update.remove), insert = unpack(update.insert);
+                    Object.keys(columns).forEach(function(name) {
+                        columns[name] = applyDelta(points.columns[name], remove, insert, columns[name], update.rows);
+                    });
+                }
+                var merged = Object.assign({}, update, {columns: columns});
+                delete merged.base;
+                delete merged.remove;
+                delete merged.insert;
+                return [merged, update.version];
+            },
+
+            // points, selected view, noise toggle -> [iframe src, toggle style]
+            draw: function(points, view, toggle) {
+                return show(points, view, toggle, null);
+            },
+
+            // the same plus the time filter toggle and slider -> [iframe src, toggle style, time label]
+            drawAt: function(points, view, toggle, filter, hours) {
+                var timed = !!points && !!points.active && (filter || []).indexOf("filter_time") >= 0;
+                hours = timed ? (hours || 0) : null;
+                return show(points, view, toggle, hours).concat([timed ? timeLabel(points, hours) : ""]);
+            }
+        }
+    });
+})();
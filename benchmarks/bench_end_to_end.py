@@ -0,0 +1,249 @@
+import argparse
+import gzip
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import requests
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+root_dir = os.path.join(current_dir, '../')
+module_dir = os.path.join(root_dir, 'functions')
+sys.path.append(module_dir)
+sys.path.append(root_dir)
+
+# both pages end to end against a local fake HERE api (functions/fake_here.py), per size:
+# - refresh: a whole snapshot build (fetch, history, clustering) like the background refresher does
+# - fetch: tiled http fetch + parse of a changed snapshot, parse: the parser alone on one body
+# - cluster_full / cluster_incremental: a fresh fit, and the page's pipeline on a 5% changed snapshot
+# - render_<view>: map html build, callback_<view>: the dash callback plus the map page the
+#   browser then downloads (gzip), viewport_* / heat_*: the map's data requests after a pan
+# - store_full / store_delta: the flow page's points for the browser (functions/client_store.py),
+#   all of them and what changed in one refresh
+# results are saved as json, --compare prints the change against an older run.
+# run from the project root: py benchmarks/bench_end_to_end.py --sizes 1000,10000,100000
+# (sizes are flow segments, incidents are a tenth of that) or with recorded responses: --replay dir
+
+BERLIN_VIEW = (13.08836, 52.33812, 13.761, 52.6755)
+CITY_CENTER_VIEW = (13.38, 52.50, 13.42, 52.52)
+
+
+def incidents_for(segments):
+    return max(100, segments // 10)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Recorder:
+    def __init__(self):
+        self.results = []
+
+    def time(self, page, segments, stage, run):
+        # run returns (bytes, rows) or None
+        start = time.perf_counter()
+        out = run() or (None, None)
+        seconds = time.perf_counter() - start
+        size, rows = out
+        self.results.append({"page": page, "segments": segments, "stage": stage, "seconds": seconds,
+                             "bytes": size, "rows": rows})
+        shown = "" if size is None else f"{size / 1e3:>10.1f}"
+        print(f"## {page:>9} {segments:>8} {stage:>28} {seconds:>9.3f}s {shown:>10} KB {'' if rows is None else rows}")
+
+
+def callback_body(outputs, inputs, state=()):
+    # what the browser posts to /_dash-update-component
+    if len(outputs) == 1:
+        output, outputs = f"{outputs[0][0]}.{outputs[0][1]}", {"id": outputs[0][0], "property": outputs[0][1]}
+    else:
+        output = ".." + "...".join(f"{i}.{p}" for i, p in outputs) + ".."
+        outputs = [{"id": i, "property": p} for i, p in outputs]
+    return {
+        "output": output,
+        "outputs": outputs,
+        "inputs": [{"id": i, "property": p, "value": v} for i, p, v in inputs],
+        "changedPropIds": [f"{inputs[0][0]}.{inputs[0][1]}"],
+        "state": [{"id": i, "property": p, "value": v} for i, p, v in state],
+    }
+
+
+def store_update(client, body):
+    response = client.post("/_dash-update-component", json=body)
+    update = response.get_json()["response"][body["output"].rsplit(".", 1)[0]]["data"]
+    return len(response.data), update.get("rows")
+
+
+def viewport(client, path, view, zoom, filters=""):
+    west, south, east, north = view
+    response = client.get(f"{path}?west={west}&south={south}&east={east}&north={north}&zoom={zoom}&{filters}",
+                          headers={"Accept-Encoding": "gzip"})
+    data = gzip.decompress(response.data) if response.headers.get("Content-Encoding") == "gzip" else response.data
+    return len(response.data), len(json.loads(data)["lat"])
+
+
+def run_page(recorder, client, fake, page, segments, parse):
+    module = sys.modules[f"pages.{page}"]
+    refresher = module.flow_refresher if page == "flow" else module.incident_refresher
+    fetcher = module.flow_fetcher if page == "flow" else module.incident_fetcher
+    pipeline = module.flow_pipeline if page == "flow" else module.incident_pipeline
+    cluster = module.cluster_flow_data if page == "flow" else module.cluster_incident_data
+    keys = module.segment_ids if page == "flow" else module.incident_ids
+    endpoint = "flow" if page == "flow" else "incidents"
+    bbox = module.bounding_box
+
+    recorder.time(page, segments, "refresh", lambda: (None, len(refresher.refresh()["data"])))
+
+    fake.advance()
+    data = {}
+
+    def fetch():
+        data["frame"] = fetcher.fetch(bbox)
+        return None, len(data["frame"])
+    recorder.time(page, segments, "fetch", fetch)
+
+    raw = requests.get(fake.url + endpoint, params={"in": "bbox:" + bbox}).content
+    recorder.time(page, segments, "parse", lambda: (len(raw), len(parse(raw))))
+
+    # a throwaway pipeline with the page's settings that refits from scratch every time
+    full = ClusterPipeline(f"bench-{page}-{segments}", pipeline.features, "full", pipeline.params,
+                           pipeline.color_by, pipeline.colors, pipeline.keep_scaled)
+    frame = data["frame"]
+    if "geometry" in frame.attrs:
+        frame['lat'], frame['lng'] = frame.attrs["geometry"].midpoints()
+
+    def cluster_full():
+        full.run(frame.copy(), keys(frame))
+        return None, len(frame)
+
+    def cluster_incremental():
+        cluster(frame.copy())
+        return None, len(frame)
+    recorder.time(page, segments, "cluster_full", cluster_full)
+    recorder.time(page, segments, "cluster_incremental", cluster_incremental)
+
+    snapshot = refresher.current()
+    if page == "flow":
+        views = [("clustered_dot", False), ("clustered_dot", True), ("dot", False), ("clustered_heatmap", False),
+                 ("heatmap", False)]
+        render = module.render_flow_map
+    else:
+        views = [("combined", False), ("combined", True), ("raw", False)]
+        render = module.render_incident_map
+    for view, gray in views:
+        name = view + ("_gray" if gray else "")
+        recorder.time(page, segments, f"render_{name}",
+                      lambda: (len(render(snapshot, view, gray).encode("utf-8")), None))
+
+    # views switch in the browser, the server only sends the points
+    prefix = "flow" if page == "flow" else "incident"
+    store = ([(f"{prefix}-store-update", "data")], [(f"{prefix}-poll", "n_intervals", 0)])
+    selected = [] if page == "flow" else [("incident-map-dropdown", "value", "combined")]
+    recorder.time(page, segments, "store_full",
+                  lambda: store_update(client, callback_body(*store, [(f"{prefix}-version", "data", None)] + selected +
+                                                             [(f"{prefix}-region", "data", None)])))
+    snapshot = refresher.current()
+    version = snapshot_token(snapshot) if page == "flow" else module.incident_token(module.default_feed, snapshot)
+    refresher.refresh()
+    recorder.time(page, segments, "store_delta",
+                  lambda: store_update(client, callback_body(*store, [(f"{prefix}-version", "data", version)] + selected +
+                                                             [(f"{prefix}-region", "data", None)])))
+
+    layers = ["clustered_dot", "dot", "heatmap"] if page == "flow" else ["combined", "raw", "combined?hours=-3"]
+    for layer in layers:
+        kind = "heat" if "heatmap" in layer else "viewport"
+        path, _, filters = layer.partition("?")
+        for zoom, view in ((11, BERLIN_VIEW), (15, CITY_CENTER_VIEW)):
+            recorder.time(page, segments, f"{kind}_{path}{'_' + filters if filters else ''}_z{zoom}",
+                          lambda: viewport(client, f"/maps/points/{page}/{path}.json", view, zoom, filters))
+
+
+def compare(old_path, new):
+    with open(old_path) as f:
+        old = json.load(f)
+    before = {(r["page"], r["segments"], r["stage"]): r for r in old["results"]}
+    print(f"\ncompared with {old_path} ({old['run'].get('commit')}):")
+    print(f"{'page':>9} {'segments':>8} {'stage':>28} {'before s':>9} {'after s':>9} {'change':>8}")
+    for r in new["results"]:
+        b = before.get((r["page"], r["segments"], r["stage"]))
+        if b is None or not b["seconds"]:
+            continue
+        change = (r["seconds"] - b["seconds"]) / b["seconds"] * 100
+        print(f"{r['page']:>9} {r['segments']:>8} {r['stage']:>28} {b['seconds']:>9.3f} {r['seconds']:>9.3f} {change:>+7.0f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000", help="flow segments per run, up to 1000000")
+    parser.add_argument("--replay", help="directory with recorded responses (see fake_here.py --record)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every fake api response")
+    parser.add_argument("--output", help="where to save the json (default benchmarks/results/end_to_end-<time>.json)")
+    parser.add_argument("--compare", help="an earlier results json to compare against")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    from fake_here import FakeHereServer
+    fake = FakeHereServer(sizes[0], incidents_for(sizes[0]), replay_dir=args.replay, latency=args.latency).start()
+
+    # the app runs as usual but against the fake api, without background refreshes
+    # and with history going to a temporary folder
+    tmp = tempfile.TemporaryDirectory()
+    os.environ.update({
+        "HERE_BASE_URL": fake.url,
+        "HERE_API_KEY": os.getenv("HERE_API_KEY") or "fake",
+        "FLOW_REFRESH_SECONDS": "86400",
+        "INCIDENT_REFRESH_SECONDS": "86400",
+        "HERE_RATE_LIMIT": "0",  # the fake api has no quota
+        "HISTORY_DIR": os.path.join(tmp.name, "history"),
+        "SNAPSHOT_CACHE_DIR": "",  # always a cold start
+    })
+    import app
+    from clustering_pipeline import ClusterPipeline
+    from client_store import snapshot_token
+    from stream_parser import parse_flow_stream
+    from traffic_fetcher import parse_incident_body
+
+    for page in ("flow", "incidents"):
+        module = sys.modules[f"pages.{page}"]
+        refresher = module.flow_refresher if page == "flow" else module.incident_refresher
+        while refresher.current() is None:
+            time.sleep(0.1)
+
+    started = datetime.now(timezone.utc)
+    recorder = Recorder()
+    client = app.app.server.test_client()
+    for i, segments in enumerate(sizes):
+        if i and not args.replay:
+            fake.configure(segments, incidents_for(segments))
+        run_page(recorder, client, fake, "flow", segments, parse_flow_stream)
+        run_page(recorder, client, fake, "incidents", segments, parse_incident_body)
+
+    result = {
+        "run": {
+            "started": started.isoformat(),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "sizes": sizes,
+            "replay": args.replay,
+            "latency": args.latency,
+        },
+        "results": recorder.results,
+    }
+    output = args.output or os.path.join(current_dir, "results", f"end_to_end-{started:%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(result, f, indent=1)
+    print(f"\nsaved {len(recorder.results)} results to {output}")
+    if args.compare:
+        compare(args.compare, result)
+    tmp.cleanup()
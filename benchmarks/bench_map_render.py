@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+import folium
+from folium.plugins import HeatMap
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from client_store import ClientStore
+from history_store import segment_ids
+from map_layers import add_client_layer, add_viewport_heatmap, add_viewport_layer, build_popups, jam_colors
+from viewport import HeatSource, ViewportSource
+
+# render time and html size of the clustered dot map and the heatmap, the old per-row iterrows
+# maps vs what the flow page sends now:
+# - viewport: the ViewportPointLayer page, the pyramid build and the first zoom 11 request for all
+#   of berlin (pages/flow.py create_viewport_dot_map, flow_viewport_source)
+# - client: the ClientPointLayer page and the first full ClientStore payload (create_client_map,
+#   flow_store_update), the browser draws every view from it
+# - heat_grid: the heatmap page, grid build and the first zoom 11 request
+# size is the page plus that response
+# run from the project root: py benchmarks/bench_map_render.py
+
+BERLIN = (13.08836, 52.33812, 13.761, 52.6755)
+# same as pages/flow.py flow_client_columns
+CLIENT_COLUMNS = [
+    ("lat", "lat", 1e6), ("lng", "lng", 1e6),
+    ("jam", "jam_factor", 10), ("speed", "speed", 10), ("free_flow", "free_flow_speed", 10),
+    ("kmeans", "kmeans_cluster", 1), ("dbscan", "dbscan_cluster", 1),
+    ("description", "description", None),
+]
+
+
+def synthetic_segments(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "description": pd.Series(rng.integers(0, 2000, n)).map("Street {}".format),
+        "speed": rng.uniform(5, 80, n).round(1),
+        "free_flow_speed": rng.uniform(30, 80, n).round(1),
+        "jam_factor": rng.uniform(0, 10, n).round(1),
+        "lat": rng.uniform(52.33812, 52.6755, n),
+        "lng": rng.uniform(13.08836, 13.761, n),
+        "kmeans_cluster": rng.integers(0, 3, n),
+        "dbscan_cluster": rng.integers(-1, 20, n),
+    })
+
+
+def render_iterrows(data, colors):
+    m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
+    for _, row in data.iterrows():
+        color = 'gray' if row['dbscan_cluster'] == -1 else colors.get(row['kmeans_cluster'], 'blue')
+        popup_content = (
+            f"<b>Location:</b> {row['description']}<br>"
+            f"<b>Speed:</b> {row['speed']} km/h<br>"
+            f"<b>Jam Factor:</b> {row['jam_factor']}<br>"
+            f"<b>KMeans Cluster:</b> {row['kmeans_cluster']}<br>"
+            f"<b>DBSCAN Cluster:</b> {row['dbscan_cluster']}"
+        )
+        popup = folium.Popup(popup_content, max_width=400, min_width=200)
+        folium.CircleMarker(location=[row['lat'], row['lng']], radius=5, color=color,
+                            fill=True, fill_opacity=0.7, popup=popup).add_to(m)
+    return m._repr_html_()
+
+
+def render_viewport(data, colors):
+    m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
+    # noise stays in gray like the iterrows map (the clustered_dot-gray layer)
+    add_viewport_layer(m, "points/flow/clustered_dot-gray.json")
+    point_colors = data['kmeans_cluster'].map(colors).fillna('blue')
+    point_colors = point_colors.where(data['dbscan_cluster'] != -1, 'gray')
+    popups = lambda subset: build_popups(subset, [
+        ("Location", 'description', ""),
+        ("Speed", 'speed', " km/h"),
+        ("Jam Factor", 'jam_factor', ""),
+        ("KMeans Cluster", 'kmeans_cluster', ""),
+        ("DBSCAN Cluster", 'dbscan_cluster', ""),
+    ])
+    source = ViewportSource(data, point_colors, popups, 'jam_factor', "segments", jam_colors)
+    return m._repr_html_() + source.query(*BERLIN, 11)
+
+
+def render_client(data, colors):
+    m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
+    add_client_layer(m, "flow")
+    update = ClientStore(CLIENT_COLUMNS, segment_ids).payload("1", data)
+    return m._repr_html_() + json.dumps(update, separators=(",", ":"))
+
+
+def render_heat_iterrows(data):
+    m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
+    heat_data = [
+        [row['lat'], row['lng'], row['jam_factor']]
+        for _, row in data.iterrows()
+        if row['jam_factor'] > 0
+    ]
+    HeatMap(heat_data, min_opacity=0.5, radius=15, blur=10).add_to(m)
+    return m._repr_html_()
+
+
+def render_heat_grid(data):
+    m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
+    add_viewport_heatmap(m, "points/flow/heatmap.json")
+    source = HeatSource(data['lat'], data['lng'], data['jam_factor'])
+    return m._repr_html_() + source.query(*BERLIN, 11)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    html = fn(*args)
+    return time.perf_counter() - start, len(html.encode("utf-8"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,500000")
+    parser.add_argument("--legacy-max", type=int, default=10000,
+                        help="largest size to also render the old iterrows way (it is slow)")
+    args = parser.parse_args()
+
+    colors = {0: 'green', 1: 'orange', 2: 'red'}
+    print(f"{'segments':>10} {'method':>12} {'seconds':>10} {'html MB':>10}")
+    for n in [int(s) for s in args.sizes.split(",")]:
+        data = synthetic_segments(n)
+        seconds, size = timed(render_viewport, data, colors)
+        print(f"{n:>10} {'viewport':>12} {seconds:>10.2f} {size / 1e6:>10.2f}")
+        seconds, size = timed(render_client, data, colors)
+        print(f"{n:>10} {'client':>12} {seconds:>10.2f} {size / 1e6:>10.2f}")
+        if n <= args.legacy_max:
+            seconds, size = timed(render_iterrows, data, colors)
+            print(f"{n:>10} {'iterrows':>12} {seconds:>10.2f} {size / 1e6:>10.2f}")
+        seconds, size = timed(render_heat_grid, data)
+        print(f"{n:>10} {'heat_grid':>12} {seconds:>10.2f} {size / 1e6:>10.2f}")
+        if n <= args.legacy_max:
+            seconds, size = timed(render_heat_iterrows, data)
+            print(f"{n:>10} {'heat_rows':>12} {seconds:>10.2f} {size / 1e6:>10.2f}")
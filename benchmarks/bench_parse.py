@@ -0,0 +1,114 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+
+# peak memory and throughput of the response parsers: json.loads + per row dicts
+# (the old path) against the streaming column parser. each run is its own process so
+# peak RSS belongs to that parse only.
+# run from the project root: py benchmarks/bench_parse.py
+# or on recorded responses: py benchmarks/bench_parse.py --flow saved_flow.json --incidents saved_incidents.json
+
+
+def _status_mb(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+
+
+def rss_mb():
+    # current RSS. on linux the peak is reset here too so reading the file doesn't count towards it
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _status_mb("VmRSS")
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    try:
+        return _status_mb("VmHWM")
+    except OSError:  # not linux
+        return None
+
+
+def child(kind, method, path):
+    from traffic_fetcher import parse_flow_response, parse_incident_response, parse_incident_body
+    from stream_parser import parse_flow_stream
+
+    with open(path, "rb") as f:
+        body = f.read()
+    parsers = {
+        ("flow", "dicts"): lambda: parse_flow_response(json.loads(body)),
+        ("flow", "stream"): lambda: parse_flow_stream(body),
+        ("incidents", "dicts"): lambda: parse_incident_response(json.loads(body)),
+        ("incidents", "stream"): lambda: parse_incident_body(body),
+    }
+    before = rss_mb()
+    start = time.perf_counter()
+    frame = parsers[(kind, method)]()
+    seconds = time.perf_counter() - start
+    after = peak_rss_mb()
+    print(json.dumps({
+        "rows": len(frame),
+        "seconds": seconds,
+        "mb_per_s": len(body) / 1e6 / seconds,
+        "peak_rss_mb": None if before is None or after is None else after - before,
+        "frame_mb": frame.memory_usage(deep=True).sum() / 1e6,
+    }))
+
+
+def run(kind, method, path):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", kind, method, path],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000", help="synthetic payload sizes (results per payload)")
+    parser.add_argument("--flow", help="recorded flow response to use instead of synthetic ones")
+    parser.add_argument("--incidents", help="recorded incidents response to use instead of synthetic ones")
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        sys.exit()
+
+    from fake_here import flow_payload, incident_payload, payload_bytes
+
+    payloads = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.flow or args.incidents:
+            if args.flow:
+                payloads.append(("flow", args.flow))
+            if args.incidents:
+                payloads.append(("incidents", args.incidents))
+        else:
+            for n in [int(s) for s in args.sizes.split(",")]:
+                for kind, make in (("flow", flow_payload), ("incidents", incident_payload)):
+                    path = os.path.join(tmp, f"{kind}_{n}.json")
+                    with open(path, "wb") as f:
+                        f.write(payload_bytes(make(n)))
+                    payloads.append((kind, path))
+
+        print(f"{'payload':>24} {'MB':>7} {'method':>7} {'rows':>8} {'seconds':>8} {'MB/s':>7} {'peak RSS MB':>12} {'frame MB':>9}")
+        for kind, path in payloads:
+            size = os.path.getsize(path) / 1e6
+            for method in ("dicts", "stream"):
+                r = run(kind, method, path)
+                peak = "n/a" if r["peak_rss_mb"] is None else f"{r['peak_rss_mb']:.1f}"
+                print(f"{os.path.basename(path):>24} {size:>7.1f} {method:>7} {r['rows']:>8} {r['seconds']:>8.2f} "
+                      f"{r['mb_per_s']:>7.1f} {peak:>12} {r['frame_mb']:>9.1f}")
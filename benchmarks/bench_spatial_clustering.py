@@ -0,0 +1,66 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+
+from sklearn.cluster import DBSCAN
+from spatial_clustering import SpatialIndex
+from fake_here import BERLIN
+
+# dbscan on lat/lng: the old euclidean-on-degrees fit, a haversine ball tree fit, and a
+# sweep of several eps / min_samples settings off one shared neighbour graph
+# (sweep time is for all settings together). points are clumped around "roads" the way
+# flow segments are.
+# run from the project root: py benchmarks/bench_spatial_clustering.py
+
+
+def make_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    west, south, east, north = BERLIN
+    centers = rng.uniform([south, west], [north, east], (max(1, n // 50), 2))
+    points = centers[rng.integers(0, len(centers), n)] + rng.normal(0, 0.003, (n, 2))
+    return points[:, 0], points[:, 1]
+
+
+def timed(run):
+    start = time.perf_counter()
+    result = run()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--eps", default="25,50,100", help="eps values in meters for the sweep")
+    parser.add_argument("--min-samples", default="3,5,10")
+    parser.add_argument("--skip-degrees-above", type=int, default=100000,
+                        help="don't run the euclidean-on-degrees fit above this many points")
+    args = parser.parse_args()
+    eps_values = [float(e) for e in args.eps.split(",")]
+    min_samples_values = [int(m) for m in args.min_samples.split(",")]
+    eps_m = max(eps_values)
+    eps_deg = eps_m / 111_320
+
+    print(f"{'points':>9} {'degrees s':>10} {'haversine s':>12} {'graph s':>8} {'sweep s':>8} "
+          f"{'settings':>9} {'edges':>11} {'clusters':>9} {'noise':>8}")
+    for n in [int(s) for s in args.sizes.split(",")]:
+        lat, lng = make_points(n)
+
+        degrees = "skipped"
+        if n <= args.skip_degrees_above:
+            seconds, _ = timed(lambda: DBSCAN(eps=eps_deg, min_samples=5).fit(np.column_stack([lat, lng])))
+            degrees = f"{seconds:.2f}"
+
+        single, labels = timed(lambda: SpatialIndex(lat, lng, eps_m).dbscan(eps_m, 5))
+
+        index = SpatialIndex(lat, lng, eps_m)
+        graph_seconds, graph = timed(lambda: index.graph())
+        sweep_seconds, (table, _) = timed(lambda: index.sweep(eps_values, min_samples_values))
+
+        print(f"{n:>9} {degrees:>10} {single:>12.2f} {graph_seconds:>8.2f} {sweep_seconds:>8.2f} "
+              f"{len(table):>9} {graph.nnz:>11} {len(set(labels.tolist()) - {-1}):>9} {int((labels == -1).sum()):>8}")
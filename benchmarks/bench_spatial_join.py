@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from geometry import SegmentGeometry
+from spatial_join import SegmentIndex, join_incidents
+
+# incident -> flow segment join (spatial_join.py) at city sizes: building the segment index
+# once per flow snapshot, and the join per refresh, on first points only and on full shapes
+# (points_per_segment points each, like FULL_GEOMETRY=1)
+# run from the project root: py benchmarks/bench_spatial_join.py
+
+
+def synthetic_flow(n, points_per_segment, seed=0):
+    rng = np.random.default_rng(seed)
+    lat = rng.uniform(52.33812, 52.6755, n)
+    lng = rng.uniform(13.08836, 13.761, n)
+    data = pd.DataFrame({
+        "lat": lat,
+        "lng": lng,
+        "speed": rng.uniform(5, 80, n),
+        "free_flow_speed": rng.uniform(30, 80, n),
+        "jam_factor": rng.uniform(0, 10, n),
+    })
+    if points_per_segment > 1:
+        # short roads heading off in a random direction, ~20m a step
+        steps = np.arange(points_per_segment)
+        angle = rng.uniform(0, 2 * np.pi, n)[:, None]
+        shape_lat = lat[:, None] + steps * 0.00018 * np.sin(angle)
+        shape_lng = lng[:, None] + steps * 0.0003 * np.cos(angle)
+        offsets = np.arange(n + 1) * points_per_segment
+        data.attrs["geometry"] = SegmentGeometry(shape_lat.ravel(), shape_lng.ravel(), offsets)
+    return data
+
+
+def synthetic_incidents(n, seed=1):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"lat": rng.uniform(52.33812, 52.6755, n), "lng": rng.uniform(13.08836, 13.761, n)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,50000,200000", help="flow segments, incidents are a tenth")
+    parser.add_argument("--radius", type=float, default=200, help="meters")
+    parser.add_argument("--points", type=int, default=10, help="shape points per segment for the full geometry runs")
+    args = parser.parse_args()
+
+    print(f"{'segments':>10} {'incidents':>10} {'points':>10} {'index s':>10} {'join s':>10} {'pairs':>10}")
+    for n in [int(s) for s in args.sizes.split(",")]:
+        incidents = synthetic_incidents(n // 10)
+        for points in (1, args.points):
+            flow = synthetic_flow(n, points)
+            start = time.perf_counter()
+            index = SegmentIndex(flow)
+            built = time.perf_counter() - start
+            start = time.perf_counter()
+            _, pairs = join_incidents(incidents, flow, args.radius, index)
+            joined = time.perf_counter() - start
+            print(f"{n:>10} {len(incidents):>10} {n * points:>10} {built:>10.3f} {joined:>10.3f} {len(pairs):>10}")
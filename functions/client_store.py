@@ -0,0 +1,141 @@
+import base64
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# a snapshot's points for the browser, kept in a dcc.Store so switching views, hiding noise and
+# recoloring run in clientside callbacks (assets/client_maps.js) without asking the server.
+#
+# columns go as base64 typed arrays: numbers scaled to ints (coordinates in micro degrees,
+# speeds in tenths...) in the smallest int type that fits, delta encoded when the deltas fit a
+# smaller one, text as codes into a list of names. rows are kept in a fixed order (by the first
+# two columns, lat and lng, then id) so after a refresh only the difference to the browser's
+# version is sent: the rows to drop from it and the new or changed rows with where they go.
+#
+# columns is a list of (name in the browser, frame column, scale), scale None for text, and
+# ids(frame) gives each row an id that stays the same across refreshes (history_store.segment_ids)
+
+INT_TYPES = [("i1", np.int8), ("i2", np.int16), ("i4", np.int32)]
+MISSING = np.iinfo(np.int64).min
+
+
+def _smallest(values):
+    low, high = (int(values.min()), int(values.max())) if len(values) else (0, 0)
+    for name, dtype in INT_TYPES:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return name, dtype
+    return None, None
+
+
+def pack(values):
+    # int array -> {"type", "data"} or, when the steps fit a smaller type, the first value and
+    # the steps from each value to the next as {"type", "start", "data"}
+    values = np.asarray(values, dtype=np.int64)
+    name, dtype = _smallest(values)
+    if dtype is None:
+        raise ValueError(f"values out of int32 range ({values.min()}, {values.max()})")
+    if len(values) > 1:
+        steps = np.diff(values)
+        step_name, step_dtype = _smallest(steps)  # steps across the whole int32 range don't fit one
+        if step_dtype is not None and np.dtype(step_dtype).itemsize < np.dtype(dtype).itemsize:
+            data = steps.astype(np.dtype(step_dtype).newbyteorder("<")).tobytes()
+            return {"type": step_name, "start": int(values[0]), "data": base64.b64encode(data).decode("ascii")}
+    data = values.astype(np.dtype(dtype).newbyteorder("<")).tobytes()
+    return {"type": name, "data": base64.b64encode(data).decode("ascii")}
+
+
+def quantize(values, scale):
+    # numbers -> ints, MISSING where there was a NaN
+    values = np.asarray(values, dtype=float) * scale
+    return np.where(np.isnan(values), MISSING, np.round(np.nan_to_num(values))).astype(np.int64)
+
+
+def encode_column(values, scale):
+    if scale is None:
+        codes, names = pd.factorize(pd.Series(values, dtype=object))
+        return {"names": names.tolist(), "codes": pack(codes)}
+    missing = values == MISSING
+    encoded = {"scale": scale, "values": pack(np.where(missing, 0, values))}
+    if missing.any():
+        encoded["missing"] = pack(np.flatnonzero(missing))
+    return encoded
+
+
+class ClientTable:
+    # one snapshot's columns in client order, quantized the way the browser gets them
+    def __init__(self, data, ids, columns):
+        self.scales = {name: scale for name, _, scale in columns}
+        values = {
+            name: data[column].astype(str).to_numpy(dtype=object) if scale is None else quantize(data[column], scale)
+            for name, column, scale in columns
+        }
+        # the same id twice (two segments hashing alike) stays two rows
+        ids = pd.Series(np.asarray(ids, dtype=np.int64))
+        occurrence = ids.groupby(ids).cumcount().to_numpy()
+        first, second = columns[0][0], columns[1][0]
+        order = np.lexsort((occurrence, ids.to_numpy(), values[second], values[first]))
+        self.values = {name: column[order] for name, column in values.items()}
+        self.keys = pd.MultiIndex.from_arrays([ids.to_numpy()[order], occurrence[order]])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def encode(self, rows=None):
+        return {
+            name: encode_column(values if rows is None else values[rows], self.scales[name])
+            for name, values in self.values.items()
+        }
+
+    def diff(self, base):
+        # (positions in base to drop, positions in self to insert), a changed row is both
+        found = base.keys.get_indexer(self.keys)
+        same = found >= 0
+        at = np.where(same, found, 0)
+        for name, values in self.values.items():
+            if len(base):
+                same &= values == base.values[name][at]
+        kept = np.zeros(len(base), dtype=bool)
+        kept[found[same]] = True
+        return np.flatnonzero(~kept), np.flatnonzero(~same)
+
+
+class ClientStore:
+    # per page: the tables of the last few snapshots and the payloads already encoded from them
+    def __init__(self, columns, ids, keep=3):
+        self.columns = columns
+        self.ids = ids
+        self.keep = keep
+        self._tables = OrderedDict()
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def payload(self, token, data, client_token=None):
+        # the rows that changed since client_token if that snapshot is still known and the
+        # change is less than half of it, else every row
+        with self._lock:
+            table = self._tables.get(token)
+            if table is None:
+                table = self._tables[token] = ClientTable(data, self.ids(data), self.columns)
+                while len(self._tables) > self.keep:
+                    old, _ = self._tables.popitem(last=False)
+                    self._payloads = {key: value for key, value in self._payloads.items() if old not in key}
+            base = client_token if client_token in self._tables and client_token != token else None
+            if (token, base) not in self._payloads:
+                self._payloads[(token, base)] = self._encode(token, table, base)
+            return self._payloads[(token, base)]
+
+    def _encode(self, token, table, base):
+        if base is not None:
+            remove, insert = table.diff(self._tables[base])
+            if len(insert) < len(table) // 2:
+                return {"version": token, "base": base, "rows": len(table),
+                        "remove": pack(remove), "insert": pack(insert), "columns": table.encode(insert)}
+        return {"version": token, "rows": len(table), "columns": table.encode()}
+
+
+def snapshot_token(snapshot):
+    # names a snapshot for the browser: version and build time, so a version number from
+    # another worker process (one not sharing snapshots) is never taken for this one's
+    return f"{snapshot['version']}-{snapshot['built_at']:.3f}"
@@ -0,0 +1,48 @@
+from functools import partial
+import numpy as np
+import pandas as pd
+from incremental_clustering import IncrementalClusterer
+
+# the part of clustering_pipeline that runs inside the worker processes. kept in its own
+# module so it is fully imported before the workers are forked (a fork in the middle of
+# importing a module leaves that module locked in the child)
+
+ALGORITHMS = {
+    "incremental": IncrementalClusterer,  # carries models over between refreshes
+    "full": partial(IncrementalClusterer, refit_every=1),  # fresh fit every time, ids still matched
+}
+
+
+_clusterers = {}  # pipeline name -> algorithm instance, lives in the worker process
+
+
+def run_job(name, algorithm, params, columns, keys, color_by=None, colors=None, keep_scaled=()):
+    clusterer = _clusterers.get(name)
+    if clusterer is None:
+        clusterer = _clusterers[name] = ALGORITHMS[algorithm](**params)
+    frame = pd.DataFrame(columns, copy=False)
+    clusterer.update(frame, keys)
+
+    kmeans_labels = frame['kmeans_cluster'].to_numpy(dtype=np.int32)
+    result = {
+        "kmeans_cluster": kmeans_labels,
+        "dbscan_cluster": frame['dbscan_cluster'].to_numpy(dtype=np.int32),
+        "centroids": np.asarray(clusterer.kmeans.cluster_centers_),
+        "scaled": {column: frame[column].to_numpy() for column in keep_scaled},
+        "stats": clusterer.last_stats,
+        "colors": None,
+    }
+    if color_by is not None:
+        result["colors"] = rank_colors(kmeans_labels, columns[color_by], colors)
+    return result
+
+
+def rank_colors(labels, values, colors):
+    # clusters ordered by their mean value, lowest gets colors[0]
+    if len(labels) == 0:
+        return {}
+    sums = np.bincount(labels, weights=values)
+    counts = np.bincount(labels)
+    present = np.flatnonzero(counts)
+    order = present[np.argsort(sums[present] / counts[present], kind="stable")]
+    return {int(cluster): colors[min(rank, len(colors) - 1)] for rank, cluster in enumerate(order)}
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+from cluster_jobs import run_job
+import metrics
+
+# the clustering for both pages, run in worker processes so kmeans / dbscan don't hold the
+# GIL while dash is serving requests.
+# - a feature set turns a snapshot into plain numpy columns (runs in the web process)
+# - an algorithm (by name, from cluster_jobs.ALGORITHMS) does the clustering in the worker and keeps its
+#   state there between refreshes
+# only the columns go to the worker and only label / centroid arrays come back, never a
+# DataFrame. each pipeline sticks to one worker so its state is always in the same process,
+# flow and incidents get different workers so they run in parallel.
+# CLUSTER_WORKERS=0 runs everything in the web process instead
+
+# feature sets
+
+def flow_features(data):
+    return {column: data[column].to_numpy(dtype=float) for column in ("lat", "lng", "jam_factor")}
+
+
+CRITICALITY_VALUES = {"minor": 1, "moderate": 2, "major": 3}
+
+
+def incident_features(data):
+    if 'criticality' in data.columns:
+        criticality = data['criticality'].astype(str).map(CRITICALITY_VALUES).fillna(0)
+    else:
+        criticality = pd.Series(0, index=data.index)  # default if missing (but shouldnt be)
+    return {
+        "lat": data['lat'].to_numpy(dtype=float),
+        "lng": data['lng'].to_numpy(dtype=float),
+        "criticality_value": criticality.to_numpy(dtype=float),
+    }
+
+
+# web side
+
+def _start_workers(count):
+    # forked now, at import time while nothing else is running, so the workers don't inherit
+    # locks held by the refresher threads. without fork (windows) the workers would re-import
+    # the app, so it falls back to running in process
+    if count <= 0 or "fork" not in multiprocessing.get_all_start_methods():
+        return []
+    context = multiprocessing.get_context("fork")
+    pools = [ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(count)]
+    pids = [pool.submit(os.getpid).result() for pool in pools]
+    print(f"@@ clustering workers started: {pids} @@")
+    return pools
+
+
+_pools = _start_workers(int(os.getenv("CLUSTER_WORKERS", 2)))
+_pipelines = []
+
+
+class ClusterPipeline:
+    def __init__(self, name, features, algorithm="incremental", params=None, color_by=None, colors=None,
+                 keep_scaled=()):
+        self.name = name
+        self.features = features
+        self.algorithm = algorithm
+        self.params = params or {}
+        self.color_by = color_by
+        self.colors = colors
+        self.keep_scaled = tuple(keep_scaled)  # scaled feature columns to copy back onto the data
+        self.worker = len(_pipelines) % len(_pools) if _pools else None
+        _pipelines.append(self)
+
+    def run(self, data, keys):
+        # adds kmeans_cluster / dbscan_cluster (and keep_scaled) to data,
+        # returns the rest of the result (centroids, colors, stats)
+        columns = self.features(data)
+        job = (self.name, self.algorithm, self.params, columns, np.asarray(keys, dtype=np.int64),
+               self.color_by, self.colors, self.keep_scaled)
+        start = time.perf_counter()
+        if self.worker is None:
+            result = run_job(*job)
+        else:
+            try:
+                result = _pools[self.worker].submit(run_job, *job).result()
+            except BrokenProcessPool:
+                # worker died (oom?), its state is gone so the next fit is a full one
+                print(f"@@ clustering worker for {self.name} died, restarting @@")
+                _pools[self.worker] = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork"))
+                result = _pools[self.worker].submit(run_job, *job).result()
+        seconds = time.perf_counter() - start
+        print(f"{self.name} clustering round trip: {seconds:.2f}s")
+        metrics.cluster_seconds.observe(seconds, page=self.name, algorithm=self.algorithm)
+        metrics.cluster_rows.observe(len(data), page=self.name)
+
+        data['kmeans_cluster'] = result.pop("kmeans_cluster")
+        data['dbscan_cluster'] = result.pop("dbscan_cluster")
+        for column, values in result.pop("scaled").items():
+            data[column] = values
+        return result
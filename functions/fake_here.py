@@ -0,0 +1,341 @@
+import argparse
+import gzip
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+
+# synthetic HERE traffic v7 payloads shaped like the real flow / incidents responses,
+# for benchmarks and for running the app without an api key.
+# FakeHereServer serves them (or recorded responses) over http like the real api:
+#   py functions/fake_here.py --flow 100000 --incidents 5000
+# then start the app with HERE_BASE_URL set to the url it prints
+
+BERLIN = (13.08836, 52.33812, 13.761, 52.6755)
+CRITICALITIES = ["minor", "major", "critical", "low"]
+INCIDENT_TYPES = ["accident", "construction", "congestion", "roadClosure", "laneRestriction", "disabledVehicle"]
+
+
+def _shape(rng, west, south, east, north, links, points_per_link):
+    lat = rng.uniform(south, north)
+    lng = rng.uniform(west, east)
+    shape = []
+    for _ in range(links):
+        points = []
+        for _ in range(points_per_link):
+            points.append({"lat": round(lat, 5), "lng": round(lng, 5)})
+            lat += rng.uniform(-0.0008, 0.0008)
+            lng += rng.uniform(-0.0012, 0.0012)
+        shape.append({"points": points, "length": rng.randint(20, 400), "functionalClass": rng.randint(1, 5)})
+    return {"links": shape}
+
+
+def _flow_result(rng, streets, bounding_box):
+    west, south, east, north = bounding_box
+    free_flow = rng.uniform(15, 90)
+    speed = free_flow * rng.uniform(0.1, 1)
+    return {
+        "location": {
+            "description": rng.choice(streets),
+            "length": round(rng.uniform(30, 1500), 1),
+            "shape": _shape(rng, west, south, east, north, rng.randint(1, 3), rng.randint(2, 6)),
+        },
+        "currentFlow": {
+            "speed": round(speed, 2),
+            "speedUncapped": round(speed, 2),
+            "freeFlow": round(free_flow, 2),
+            "jamFactor": round(10 * (1 - speed / free_flow), 1),
+            "confidence": round(rng.uniform(0.7, 1), 2),
+            "traversability": "open",
+        },
+    }
+
+
+def _incident_result(rng, i, now, bounding_box):
+    west, south, east, north = bounding_box
+    start = now - timedelta(hours=rng.uniform(0, 72))
+    end = start + timedelta(hours=rng.uniform(0.5, 96))
+    kind = rng.choice(INCIDENT_TYPES)
+    return {
+        "location": {
+            "length": round(rng.uniform(10, 3000), 1),
+            "shape": _shape(rng, west, south, east, north, rng.randint(1, 2), rng.randint(2, 5)),
+        },
+        "incidentDetails": {
+            "id": str(1000000 + i),
+            "originalId": str(2000000 + i),
+            "startTime": _iso(start),
+            "endTime": _iso(end),
+            "entryTime": _iso(start),
+            "roadClosed": kind == "roadClosure",
+            "criticality": rng.choice(CRITICALITIES),
+            "type": kind,
+            "codes": [rng.randint(1, 2000)],
+            "description": {"value": f"{kind} on Street {rng.randint(0, 500)}", "language": "en"},
+            "summary": {"value": kind, "language": "en"},
+        },
+    }
+
+
+def _streets(segments):
+    return [f"Street {i}" for i in range(max(1, segments // 20))]
+
+
+def flow_payload(segments, bounding_box=BERLIN, seed=0, source_updated=None):
+    rng = random.Random(seed)
+    streets = _streets(segments)
+    results = [_flow_result(rng, streets, bounding_box) for _ in range(segments)]
+    return {"sourceUpdated": source_updated or _now(), "results": results}
+
+
+def incident_payload(incidents, bounding_box=BERLIN, seed=0, source_updated=None):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    results = [_incident_result(rng, i, now, bounding_box) for i in range(incidents)]
+    return {"sourceUpdated": source_updated or _now(), "results": results}
+
+
+def payload_bytes(payload):
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def _iso(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _now():
+    return _iso(datetime.now(timezone.utc))
+
+
+# fake server
+
+class _Feed:
+    # one endpoint's results, each kept as its own json fragment with its first point so a
+    # bbox request only joins the fragments inside it (that's how HERE answers tiles)
+    def __init__(self, make_result=None, count=0, results=None, source_updated=None, seed=0):
+        self.make_result = make_result  # rng, index -> result dict, None for recorded feeds
+        self.seed = seed
+        self.source_updated = source_updated or _next_source_updated()
+        self.id = next(_feed_ids)
+        self.version = 0
+        if results is None:
+            rng = random.Random(seed)
+            results = (make_result(rng, i) for i in range(count))
+        fragments, lat, lng = [], [], []
+        for result in results:
+            fragments.append(_fragment(result))
+            point = _first_point(result)
+            lat.append(point[0])
+            lng.append(point[1])
+        self.fragments = np.array(fragments + [b""], dtype=object)[:-1]  # [b""] keeps it 1-d
+        self.lat = np.array(lat, dtype=float)
+        self.lng = np.array(lng, dtype=float)
+        self._bodies = {}
+
+    def advance(self, fraction=0.05, moved=0.1):
+        # a new snapshot: new sourceUpdated, and a fraction of the synthetic results change.
+        # like the real feed most keep their road and only get new values, `moved` of them
+        # are somewhere else (a segment dropped and another one added)
+        self.version += 1
+        self.source_updated = _next_source_updated()
+        if self.make_result is not None and len(self.fragments):
+            rng = random.Random(self.seed + self.version)
+            for i in rng.sample(range(len(self.fragments)), int(len(self.fragments) * fraction)):
+                result = self.make_result(rng, i)
+                if rng.random() >= moved:
+                    result["location"] = json.loads(self.fragments[i])["location"]
+                self.fragments[i] = _fragment(result)
+                self.lat[i], self.lng[i] = _first_point(result)
+        self._bodies = {}
+
+    def body(self, box):
+        # (etag, json bytes) for a "west,south,east,north" bbox, kept until the next advance
+        cached = self._bodies.get(box)
+        if cached is None:
+            west, south, east, north = box
+            inside = (self.lat >= south) & (self.lat <= north) & (self.lng >= west) & (self.lng <= east)
+            body = (b'{"sourceUpdated":"' + self.source_updated.encode() + b'","results":['
+                    + b",".join(self.fragments[inside]) + b"]}")
+            etag = f'"{self.id}-{self.version}-{abs(hash(box)):x}"'
+            cached = self._bodies[box] = (etag, body, gzip.compress(body, compresslevel=1))
+        return cached
+
+
+_feed_ids = itertools.count()
+_last_update = [datetime.now(timezone.utc)]
+
+
+def _next_source_updated():
+    # a different sourceUpdated for every snapshot, even several in the same second
+    # (the client reuses its last parse when sourceUpdated hasn't changed)
+    _last_update[0] = max(datetime.now(timezone.utc), _last_update[0] + timedelta(seconds=1))
+    return _iso(_last_update[0])
+
+
+def _fragment(result):
+    return json.dumps(result, separators=(",", ":")).encode("utf-8")
+
+
+def _first_point(result):
+    try:
+        point = result["location"]["shape"]["links"][0]["points"][0]
+        return point["lat"], point["lng"]
+    except (KeyError, IndexError):
+        return 0.0, 0.0
+
+
+def _recorded(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        return json.loads(f.read())
+
+
+class FakeHereServer:
+    # local stand-in for data.traffic.hereapi.com/v7: /v7/flow and /v7/incidents with the
+    # in=bbox: parameter, ETag / If-None-Match, gzip. any apiKey is accepted.
+    # replay_dir holds recorded flow.json / incidents.json (or .json.gz, see record()),
+    # otherwise synthetic results are spread over bounding_box.
+    # latency (seconds) is added to every response, error_rate answers that share with a 503.
+    # failures is a list of (status, headers) answered in order before anything else
+    def __init__(self, flow_segments=1000, incidents=100, bounding_box=BERLIN, seed=0, replay_dir=None,
+                 port=0, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.failures = []
+        self.requests = 0
+        self.feeds = {}
+        self.configure(flow_segments, incidents, bounding_box, seed, replay_dir)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), _handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    def configure(self, flow_segments=1000, incidents=100, bounding_box=BERLIN, seed=0, replay_dir=None):
+        # (re)build both feeds, e.g. between benchmark sizes
+        start = time.perf_counter()
+        streets = _streets(flow_segments)
+        now = datetime.now(timezone.utc)
+        makers = {
+            "flow": (lambda rng, i: _flow_result(rng, streets, bounding_box), flow_segments),
+            "incidents": (lambda rng, i: _incident_result(rng, i, now, bounding_box), incidents),
+        }
+        feeds = {}
+        for endpoint, (make, count) in makers.items():
+            recorded = None
+            for name in (f"{endpoint}.json", f"{endpoint}.json.gz"):
+                if replay_dir and os.path.exists(os.path.join(replay_dir, name)):
+                    recorded = _recorded(os.path.join(replay_dir, name))
+            if recorded is not None:
+                feeds[endpoint] = _Feed(results=recorded.get("results", []), source_updated=recorded.get("sourceUpdated"))
+            else:
+                feeds[endpoint] = _Feed(make, count, seed=seed)
+        self.feeds = feeds
+        print(f"@ fake HERE data ready: {len(feeds['flow'].fragments)} flow, "
+              f"{len(feeds['incidents'].fragments)} incidents ({time.perf_counter() - start:.1f}s) @")
+
+    def advance(self, fraction=0.05, moved=0.1):
+        for feed in self.feeds.values():
+            feed.advance(fraction, moved)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v7/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-here", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive like the real api
+
+        def do_GET(self):
+            server.requests += 1
+            url = urlparse(self.path)
+            feed = server.feeds.get(url.path.rsplit("/", 1)[-1])
+            box = parse_qs(url.query).get("in", [""])[0]
+            if feed is None or not box.startswith("bbox:"):
+                return self._send(404, b'{"error":"not found"}')
+            try:
+                box = tuple(float(v) for v in box[len("bbox:"):].split(","))
+            except ValueError:
+                return self._send(400, b'{"error":"bad bbox"}')
+            if server.latency:
+                time.sleep(server.latency)
+            if server.failures:
+                status, headers = server.failures.pop(0)
+                return self._send(status, b'{"error":"failure"}', headers)
+            if server.error_rate and random.random() < server.error_rate:
+                return self._send(503, b'{"error":"unavailable"}', {"Retry-After": "1"})
+
+            etag, body, compressed = feed.body(box)
+            headers = {"ETag": etag}
+            if etag in self.headers.get("If-None-Match", ""):
+                return self._send(304, b"", headers)
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                headers["Content-Encoding"] = "gzip"
+                body = compressed
+            self._send(200, body, headers)
+
+        def _send(self, status, body, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def record(directory, bounding_box="13.08836,52.33812,13.761,52.6755"):
+    # save live responses (needs HERE_API_KEY) for FakeHereServer(replay_dir=directory)
+    from here_client import get_client
+
+    client = get_client()
+    os.makedirs(directory, exist_ok=True)
+    for endpoint in ("flow", "incidents"):
+        params = {"in": "bbox:" + bounding_box, "locationReferencing": "shape"}
+        response, _ = client.get(endpoint, params)
+        with gzip.open(os.path.join(directory, f"{endpoint}.json.gz"), "wb") as f:
+            f.write(response.content)
+        print(f"recorded {endpoint}: {len(response.content)} bytes")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--flow", type=int, default=10000, help="synthetic flow segments")
+    parser.add_argument("--incidents", type=int, default=500, help="synthetic incidents")
+    parser.add_argument("--replay", help="directory with recorded flow / incidents responses")
+    parser.add_argument("--record", help="save live responses into this directory and exit")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--advance-every", type=float, default=0, help="seconds between new snapshots, 0 for never")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record)
+    else:
+        fake = FakeHereServer(args.flow, args.incidents, replay_dir=args.replay, port=args.port,
+                              latency=args.latency, error_rate=args.error_rate).start()
+        print(f"serving fake HERE api, run the app with HERE_BASE_URL={fake.url}")
+        while True:
+            time.sleep(args.advance_every or 3600)
+            if args.advance_every:
+                fake.advance()
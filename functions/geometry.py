@@ -0,0 +1,141 @@
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = (np.radians(v) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+# every point of every segment in two flat float arrays, plus offsets so that
+# segment i is lat[offsets[i]:offsets[i + 1]] (same idea as an arrow list column).
+# no python object per point, and all the helpers below run on whole arrays
+class SegmentGeometry:
+    def __init__(self, lat, lng, offsets):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+    @classmethod
+    def from_results(cls, results):
+        # all links of a segment are joined into one polyline
+        lat = []
+        lng = []
+        offsets = [0]
+        for result in results:
+            for link in result.get("location", {}).get("shape", {}).get("links", []):
+                for point in link.get("points", []):
+                    lat.append(point.get("lat", 0))
+                    lng.append(point.get("lng", 0))
+            offsets.append(len(lat))
+        return cls(lat, lng, offsets)
+
+    @classmethod
+    def concat(cls, geometries):
+        lat = np.concatenate([g.lat for g in geometries])
+        lng = np.concatenate([g.lng for g in geometries])
+        starts = np.cumsum([0] + [len(g.lat) for g in geometries[:-1]])
+        offsets = np.concatenate([[0]] + [g.offsets[1:] + start for g, start in zip(geometries, starts)])
+        return cls(lat, lng, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.lat.nbytes + self.lng.nbytes + self.offsets.nbytes
+
+    def segment(self, i):
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return np.column_stack([self.lat[start:end], self.lng[start:end]])
+
+    def take(self, indices):
+        # keep only these segments, in this order
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        counts = self.counts[indices]
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        point_index = np.repeat(self.offsets[:-1][indices] - offsets[:-1], counts) + np.arange(offsets[-1])
+        return SegmentGeometry(self.lat[point_index], self.lng[point_index], offsets)
+
+    def _edges(self):
+        # edge k joins point k and k + 1, edges that jump between segments get length 0
+        lengths = haversine_m(self.lat[:-1], self.lng[:-1], self.lat[1:], self.lng[1:])
+        boundaries = self.offsets[1:-1] - 1
+        lengths[boundaries[(boundaries >= 0) & (boundaries < len(lengths))]] = 0
+        return lengths
+
+    def lengths(self):
+        if len(self.lat) < 2:
+            return np.zeros(len(self))
+        segment_of_edge = np.repeat(np.arange(len(self)), self.counts)[:-1]
+        return np.bincount(segment_of_edge, weights=self._edges(), minlength=len(self))
+
+    def midpoints(self):
+        # the point half way along each polyline, 0 for a segment without points (like centroids()
+        # and the parsers' first point)
+        counts = self.counts
+        first = self.offsets[:-1]
+        has_points = counts > 0
+        mid_lat = np.zeros(len(self))
+        mid_lng = np.zeros(len(self))
+        mid_lat[has_points] = self.lat[first[has_points]]
+        mid_lng[has_points] = self.lng[first[has_points]]
+        multi = counts >= 2
+        if len(self.lat) < 2 or not multi.any():
+            return mid_lat, mid_lng
+
+        edges = self._edges()
+        travelled = np.concatenate([[0], np.cumsum(edges)])
+        start = travelled[first[multi]]
+        end = travelled[self.offsets[1:][multi] - 1]
+        target = (start + end) / 2
+        edge = np.searchsorted(travelled, target, side="right") - 1
+        edge = np.clip(edge, first[multi], self.offsets[1:][multi] - 2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            frac = np.where(edges[edge] > 0, (target - travelled[edge]) / edges[edge], 0)
+        mid_lat[multi] = self.lat[edge] + frac * (self.lat[edge + 1] - self.lat[edge])
+        mid_lng[multi] = self.lng[edge] + frac * (self.lng[edge + 1] - self.lng[edge])
+        return mid_lat, mid_lng
+
+    def centroids(self):
+        # length weighted centroid of each polyline, plain mean of the points if it has no length
+        segment_of_point = np.repeat(np.arange(len(self)), self.counts)
+        counts = np.maximum(self.counts, 1)
+        mean_lat = np.bincount(segment_of_point, weights=self.lat, minlength=len(self)) / counts
+        mean_lng = np.bincount(segment_of_point, weights=self.lng, minlength=len(self)) / counts
+        if len(self.lat) < 2:
+            return mean_lat, mean_lng
+
+        edges = self._edges()
+        segment_of_edge = segment_of_point[:-1]
+        total = np.bincount(segment_of_edge, weights=edges, minlength=len(self))
+        edge_lat = (self.lat[:-1] + self.lat[1:]) / 2
+        edge_lng = (self.lng[:-1] + self.lng[1:]) / 2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            lat = np.bincount(segment_of_edge, weights=edges * edge_lat, minlength=len(self)) / total
+            lng = np.bincount(segment_of_edge, weights=edges * edge_lng, minlength=len(self)) / total
+        has_length = total > 0
+        return np.where(has_length, lat, mean_lat), np.where(has_length, lng, mean_lng)
+
+    def downsample(self, max_points):
+        # at most max_points per segment (evenly spaced), always keeping both ends
+        counts = self.counts
+        segment_of_point = np.repeat(np.arange(len(self)), counts)
+        position = np.arange(len(self.lat)) - self.offsets[:-1][segment_of_point]
+        step = np.maximum(1, np.ceil((counts - 1) / max(max_points - 1, 1))).astype(np.int64)
+        keep = (position % step[segment_of_point] == 0) | (position == counts[segment_of_point] - 1)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(segment_of_point[keep], minlength=len(self)))])
+        return SegmentGeometry(self.lat[keep], self.lng[keep], offsets)
+
+    def polylines(self):
+        # [[lat, lng], ...] per segment, for folium.PolyLine
+        points = np.column_stack([self.lat, self.lng]).tolist()
+        return [points[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
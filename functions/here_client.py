@@ -0,0 +1,223 @@
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+import metrics
+
+load_dotenv()
+
+BASE_URL = "https://data.traffic.hereapi.com/v7/"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+SOURCE_UPDATED = re.compile(rb'"sourceUpdated"\s*:\s*"([^"]*)"')
+
+
+class HereApiError(Exception):
+    pass
+
+
+# api quota shared by every region / tile / retry: `rate` requests a second on average, up to
+# `burst` at once after a quiet spell. take() blocks until a request may go out
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        # seconds spent waiting
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+# one pooled keep-alive session for every HERE call, with timeouts, retries and
+# revalidation. parse() only runs when the payload actually changed. the last parse is kept
+# for the max_cached most recently fetched (endpoint, params), i.e. tiles
+class HereClient:
+    def __init__(self, api_key, base_url=BASE_URL, connect_timeout=5, read_timeout=30,
+                 max_retries=4, backoff=0.5, max_backoff=30, pool_size=10, rate_limit=None, burst=None,
+                 max_cached=128):
+        self.api_key = api_key
+        self.quota = TokenBucket(rate_limit, burst or rate_limit) if rate_limit else None
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+        self.calls = deque(maxlen=200)  # per call latency / bytes, newest last
+        self._validators = OrderedDict()  # (endpoint, params, parser) -> etag, last modified, sourceUpdated, parsed result
+        self.max_cached = max_cached
+        self._lock = threading.Lock()
+
+    # parse gets the decoded json, or the raw body bytes when raw=True (streaming parsers).
+    # the response's sourceUpdated goes along in the result's attrs["source_updated"], the
+    # time spent waiting for the quota and between retries in attrs["waited_seconds"]
+    def fetch(self, endpoint, params, parse, raw=False):
+        key = (endpoint, tuple(sorted(params.items())), parse)
+        with self._lock:
+            cached = self._validators.get(key)
+            if cached:
+                self._validators.move_to_end(key)
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        response, waited = self.get(endpoint, params, headers)
+        if response.status_code == 304 and cached:
+            metrics.here_reused_total.inc(endpoint=endpoint)
+            return _result(cached["parsed"], cached["source_updated"], waited)
+
+        # same sourceUpdated as last time means the same data, skip the json parse
+        match = SOURCE_UPDATED.search(response.content[:4096])
+        source_updated = match.group(1).decode() if match else None
+        if cached and source_updated and source_updated == cached["source_updated"]:
+            print(f"{endpoint} unchanged since {source_updated}, reusing last parse")
+            metrics.here_reused_total.inc(endpoint=endpoint)
+            return _result(cached["parsed"], source_updated, waited)
+
+        with metrics.parse_seconds.time(endpoint=endpoint):
+            parsed = parse(response.content) if raw else parse(response.json())
+        metrics.parse_rows.observe(len(parsed), endpoint=endpoint)
+        with self._lock:
+            self._validators[key] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "source_updated": source_updated,
+                "parsed": parsed,
+            }
+            self._validators.move_to_end(key)
+            while len(self._validators) > self.max_cached:
+                self._validators.popitem(last=False)
+        return _result(parsed, source_updated, waited)
+
+    def get(self, endpoint, params, headers=None):
+        # one request with the api key, the quota and retries, no parsing or revalidation.
+        # (response, seconds spent waiting for the quota and between retries)
+        url = self.base_url + endpoint
+        params = dict(params, apiKey=self.api_key)
+        waited = 0.0
+        for attempt in range(self.max_retries + 1):
+            if self.quota is not None:
+                quota_wait = self.quota.take()
+                metrics.here_quota_wait_seconds.observe(quota_wait, endpoint=endpoint)
+                waited += quota_wait
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(endpoint, None, start, 0, attempt)
+                if attempt == self.max_retries:
+                    reason = str(e).replace(self.api_key, "***") if self.api_key else str(e)  # key is in the url
+                    raise HereApiError(f"{endpoint} request failed after {attempt + 1} attempts: {reason}") from e
+                delay = self._delay(attempt, None)
+                time.sleep(delay)
+                waited += delay
+                continue
+
+            call = self._record(endpoint, response.status_code, start, _wire_bytes(response), attempt)
+            print(f"Fetching {endpoint} data: {response.status_code} ({call['seconds']:.2f}s, {call['bytes']} bytes)")
+            if response.status_code in (200, 304):
+                return response, waited
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                raise HereApiError(f"Failed to fetch {endpoint} data: {response.status_code} {response.text[:500]}")
+            delay = self._delay(attempt, response.headers.get("Retry-After"))
+            time.sleep(delay)
+            waited += delay
+
+    def _delay(self, attempt, retry_after):
+        # full jitter exponential backoff, never sooner than the server asked for
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        wait = _retry_after_seconds(retry_after)
+        if wait is not None:
+            delay = max(delay, min(wait, self.max_backoff))
+        return delay
+
+    def _record(self, endpoint, status, start, received, attempt):
+        call = {
+            "endpoint": endpoint,
+            "status": status,
+            "seconds": time.perf_counter() - start,
+            "bytes": received,
+            "attempt": attempt,
+        }
+        self.calls.append(call)
+        metrics.here_request_seconds.observe(call["seconds"], endpoint=endpoint, status=status or "error")
+        metrics.here_response_bytes.observe(received, endpoint=endpoint)
+        if attempt:
+            metrics.here_retries_total.inc(endpoint=endpoint)
+        return call
+
+
+def _result(parsed, source_updated, waited):
+    # a copy, so callers can add columns without touching the cached parse
+    result = parsed.copy()
+    result.attrs["source_updated"] = source_updated
+    result.attrs["waited_seconds"] = waited
+    return result
+
+
+def _wire_bytes(response):
+    # compressed bytes off the socket when urllib3 knows them, otherwise the body size
+    try:
+        return response.raw.tell() or len(response.content)
+    except Exception:
+        return len(response.content)
+
+
+def _retry_after_seconds(value):
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return int(value)
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HereClient(
+                os.getenv("HERE_API_KEY"),
+                base_url=os.getenv("HERE_BASE_URL", BASE_URL),  # e.g. a FakeHereServer
+                connect_timeout=float(os.getenv("HERE_CONNECT_TIMEOUT", 5)),
+                read_timeout=float(os.getenv("HERE_READ_TIMEOUT", 30)),
+                max_retries=int(os.getenv("HERE_MAX_RETRIES", 4)),
+                rate_limit=float(os.getenv("HERE_RATE_LIMIT", 10)),  # requests per second, 0 for no limit
+                burst=float(os.getenv("HERE_RATE_BURST", 20)),
+                max_cached=int(os.getenv("HERE_CACHED_RESPONSES", 128)),
+            )
+        return _client
@@ -0,0 +1,349 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+# every flow / incident fetch saved to disk so congestion can be looked at over time.
+#
+# history/<kind>/<bbox>/<YYYY-MM-DD>/<chunk>/<column>.npy + meta.json
+#
+# one chunk per fetch, one .npy file per column (strings as categorical codes, times as
+# int64 ns utc) so reads only touch the columns they need, memory mapped. days before
+# today get compacted into a single chunk sorted by the query key (segment_id for
+# flow, start_time for incidents), so a query over months is a few searchsorted
+# calls per day instead of a scan.
+# incidents stay in the feed for hours or days, so a fetch only saves the ones that are new or
+# changed since the last save, and compaction keeps one row (the newest) per incident per day
+
+TIME_KEYS = {"flow": "time_updated", "incidents": "start_time"}
+SORT_KEYS = {"flow": ["segment_id", "time_updated"], "incidents": ["start_time"]}
+
+
+def segment_ids(frame):
+    # stable int64 id for a road segment, the same segment gets the same id in every fetch
+    key = pd.DataFrame({
+        "description": frame["description"].astype(str),
+        "lat": frame["lat"].round(5),
+        "lng": frame["lng"].round(5),
+    })
+    return pd.util.hash_pandas_object(key, index=False).to_numpy().view(np.int64)
+
+
+def incident_ids(frame):
+    key = pd.DataFrame({
+        "description": frame["description"].astype(str),
+        "start_time": _ns(frame["start_time"]),
+        "lat": frame["lat"].round(5),
+        "lng": frame["lng"].round(5),
+    })
+    return pd.util.hash_pandas_object(key, index=False).to_numpy().view(np.int64)
+
+
+def _ns(values):
+    # anything time like (strings, categoricals, tz aware datetimes) -> int64 ns since epoch, utc
+    values = pd.Series(values)
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        values = pd.to_datetime(values.astype(str), utc=True, format="ISO8601")
+    elif values.dt.tz is None:
+        values = values.dt.tz_localize("UTC")
+    return values.dt.tz_convert(None).to_numpy().astype("datetime64[ns]").view(np.int64)
+
+
+def _timestamp_ns(t):
+    t = pd.Timestamp(t)
+    t = t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+    return t.value
+
+
+def _bbox_key(bounding_box):
+    return bounding_box.replace(",", "_")
+
+
+class HistoryStore:
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._meta = {}  # chunk path -> meta, chunks never change once written
+        # what was saved last, to skip re-saving unchanged data. read back from disk on first use,
+        # so a restart doesn't save the same fetch again
+        self._last_written = {}  # (kind, bbox) -> newest time key
+        self._last_incidents = {}  # bbox -> hashes of the incident rows saved last, to only save changes
+
+    # writing
+
+    def append_flow(self, traffic_data, bounding_box):
+        if traffic_data.empty:
+            return None
+        frame = traffic_data[["description", "length", "speed", "free_flow_speed", "jam_factor", "lat", "lng", "time_updated"]].copy()
+        frame["time_updated"] = _ns(frame["time_updated"])
+        frame["segment_id"] = segment_ids(traffic_data)
+        return self._append("flow", bounding_box, frame)
+
+    def append_incidents(self, incident_data, bounding_box):
+        if incident_data.empty:
+            return None
+        frame = incident_data[["description", "criticality", "incident_type", "start_time", "end_time", "road_closed", "lat", "lng"]].copy()
+        frame["start_time"] = _ns(frame["start_time"])
+        frame["end_time"] = _ns(frame["end_time"])
+        frame["incident_id"] = incident_ids(incident_data)
+        rows = _row_hashes(frame)
+        with self._lock:
+            if bounding_box not in self._last_incidents:
+                self._last_incidents[bounding_box] = self._saved_incidents(bounding_box)
+            changed = ~np.isin(rows, self._last_incidents[bounding_box])
+            self._last_incidents[bounding_box] = rows
+        if not changed.any():
+            return None  # same incidents as the last save
+        frame = frame[changed].reset_index(drop=True)
+        frame["fetched_at"] = np.int64(time.time_ns())
+        return self._append("incidents", bounding_box, frame)
+
+    def _append(self, kind, bounding_box, frame):
+        time_key = TIME_KEYS[kind]
+        newest = int(frame[time_key].max())
+        with self._lock:
+            if (kind, bounding_box) not in self._last_written:
+                self._last_written[(kind, bounding_box)] = self._saved_newest(kind, bounding_box)
+            if kind == "flow" and self._last_written[(kind, bounding_box)] == newest:
+                return None  # same sourceUpdated as the last save
+            self._last_written[(kind, bounding_box)] = newest
+
+            day = pd.Timestamp.now(tz="UTC").strftime("%Y-%m-%d")
+            day_dir = os.path.join(self.root, kind, _bbox_key(bounding_box), day)
+            chunk_dir = os.path.join(day_dir, f"{time.time_ns()}-{uuid.uuid4().hex[:6]}")
+            self._write_chunk(chunk_dir, frame)
+            self._compact_old_days(kind, bounding_box, day)
+            return chunk_dir
+
+    def _saved_newest(self, kind, bounding_box):
+        # newest time key of the last chunk written (meta max), None if nothing is saved yet
+        for day_dir in reversed(self._days(kind, bounding_box)):
+            chunks = self._chunks(day_dir)
+            if chunks:
+                return self.meta(chunks[-1])["max"].get(TIME_KEYS[kind])
+        return None
+
+    def _saved_incidents(self, bounding_box):
+        # row hashes of the newest saved version of every incident on the last day saved
+        for day_dir in reversed(self._days("incidents", bounding_box)):
+            chunks = self._chunks(day_dir)
+            if chunks:
+                frame = _finish([self._read_chunk(chunk) for chunk in chunks], None, "start_time")
+                frame = frame.sort_values("fetched_at", kind="stable").drop_duplicates("incident_id", keep="last")
+                frame = frame.drop(columns="fetched_at")
+                frame["start_time"] = _ns(frame["start_time"])
+                frame["end_time"] = _ns(frame["end_time"])
+                return _row_hashes(frame)
+        return np.array([], dtype=np.uint64)
+
+    def _write_chunk(self, chunk_dir, frame):
+        # written to a temp dir and renamed, so readers never see half a chunk
+        tmp_dir = chunk_dir + ".tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        meta = {"rows": len(frame), "columns": {}, "min": {}, "max": {}}
+        for column in frame.columns:
+            values = frame[column]
+            if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object or pd.api.types.is_string_dtype(values):
+                values = values.astype("category")
+                np.save(os.path.join(tmp_dir, f"{column}.npy"), values.cat.codes.to_numpy())
+                meta["columns"][column] = {"kind": "category", "categories": [str(c) for c in values.cat.categories]}
+            else:
+                array = values.to_numpy()
+                np.save(os.path.join(tmp_dir, f"{column}.npy"), array)
+                meta["columns"][column] = {"kind": "values"}
+                if array.dtype.kind in "iuf" and len(array):
+                    meta["min"][column] = array.min().item()
+                    meta["max"][column] = array.max().item()
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_dir, chunk_dir)
+
+    def _compact_old_days(self, kind, bounding_box, today):
+        bbox_dir = os.path.join(self.root, kind, _bbox_key(bounding_box))
+        for day in sorted(os.listdir(bbox_dir)):
+            if day >= today:
+                continue
+            chunks = self._chunks(os.path.join(bbox_dir, day))
+            if len(chunks) == 1 and chunks[0].endswith("compacted"):
+                continue
+            self.compact(kind, bounding_box, day)
+
+    def compact(self, kind, bounding_box, day):
+        # merge a day's chunks into one, sorted by the query key
+        day_dir = os.path.join(self.root, kind, _bbox_key(bounding_box), day)
+        chunks = self._chunks(day_dir)
+        if not chunks:
+            return
+        frame = pd.concat([self._read_chunk(chunk) for chunk in chunks], ignore_index=True)
+        for column in frame.columns:
+            if isinstance(frame[column].dtype, pd.CategoricalDtype):
+                continue
+            if frame[column].dtype == object:
+                frame[column] = frame[column].astype("category")
+        if kind == "incidents":
+            # one row per incident, its newest version
+            frame = frame.sort_values("fetched_at", kind="stable").drop_duplicates("incident_id", keep="last")
+        frame = frame.sort_values(SORT_KEYS[kind], kind="stable", ignore_index=True)
+        self._write_chunk(os.path.join(day_dir, "compacted.new"), frame)
+        for chunk in chunks:
+            shutil.rmtree(chunk)
+            self._meta.pop(chunk, None)
+        os.replace(os.path.join(day_dir, "compacted.new"), os.path.join(day_dir, "compacted"))
+
+    # reading
+
+    def _chunks(self, day_dir):
+        if not os.path.isdir(day_dir):
+            return []
+        return [os.path.join(day_dir, name) for name in sorted(os.listdir(day_dir))
+                if not name.endswith(".tmp") and not name.endswith(".new")]
+
+    def _days(self, kind, bounding_box, first_day=None, last_day=None):
+        bbox_dir = os.path.join(self.root, kind, _bbox_key(bounding_box))
+        if not os.path.isdir(bbox_dir):
+            return []
+        return [os.path.join(bbox_dir, day) for day in sorted(os.listdir(bbox_dir))
+                if (first_day is None or day >= first_day) and (last_day is None or day <= last_day)]
+
+    def meta(self, chunk):
+        if chunk not in self._meta:
+            with open(os.path.join(chunk, "meta.json")) as f:
+                self._meta[chunk] = json.load(f)
+        return self._meta[chunk]
+
+    def column(self, chunk, column, rows=slice(None)):
+        # memory mapped, only the asked for rows are actually read from disk
+        values = np.load(os.path.join(chunk, f"{column}.npy"), mmap_mode="r")[rows]
+        info = self.meta(chunk)["columns"][column]
+        if info["kind"] == "category":
+            return pd.Categorical.from_codes(np.asarray(values), categories=info["categories"])
+        return np.asarray(values)
+
+    def _read_chunk(self, chunk, columns=None, rows=slice(None)):
+        meta = self.meta(chunk)
+        columns = columns or list(meta["columns"])
+        return pd.DataFrame({column: self.column(chunk, column, rows) for column in columns})
+
+    def read(self, kind, bounding_box, t0=None, t1=None, columns=None):
+        # every row whose time key is in [t0, t1], pruned by day and by each chunk's min/max
+        time_key = TIME_KEYS[kind]
+        lo = _timestamp_ns(t0) if t0 is not None else None
+        hi = _timestamp_ns(t1) if t1 is not None else None
+        first_day = pd.Timestamp(lo, tz="UTC").strftime("%Y-%m-%d") if lo is not None and kind == "flow" else None
+        frames = []
+        for day_dir in self._days(kind, bounding_box, first_day):
+            for chunk in self._chunks(day_dir):
+                meta = self.meta(chunk)
+                if lo is not None and meta["max"].get(time_key, lo) < lo:
+                    continue
+                if hi is not None and meta["min"].get(time_key, hi) > hi:
+                    continue
+                times = self.column(chunk, time_key)
+                mask = np.ones(len(times), dtype=bool)
+                if lo is not None:
+                    mask &= times >= lo
+                if hi is not None:
+                    mask &= times <= hi
+                if mask.any():
+                    frames.append(self._read_chunk(chunk, columns, np.flatnonzero(mask)))
+        return _finish(frames, columns, time_key)
+
+    def jam_factor(self, bounding_box, segments, t0, t1):
+        # jam_factor over time for these segment ids (see segment_ids()), one row per segment per fetch
+        lo, hi = _timestamp_ns(t0), _timestamp_ns(t1)
+        wanted = np.unique(np.asarray(segments, dtype=np.int64))
+        first_day = pd.Timestamp(lo, tz="UTC").strftime("%Y-%m-%d")
+        # saved on the day it was fetched, which can be just after the day it was updated
+        last_day = (pd.Timestamp(hi, tz="UTC") + pd.Timedelta(days=1)).strftime("%Y-%m-%d")
+        columns = ["segment_id", "time_updated", "jam_factor"]
+        frames = []
+        for day_dir in self._days("flow", bounding_box, first_day, last_day):
+            for chunk in self._chunks(day_dir):
+                meta = self.meta(chunk)
+                if meta["max"].get("time_updated", lo) < lo or meta["min"].get("time_updated", hi) > hi:
+                    continue
+                ids = np.load(os.path.join(chunk, "segment_id.npy"), mmap_mode="r")
+                if chunk.endswith("compacted"):
+                    # sorted by segment id, so each wanted segment is one contiguous slice
+                    starts = np.searchsorted(ids, wanted, side="left")
+                    ends = np.searchsorted(ids, wanted, side="right")
+                    rows = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends) if e > s] or [np.array([], dtype=np.int64)])
+                else:
+                    rows = np.flatnonzero(np.isin(ids, wanted))
+                if len(rows) == 0:
+                    continue
+                frame = self._read_chunk(chunk, columns, rows)
+                frames.append(frame[(frame["time_updated"] >= lo) & (frame["time_updated"] <= hi)])
+        return _finish(frames, columns, "time_updated").sort_values(["segment_id", "time_updated"], ignore_index=True)
+
+    def incidents_active_at(self, bounding_box, t):
+        # incidents with start_time <= t <= end_time, each incident once (latest fetch wins)
+        at = _timestamp_ns(t)
+        frames = []
+        for day_dir in self._days("incidents", bounding_box):
+            for chunk in self._chunks(day_dir):
+                meta = self.meta(chunk)
+                if meta["min"].get("start_time", at) > at or meta["max"].get("end_time", at) < at:
+                    continue
+                if chunk.endswith("compacted"):
+                    # sorted by start_time, only the prefix can have started by t
+                    starts = np.load(os.path.join(chunk, "start_time.npy"), mmap_mode="r")
+                    candidates = np.arange(np.searchsorted(starts, at, side="right"))
+                else:
+                    candidates = np.flatnonzero(self.column(chunk, "start_time") <= at)
+                if len(candidates) == 0:
+                    continue
+                ends = np.load(os.path.join(chunk, "end_time.npy"), mmap_mode="r")[candidates]
+                rows = candidates[np.asarray(ends) >= at]
+                if len(rows):
+                    frames.append(self._read_chunk(chunk, None, rows))
+        active = _finish(frames, None, "start_time")
+        if active.empty:
+            return active
+        active = active.sort_values("fetched_at").drop_duplicates("incident_id", keep="last")
+        return active.sort_values("start_time", ignore_index=True)
+
+
+def _row_hashes(frame):
+    # one hash per incident row, the same for a row read back from disk (strings come back as
+    # categoricals, which hash like their values)
+    frame = frame[["description", "criticality", "incident_type", "start_time", "end_time", "road_closed", "lat", "lng", "incident_id"]]
+    return pd.util.hash_pandas_object(frame.astype({column: str for column in ("description", "criticality", "incident_type")}),
+                                      index=False).to_numpy()
+
+
+def _finish(frames, columns, time_key):
+    if not frames:
+        return pd.DataFrame(columns=columns or [])
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            merged = union_categoricals([frame[column] for frame in frames])
+            lengths = np.cumsum([0] + [len(frame) for frame in frames])
+            for frame, start, end in zip(frames, lengths[:-1], lengths[1:]):
+                frame[column] = merged[start:end]
+    frame = pd.concat(frames, ignore_index=True)
+    for column in ("time_updated", "start_time", "end_time", "fetched_at"):
+        if column in frame:
+            frame[column] = pd.to_datetime(frame[column], unit="ns", utc=True)
+    return frame
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_history_store():
+    # HISTORY_DIR="" turns saving off
+    global _store
+    root = os.getenv("HISTORY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "history"))
+    if not root:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = HistoryStore(os.path.abspath(root))
+        return _store
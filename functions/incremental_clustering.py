@@ -0,0 +1,243 @@
+import time
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.neighbors import BallTree, NearestNeighbors
+from sklearn.preprocessing import MinMaxScaler
+from geometry import EARTH_RADIUS_M
+
+
+# keeps the kmeans / dbscan models between refreshes instead of starting over:
+# - kmeans is a MiniBatchKMeans nudged towards each new snapshot with partial_fit,
+#   so cluster 2 stays cluster 2 (and keeps its color)
+# - dbscan keeps its neighbour graph, and only the points within eps of a point that came,
+#   went or moved are looked up again. the clusters are then the connected core points of
+#   the whole graph, which is cheap next to the neighbour search. the result is the
+#   clustering a full dbscan gives, up to which cluster a border point next to two clusters
+#   goes to
+# every refit_every updates (or when most of the map changed) it does a full refit,
+# and new ids are matched to the old ones so identities still carry over.
+# with haversine=True dbscan_columns are lat, lng and eps is in meters
+class IncrementalClusterer:
+    def __init__(self, kmeans_columns, dbscan_columns, n_clusters=3, eps=0.01, min_samples=5,
+                 scale_columns=None, refit_every=12, random_state=0, haversine=False):
+        self.kmeans_columns = kmeans_columns
+        self.dbscan_columns = dbscan_columns
+        self.n_clusters = n_clusters
+        self.eps = eps
+        self.min_samples = min_samples
+        self.scale_columns = scale_columns
+        self.refit_every = refit_every
+        self.random_state = random_state
+        self.haversine = haversine
+        self.kmeans = None
+        self.scaler = None
+        self.updates = 0
+        self.full_seconds_per_row = None
+        self.last_stats = {}
+        # dbscan state from the last snapshot
+        self._ids = None  # point ids (see _point_ids), sorted
+        self._features = None  # in the same order as _ids
+        self._labels = None  # same order
+        self._graph = None  # neighbour graph, rows and columns in the same order
+        self._next_label = 0
+
+    def update(self, data, keys):
+        # adds kmeans_cluster / dbscan_cluster columns to data (and scales scale_columns in place)
+        start = time.perf_counter()
+        keys = np.asarray(keys, dtype=np.int64)
+        full = self.kmeans is None or self.updates % self.refit_every == 0 or len(data) < self.n_clusters * 2
+
+        if self.scale_columns:
+            if full or self.scaler is None:
+                self.scaler = MinMaxScaler().fit(data[self.scale_columns])
+            data[self.scale_columns] = self.scaler.transform(data[self.scale_columns])
+
+        kmeans_features = data[self.kmeans_columns].to_numpy(dtype=float)
+        dbscan_features = data[self.dbscan_columns].to_numpy(dtype=float)
+        if full:
+            data['kmeans_cluster'] = self._refit_kmeans(kmeans_features)
+            labels, rerun = self._refit_dbscan(dbscan_features, keys), len(data)
+        else:
+            self.kmeans.partial_fit(kmeans_features)
+            data['kmeans_cluster'] = self.kmeans.predict(kmeans_features)
+            labels, rerun = self._update_dbscan(dbscan_features, keys)
+        data['dbscan_cluster'] = labels
+        self.updates += 1
+
+        seconds = time.perf_counter() - start
+        if full:
+            self.full_seconds_per_row = seconds / max(len(data), 1)
+        estimate = (self.full_seconds_per_row or 0) * len(data)
+        # most of the map changed and dbscan ran on everything, nothing was saved
+        dbscan_full = full or rerun >= len(data)
+        self.last_stats = {
+            "full_refit": full,
+            "rows": len(data),
+            "dbscan_rows_rerun": rerun,
+            "seconds": seconds,
+            "estimated_full_seconds": estimate,
+            "saved_seconds": 0 if dbscan_full else max(0, estimate - seconds),
+        }
+        if full:
+            print(f"full clustering refit: {seconds:.2f}s")
+        elif dbscan_full:
+            print(f"incremental clustering: {seconds:.2f}s, dbscan re-run on all {len(data)} points (most of the map changed)")
+        else:
+            print(f"incremental clustering: {seconds:.2f}s, dbscan re-run on {rerun}/{len(data)} points, "
+                  f"~{self.last_stats['saved_seconds']:.2f}s saved vs a full refit")
+        return data
+
+    def _refit_kmeans(self, features):
+        previous = self.kmeans.cluster_centers_ if self.kmeans is not None else None
+        self.kmeans = MiniBatchKMeans(n_clusters=self.n_clusters, random_state=self.random_state,
+                                      n_init=3, batch_size=2048).fit(features)
+        labels = self.kmeans.labels_
+        if previous is not None and previous.shape == self.kmeans.cluster_centers_.shape:
+            # new center j takes the id of the old center it is closest to
+            distance = np.linalg.norm(self.kmeans.cluster_centers_[:, None, :] - previous[None, :, :], axis=2)
+            new, old = linear_sum_assignment(distance)
+            order = np.empty(self.n_clusters, dtype=int)
+            order[old] = new
+            self.kmeans.cluster_centers_ = self.kmeans.cluster_centers_[order]
+            relabel = np.empty(self.n_clusters, dtype=int)
+            relabel[new] = old
+            labels = relabel[labels]
+        return labels
+
+    # dbscan
+
+    def _index(self, features):
+        # neighbour search over these points, None if there are none
+        if len(features) == 0:
+            return None
+        if self.haversine:
+            return BallTree(np.radians(features[:, :2]), metric="haversine")
+        return NearestNeighbors(radius=self.eps).fit(features)
+
+    def _neighbour_rows(self, index, size, queries):
+        # csr, row i has every indexed point within eps of queries[i] (a point itself included,
+        # like dbscan counts it)
+        if index is None or len(queries) == 0:
+            return csr_matrix((len(queries), size), dtype=bool)
+        if self.haversine:
+            indices = index.query_radius(np.radians(queries[:, :2]), r=self.eps / EARTH_RADIUS_M)
+            counts = np.fromiter((len(i) for i in indices), dtype=np.int64, count=len(indices))
+            return csr_matrix((np.ones(counts.sum(), dtype=bool), np.concatenate(indices), np.r_[0, np.cumsum(counts)]),
+                              shape=(len(queries), size))
+        return index.radius_neighbors_graph(queries, mode="connectivity").astype(bool)
+
+    def _point_ids(self, features, keys):
+        # key + features, so a point that moved counts as a new one, and the nth copy of a
+        # repeated point is its own point
+        frame = pd.DataFrame(features)
+        frame["key"] = keys
+        hashes = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+        occurrence = pd.Series(hashes).groupby(hashes).cumcount().to_numpy()
+        return pd.util.hash_pandas_object(pd.DataFrame({"hash": hashes, "occurrence": occurrence}), index=False).to_numpy()
+
+    def _remember(self, ids, features, labels, graph):
+        # kept sorted by id, the graph rows and columns too
+        order = np.argsort(ids)
+        position = np.empty(len(ids), dtype=np.int64)
+        position[order] = np.arange(len(ids))
+        graph = graph[order]
+        graph = csr_matrix((graph.data, position[graph.indices], graph.indptr), shape=graph.shape)
+        self._ids = ids[order]
+        self._features = features[order]
+        self._labels = labels[order]
+        self._graph = graph
+        self._next_label = max(self._next_label, int(labels.max()) + 1 if len(labels) else 0)
+
+    def _old_state(self, ids):
+        # (label each point had last time or -2 if it is new, its row in the old state or -1)
+        if self._ids is None or len(self._ids) == 0:
+            return np.full(len(ids), -2), np.full(len(ids), -1)
+        position = np.clip(np.searchsorted(self._ids, ids), 0, len(self._ids) - 1)
+        found = self._ids[position] == ids
+        return np.where(found, self._labels[position], -2), np.where(found, position, -1)
+
+    def _refit_dbscan(self, features, keys, index=None):
+        ids = self._point_ids(features, keys)
+        index = index or self._index(features)
+        graph = self._neighbour_rows(index, len(features), features)
+        labels = self._labels_from_graph(graph, self._old_state(ids)[0])
+        self._remember(ids, features, labels, graph)
+        return labels
+
+    def _labels_from_graph(self, graph, old_labels):
+        # dbscan off the neighbour graph: clusters are the connected core points, a border point
+        # goes with a core neighbour, its old cluster if that is one of them
+        degree = np.diff(graph.indptr)
+        core = degree >= self.min_samples
+        rows = np.repeat(np.arange(len(degree)), degree)
+        cols = graph.indices
+        links = core[rows] & core[cols]
+        _, component = connected_components(
+            csr_matrix((np.ones(links.sum(), dtype=bool), (rows[links], cols[links])), shape=graph.shape), directed=False
+        )
+        labels = np.full(len(degree), -1)
+        labels[core] = self._match_labels(component[core], old_labels[core])
+        edges = np.flatnonzero(core[cols] & ~core[rows])
+        if len(edges):
+            candidates = labels[cols[edges]]
+            same = candidates == old_labels[rows[edges]]
+            order = np.lexsort((~same, rows[edges]))
+            border_rows, first = np.unique(rows[edges][order], return_index=True)
+            labels[border_rows] = candidates[order][first]
+        return labels
+
+    def _match_labels(self, clusters, old_labels):
+        # each new cluster takes the old id most of its points had, or a fresh id
+        votes = pd.DataFrame({"cluster": clusters, "old": old_labels})
+        votes = votes[votes["old"] >= 0].value_counts().reset_index(name="count")
+        votes = votes.sort_values(["cluster", "count", "old"], ascending=[True, False, True], kind="stable")
+        identity = {}
+        taken = set()
+        for cluster, old in zip(votes["cluster"].tolist(), votes["old"].tolist()):
+            if cluster not in identity and old not in taken:
+                identity[cluster] = old
+                taken.add(old)
+        unique, inverse = np.unique(clusters, return_inverse=True)
+        for cluster in unique.tolist():
+            if cluster not in identity:
+                identity[cluster] = self._next_label
+                self._next_label += 1
+        return np.array([identity[cluster] for cluster in unique.tolist()], dtype=np.int64)[inverse]
+
+    def _update_dbscan(self, features, keys):
+        ids = self._point_ids(features, keys)
+        old_labels, position = self._old_state(ids)
+        gone = np.ones(len(self._ids), dtype=bool)
+        gone[position[position >= 0]] = False
+        # where points came, went or moved (a moved point is both)
+        changed = np.concatenate([features[position < 0], self._features[gone]])
+        if len(changed) == 0:
+            return old_labels, 0
+
+        # only the points within eps of a change can have different neighbours, they are looked
+        # up again. everyone else keeps their neighbours from last time, then the clusters are
+        # redone over the whole graph
+        index = self._index(features)
+        zone_rows = np.unique(self._neighbour_rows(index, len(features), changed).indices)
+        if len(zone_rows) > len(keys) / 2:
+            return self._refit_dbscan(features, keys, index), len(keys)
+        found = self._neighbour_rows(index, len(features), features[zone_rows]).tocoo()
+
+        zone = np.zeros(len(keys), dtype=bool)
+        zone[zone_rows] = True
+        clean = np.flatnonzero(~zone)
+        new_row = np.full(len(self._ids), -1)
+        new_row[position[position >= 0]] = np.flatnonzero(position >= 0)
+        kept = self._graph[position[clean]]
+        kept_cols = new_row[kept.indices]
+        rows = np.concatenate([np.repeat(clean, np.diff(kept.indptr)), zone_rows[found.row]])
+        cols = np.concatenate([kept_cols, found.col])
+        graph = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(keys), len(keys)))
+
+        labels = self._labels_from_graph(graph, old_labels)
+        self._remember(ids, features, labels, graph)
+        return labels, len(zone_rows)
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+# "which incidents are active at time t" without scanning every row: a centered interval
+# tree over (start, end). each node keeps the intervals that contain its center, sorted by
+# start and by end, everything entirely left / right of the center goes to a child. a query
+# walks one path down (log n nodes) and at each node takes a prefix of one sorted list,
+# so it costs O(log n + k) for k matches. times are epoch seconds, a missing start or end
+# counts as open ended
+
+EPOCH = pd.Timestamp(0, tz="UTC")
+
+
+def epoch_seconds(times):
+    # datetime column (or anything to_datetime takes) -> float seconds, NaN for missing
+    times = pd.to_datetime(pd.Series(times), utc=True)
+    return ((times - EPOCH) / pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+
+
+class IntervalIndex:
+    def __init__(self, start, end):
+        start = epoch_seconds(start)
+        end = epoch_seconds(end)
+        self.start = np.where(np.isnan(start), -np.inf, start)
+        self.end = np.where(np.isnan(end), np.inf, end)
+        self.end = np.maximum(self.end, self.start)  # an end before the start is a point in time
+        # per node: center, children, its rows sorted by start / by end and the sorted keys
+        self._center, self._left, self._right = [], [], []
+        self._by_start, self._by_end, self._starts, self._ends = [], [], [], []
+        self._root = self._build(np.arange(len(self.start)))
+
+    def __len__(self):
+        return len(self.start)
+
+    def _build(self, rows):
+        if len(rows) == 0:
+            return -1
+        endpoints = np.concatenate([self.start[rows], self.end[rows]])
+        endpoints = endpoints[np.isfinite(endpoints)]
+        center = float(np.median(endpoints)) if len(endpoints) else 0.0
+        left = rows[self.end[rows] < center]
+        right = rows[self.start[rows] > center]
+        here = rows[(self.end[rows] >= center) & (self.start[rows] <= center)]
+
+        node = len(self._center)
+        self._center.append(center)
+        by_start = here[np.argsort(self.start[here], kind="stable")]
+        by_end = here[np.argsort(-self.end[here], kind="stable")]  # latest end first
+        self._by_start.append(by_start)
+        self._by_end.append(by_end)
+        self._starts.append(self.start[by_start])
+        self._ends.append(-self.end[by_end])  # negated so it is ascending too
+        self._left.append(-1)
+        self._right.append(-1)
+        self._left[node] = self._build(left)
+        self._right[node] = self._build(right)
+        return node
+
+    def active_at(self, t):
+        # row numbers of the intervals with start <= t <= end, in no particular order
+        found = []
+        node = self._root
+        while node != -1:
+            center = self._center[node]
+            if t < center:
+                found.append(self._by_start[node][:np.searchsorted(self._starts[node], t, side="right")])
+                node = self._left[node]
+            elif t > center:
+                found.append(self._by_end[node][:np.searchsorted(self._ends[node], -t, side="right")])
+                node = self._right[node]
+            else:
+                found.append(self._by_start[node])
+                break
+        return np.concatenate(found) if found else np.array([], dtype=np.int64)
+
+    def active_mask(self, t):
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self.active_at(t)] = True
+        return mask
@@ -0,0 +1,141 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import time
+
+import metrics
+
+try:
+    import brotli  # optional, pip install brotli
+except ImportError:
+    brotli = None
+
+
+# one rendered map document, compressed once up front so serving it is just a lookup.
+# the digest of the html is its name, so the same map always has the same url
+class RenderedMap:
+    def __init__(self, html):
+        body = html.encode("utf-8")
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.encodings = {"identity": body, "gzip": gzip.compress(body, compresslevel=6)}
+        if brotli is not None:
+            self.encodings["br"] = brotli.compress(body, quality=5)
+        self.size = sum(len(b) for b in self.encodings.values())
+
+    @property
+    def url(self):
+        return f"/maps/{self.digest}.html"
+
+
+# rendered maps, rendered the first time someone asks for them and kept in a
+# least recently used cache capped by total bytes. keys look like
+# (page, view, show_gray, snapshot version) so a new snapshot never reuses old maps
+class MapCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0  # requests that waited on someone else's render
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._by_digest = {}  # digest -> [rendered map, number of keys using it]
+        self._pinned = {}  # small fixed pages (loading, no data) that are never evicted
+        self._oversize = {}  # key without its version -> (key, rendered map) too big for the cache
+        self._rendering = {}
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render):
+        owner = False
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            oversize = self._oversize.get(key[:-1])
+            if oversize is not None and oversize[0] == key:
+                self.hits += 1
+                return oversize[1]
+            future = self._rendering.get(key)
+            if future is not None:
+                self.shared += 1
+            else:
+                self.misses += 1
+                future = Future()
+                self._rendering[key] = future
+                owner = True
+        if not owner:
+            return future.result()
+
+        try:
+            start = time.perf_counter()
+            rendered = RenderedMap(render())
+            page, view = key[0], key[1]
+            metrics.render_seconds.observe(time.perf_counter() - start, page=page, view=view)
+            metrics.render_html_bytes.observe(len(rendered.encodings["identity"]), page=page, view=view)
+        except Exception as e:
+            with self._lock:
+                del self._rendering[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._rendering[key]
+            self._store(key, rendered)
+        future.set_result(rendered)
+        return rendered
+
+    def pin(self, html):
+        rendered = RenderedMap(html)
+        with self._lock:
+            self._pinned.setdefault(rendered.digest, rendered)
+        return rendered
+
+    def lookup(self, digest):
+        with self._lock:
+            if digest in self._pinned:
+                return self._pinned[digest]
+            entry = self._by_digest.get(digest)
+            if entry:
+                return entry[0]
+            for _, rendered in self._oversize.values():
+                if rendered.digest == digest:
+                    return rendered
+            return None
+
+    def _store(self, key, rendered):
+        if rendered.size > self.max_bytes:
+            # bigger than the whole cache: kept outside it so its url works, one per page / view
+            # until the next snapshot version of that view replaces it
+            self._oversize[key[:-1]] = (key, rendered)
+            return
+        self._entries[key] = rendered
+        self.bytes += rendered.size
+        self._by_digest.setdefault(rendered.digest, [rendered, 0])[1] += 1
+        while self.bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+            entry = self._by_digest[evicted.digest]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._by_digest[evicted.digest]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared": self.shared,
+                "evictions": self.evictions,
+                "oversize": len(self._oversize),
+            }
+
+
+# one cache for every page in the process
+map_cache = MapCache(int(os.getenv("MAP_CACHE_MB", 256)) * 1024 * 1024)
@@ -0,0 +1,269 @@
+import json
+import re
+import numpy as np
+import pandas as pd
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from folium.plugins import HeatMap
+from jinja2 import Template
+
+
+def encode_points(lat, lng, colors, popups=None, radius=None):
+    # the points as columns (lat, lng, color index, popup) for a canvas layer in the browser.
+    # colors become small ints into a palette so each point costs a digit, not a color name
+    codes, palette = pd.factorize(pd.Series(colors).astype(str))
+    payload = {
+        "lat": np.round(np.asarray(lat, dtype=float), 6).tolist(),
+        "lng": np.round(np.asarray(lng, dtype=float), 6).tolist(),
+        "color": codes.tolist(),
+        "palette": palette.tolist(),
+    }
+    if popups is not None:
+        payload["popup"] = pd.Series(popups).astype(str).tolist()
+    if radius is not None:
+        payload["radius"] = np.asarray(radius, dtype=float).tolist()
+    # keep "</script>" in a popup from closing the page's script tag
+    return json.dumps(payload, separators=(",", ":")).replace("</", "<\\/")
+
+
+# asks the server for the data in view after every pan / zoom and hands it to draw(data).
+# only the newest view is drawn, older requests are cancelled. the map page's own query
+# string goes along, so the same cached page can show filtered data (maps/<digest>.html?hours=-3)
+_VIEWPORT_LOADER = """
+                var latest = 0, pending = null;
+                var filters = window.location.search ? "&" + window.location.search.slice(1) : "";
+                function load() {
+                    var bounds = map.getBounds(), request = ++latest;
+                    if (pending) { pending.abort(); }
+                    pending = new AbortController();
+                    var query = "?west=" + bounds.getWest() + "&south=" + bounds.getSouth() +
+                        "&east=" + bounds.getEast() + "&north=" + bounds.getNorth() + "&zoom=" + map.getZoom() + filters;
+                    fetch({{ this.url|tojson }} + query, {signal: pending.signal})
+                        .then(function(response) { return response.ok ? response.json() : null; })
+                        .then(function(data) { if (data && request === latest) { draw(data); } })
+                        .catch(function() {});
+                }
+                map.on("moveend", load);
+                load();
+"""
+
+
+# one canvas layer for the points the server sends for whatever part of the map is in
+# view (see viewport.py), fetched again after every pan / zoom. zoomed out the
+# server sends bins instead of points, with a radius per marker
+class ViewportPointLayer(MacroElement):
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.featureGroup().addTo({{ this._parent.get_name() }});
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var group = {{ this.get_name() }};
+                var renderer = L.canvas({padding: 0.5});
+                function draw(data) {
+                    group.clearLayers();
+                    for (var i = 0; i < data.lat.length; i++) {
+                        var marker = L.circleMarker([data.lat[i], data.lng[i]], {
+                            radius: data.radius ? data.radius[i] : {{ this.radius }},
+                            color: data.palette[data.color[i]],
+                            fill: true,
+                            fillOpacity: {{ this.fill_opacity }},
+                            renderer: renderer
+                        });
+                        if (data.popup) {
+                            marker.bindPopup(data.popup[i], {maxWidth: 400, minWidth: 200});
+                        }
+                        marker.addTo(group);
+                    }
+                }
+""" + _VIEWPORT_LOADER + """
+            })();
+        {% endmacro %}
+        """
+    )
+
+    def __init__(self, url, radius=5, fill_opacity=0.7):
+        super().__init__()
+        self._name = "ViewportPointLayer"
+        self.url = url
+        self.radius = radius
+        self.fill_opacity = fill_opacity
+
+
+# heatmap from the server's intensity grid (see viewport.HeatSource): per pan / zoom it gets
+# one weighted point per grid cell in view instead of every segment in the bbox
+class ViewportHeatLayer(JSCSSMixin, MacroElement):
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.heatLayer([], {{ this.options|tojson }}).addTo({{ this._parent.get_name() }});
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var heat = {{ this.get_name() }};
+                function draw(data) {
+                    var points = new Array(data.lat.length);
+                    for (var i = 0; i < data.lat.length; i++) {
+                        points[i] = [data.lat[i], data.lng[i], data.weight[i]];
+                    }
+                    heat.setLatLngs(points);
+                }
+""" + _VIEWPORT_LOADER + """
+            })();
+        {% endmacro %}
+        """
+    )
+
+    default_js = HeatMap.default_js
+
+    def __init__(self, url, min_opacity=0.5, radius=15, blur=10):
+        super().__init__()
+        self._name = "ViewportHeatLayer"
+        self.url = url
+        self.options = {"minOpacity": min_opacity, "radius": radius, "blur": blur}
+
+
+# the map for a page that keeps its points in the browser (client_store.py): the page's
+# clientside callback (assets/client_maps.js) leaves the decoded columns and the selected view
+# in the parent window and this layer draws them, as dots or a heatmap, again on every change.
+# the page itself has no data in it, so it is the same document for every snapshot
+class ClientPointLayer(JSCSSMixin, MacroElement):
+    _template = Template(
+        """
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.featureGroup().addTo({{ this._parent.get_name() }});
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var group = {{ this.get_name() }};
+                var heat = L.heatLayer([], {{ this.heat_options|tojson }}).addTo(map);
+                var renderer = L.canvas({padding: 0.5});
+
+                // a NaN comes back from the page's dcc.Store as null
+                function missing(value) {
+                    return value === null || (typeof value === "number" && isNaN(value));
+                }
+
+                function popup(columns, fields, row) {
+                    return fields.map(function(field) {
+                        var value = columns[field[1]][row];
+                        var text = missing(value) ? "-" : String(value);
+                        return "<b>" + field[0] + ":</b> " + text + field[2];
+                    }).join("<br>");
+                }
+
+                // with a time filter only the rows active at state.activeAt, like intervals.IntervalIndex:
+                // a missing start or end is open ended, an end before the start is a point in time
+                function activeAt(columns, view, at) {
+                    if (at === null || at === undefined || !view.time) { return null; }
+                    var start = columns[view.time[0]], end = columns[view.time[1]];
+                    return function(row) {
+                        var from = missing(start[row]) ? -Infinity : start[row];
+                        var to = missing(end[row]) ? Infinity : Math.max(end[row], from);
+                        return from <= at && at <= to;
+                    };
+                }
+
+                function draw(state) {
+                    var columns = state.points.columns, view = state.view;
+                    var lat = columns.lat, lng = columns.lng;
+                    var noise = view.noise ? columns[view.noise] : null;
+                    var palette = view.palette ? state.points.palettes[view.palette] : {};
+                    var active = activeAt(columns, view, state.activeAt);
+                    group.clearLayers();
+                    heat.setLatLngs([]);
+                    if (view.kind === "heat") {
+                        var points = [];
+                        for (var i = 0; i < lat.length; i++) {
+                            if (noise && !state.showNoise && noise[i] === -1) { continue; }
+                            if (active && !active(i)) { continue; }
+                            var weight = columns[view.weight][i];
+                            points.push([lat[i], lng[i], weight > 0 ? weight : 0]);
+                        }
+                        heat.setLatLngs(points);
+                        return;
+                    }
+                    for (var j = 0; j < lat.length; j++) {
+                        if (noise && !state.showNoise && noise[j] === -1) { continue; }
+                        if (active && !active(j)) { continue; }
+                        var color = noise && noise[j] === -1 ? "gray" : (view.color && palette[columns[view.color][j]]) || "blue";
+                        var marker = L.circleMarker([lat[j], lng[j]], {
+                            radius: {{ this.radius }},
+                            color: color,
+                            fill: true,
+                            fillOpacity: {{ this.fill_opacity }},
+                            renderer: renderer
+                        });
+                        if (view.popup) {
+                            marker.bindPopup(popup.bind(null, columns, view.popup, j), {maxWidth: 400, minWidth: 200});
+                        }
+                        group.addLayer(marker);
+                    }
+                }
+
+                try {
+                    var maps = window.parent.trafficMaps = window.parent.trafficMaps || {};
+                    var slot = maps[{{ this.page|tojson }}] = maps[{{ this.page|tojson }}] || {};
+                    slot.draw = draw;
+                    if (slot.state) { draw(slot.state); }
+                } catch (e) {}  // opened on its own, there is nothing to draw
+            })();
+        {% endmacro %}
+        """
+    )
+
+    default_js = HeatMap.default_js
+
+    def __init__(self, page, radius=5, fill_opacity=0.7, min_opacity=0.5, heat_radius=15, blur=10):
+        super().__init__()
+        self._name = "ClientPointLayer"
+        self.page = page
+        self.radius = radius
+        self.fill_opacity = fill_opacity
+        self.heat_options = {"minOpacity": min_opacity, "radius": heat_radius, "blur": blur}
+
+
+def build_popups(data, fields):
+    # fields is a list of (label, column, suffix), built column-wise instead of per row.
+    # column can also be an already formatted series
+    parts = []
+    for label, column, suffix in fields:
+        values = data[column] if isinstance(column, str) else column
+        parts.append(f"<b>{label}:</b> " + values.astype(str) + suffix)
+    popup = parts[0]
+    for part in parts[1:]:
+        popup = popup + "<br>" + part
+    return popup
+
+
+def jam_colors(mean_jam):
+    # green / orange / red by (average) jam factor, gray where there is none. also colors
+    # the zoomed out bins by their mean
+    mean_jam = np.asarray(mean_jam, dtype=float)
+    colors = np.select([mean_jam < 4, mean_jam < 8], ['green', 'orange'], 'red')
+    return np.where(np.isnan(mean_jam), 'gray', colors)
+
+
+def add_viewport_layer(m, url, radius=5, fill_opacity=0.7):
+    # url is relative to the map page (/maps/<digest>.html), e.g. "points/flow/dot.json"
+    ViewportPointLayer(url, radius=radius, fill_opacity=fill_opacity).add_to(m)
+    return m
+
+
+def add_viewport_heatmap(m, url, min_opacity=0.5, radius=15, blur=10):
+    ViewportHeatLayer(url, min_opacity=min_opacity, radius=radius, blur=blur).add_to(m)
+    return m
+
+
+def add_client_layer(m, page, radius=5, fill_opacity=0.7):
+    ClientPointLayer(page, radius=radius, fill_opacity=fill_opacity).add_to(m)
+    return m
+
+
+FOLIUM_ID = re.compile(r"(?<=_)[0-9a-f]{32}\b")
+
+
+def stable_ids(html):
+    # folium names every element with a random id, so the same map renders to different html
+    # (and a different url) in every worker process. numbering them in order of appearance
+    # makes a map that is not built from snapshot data identical everywhere
+    ids = {}
+    return FOLIUM_ID.sub(lambda match: ids.setdefault(match.group(0), f"{len(ids):032x}"), html)
@@ -0,0 +1,57 @@
+import gzip
+import time
+from flask import Response, abort, request
+
+import metrics
+from map_cache import map_cache
+from viewport import get_viewport_source, known_layer, parse_hours, parse_view, points_json
+
+
+# serves rendered maps by content hash so the browser can cache them and the
+# callbacks only have to send a url. a digest never changes meaning, so it can be cached forever
+def register_map_routes(server, cache=map_cache):
+    @server.route("/maps/<digest>.html")
+    def serve_map(digest):
+        rendered = cache.lookup(digest)
+        if rendered is None:
+            abort(404)
+
+        etag = f'"{rendered.digest}"'
+        headers = {
+            "ETag": etag,
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "Vary": "Accept-Encoding",
+        }
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(status=304, headers=headers)
+
+        accepted = request.accept_encodings
+        for encoding in ("br", "gzip"):
+            if encoding in rendered.encodings and accepted[encoding]:
+                headers["Content-Encoding"] = encoding
+                break
+        else:
+            encoding = "identity"
+        return Response(rendered.encodings[encoding], headers=headers, content_type="text/html; charset=utf-8")
+
+    # points (or bins) in the map's current view, asked for by the map on every pan / zoom.
+    # always from the newest snapshot, so an open map picks up refreshes as it is moved.
+    # the map page passes its own query string along (e.g. ?hours=-3 for the incident time slider)
+    @server.route("/maps/points/<source>/<layer>.json")
+    def serve_points(source, layer):
+        view = parse_view(request.args)
+        if view is None:
+            abort(400)
+        start = time.perf_counter()
+        body = points_json(get_viewport_source(source, layer, parse_hours(request.args)), view).encode("utf-8")
+        headers = {"Cache-Control": "no-store", "Vary": "Accept-Encoding"}
+        if len(body) > 1024 and request.accept_encodings["gzip"]:
+            body = gzip.compress(body, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+        if not known_layer(source, layer):
+            source = layer = "unknown"
+        metrics.points_seconds.observe(time.perf_counter() - start, source=source, layer=layer)
+        metrics.points_bytes.observe(len(body), source=source, layer=layer)
+        return Response(body, headers=headers, content_type="application/json")
+
+    return serve_map
@@ -0,0 +1,210 @@
+import bisect
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, request
+
+# counters and histograms for every stage (HERE fetch, parse, clustering, map render,
+# callbacks), served as prometheus text at /metrics. kept in process and cheap to update:
+# one dict lookup, a bisect and a lock per observation. with several web processes every
+# process has its own numbers, scrape each one
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTE_BUCKETS = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+ROW_BUCKETS = (10, 100, 1e3, 1e4, 1e5, 3e5, 1e6)
+
+_registry = []
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}  # label values -> value(s)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{_escape(value)}"' for label, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.extend(self._lines(key, value))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _lines(self, key, value):
+        return [f"{self.name}{self._label_text(key)} {_number(value)}"]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _lines(self, key, value):
+        return [f"{self.name}{self._label_text(key)} {_number(value)}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # counts, sum, count
+            entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _lines(self, key, entry):
+        counts, total, count = entry
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (float("inf"),), counts):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else _number(bound)
+            lines.append(f"{self.name}_bucket{self._label_text(key, [('le', le)])} {cumulative}")
+        lines.append(f"{self.name}_sum{self._label_text(key)} {_number(total)}")
+        lines.append(f"{self.name}_count{self._label_text(key)} {count}")
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    lines = []
+    for metric in list(_registry):
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# HERE api
+here_request_seconds = Histogram("here_request_seconds", "HERE api request latency, one per attempt",
+                                 ["endpoint", "status"])
+here_response_bytes = Histogram("here_response_bytes", "HERE api response size on the wire", ["endpoint"],
+                                BYTE_BUCKETS)
+here_retries_total = Counter("here_retries_total", "HERE api requests retried", ["endpoint"])
+here_reused_total = Counter("here_reused_total", "HERE api responses answered from the last parse (304 or same sourceUpdated)",
+                            ["endpoint"])
+here_quota_wait_seconds = Histogram("here_quota_wait_seconds", "time a HERE api request waited for the rate limit", ["endpoint"])
+parse_seconds = Histogram("parse_seconds", "time to parse a HERE api response", ["endpoint"])
+parse_rows = Histogram("parse_rows", "rows parsed from one HERE api response", ["endpoint"], ROW_BUCKETS)
+
+# snapshots
+snapshot_seconds = Histogram("snapshot_seconds", "time to build a snapshot (fetch, history, clustering)", ["page"])
+snapshot_rows = Gauge("snapshot_rows", "rows in the current snapshot", ["page"])
+snapshot_failures_total = Counter("snapshot_failures_total", "snapshot builds that failed", ["page"])
+cluster_seconds = Histogram("cluster_seconds", "clustering time including the worker round trip",
+                            ["page", "algorithm"])
+cluster_rows = Histogram("cluster_rows", "rows clustered per run", ["page"], ROW_BUCKETS)
+
+# maps
+render_seconds = Histogram("map_render_seconds", "time to render and compress a map", ["page", "view"])
+render_html_bytes = Histogram("map_html_bytes", "rendered map html size, uncompressed", ["page", "view"],
+                              BYTE_BUCKETS)
+points_seconds = Histogram("map_points_seconds", "time to answer a viewport points request", ["source", "layer"])
+points_bytes = Histogram("map_points_bytes", "viewport points response size as sent", ["source", "layer"],
+                         BYTE_BUCKETS)
+
+# dash callbacks
+callback_seconds = Histogram("callback_seconds", "dash callback request latency", ["callback"])
+callback_bytes = Histogram("callback_response_bytes", "dash callback response size", ["callback"], BYTE_BUCKETS)
+
+
+def _callback_name(dash_app):
+    # only callbacks the app has, any other output the client sends is "unknown"
+    body = request.get_json(silent=True) or {}
+    output = body.get("output", "")
+    if output not in dash_app.callback_map:
+        return "unknown"
+    callback = dash_app.callback_map[output].get("callback")
+    return getattr(callback, "__name__", None) or output
+
+
+# /metrics, callback timing, and with PROFILE_REQUESTS=1 a cProfile of any request that
+# asks for it: ?profile=1 answers with the top functions instead of the page,
+# an X-Profile header only prints them (for callbacks, so dash still gets its json)
+def register_metrics(server, dash_app, profiling=None):
+    if profiling is None:
+        profiling = os.getenv("PROFILE_REQUESTS", "0") == "1"
+
+    @server.route("/metrics")
+    def serve_metrics():
+        return Response(render(), content_type="text/plain; version=0.0.4; charset=utf-8",
+                        headers={"Cache-Control": "no-store"})
+
+    @server.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+        if profiling and (request.args.get("profile") == "1" or request.headers.get("X-Profile")):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+
+    @server.after_request
+    def record(response):
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(30)
+            print(f"@ profile of {request.method} {request.path} @\n{out.getvalue()}")
+            if request.args.get("profile") == "1":
+                response = Response(out.getvalue(), content_type="text/plain; charset=utf-8")
+
+        if request.path.endswith("/_dash-update-component") and "metrics_start" in g:
+            name = _callback_name(dash_app)
+            callback_seconds.observe(time.perf_counter() - g.metrics_start, callback=name)
+            if not response.direct_passthrough:
+                callback_bytes.observe(response.calculate_content_length() or 0, callback=name)
+        return response
+
+    return serve_metrics
@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+import metrics
+
+# every refresher by name, so one page can read another's snapshot, and listeners that run
+# after a refresher with that name swaps in a new snapshot (they can be added before it exists)
+_refreshers = {}
+_listeners = defaultdict(list)
+
+
+def get_refresher(name):
+    return _refreshers.get(name)
+
+
+def on_refresh(name, listener):
+    _listeners[name].append(listener)
+
+
+# rebuilds a snapshot (frames, clusters, maps) on a background thread every `interval` seconds.
+# the finished snapshot replaces the old one in a single assignment, so readers only
+# ever see a complete snapshot and never wait on a fetch.
+# warm_start returns a saved snapshot (see snapshot_cache.py) or None; a saved snapshot is
+# served from the start and the first refresh waits until it is `interval` old.
+# with a share (see snapshot_share.py) only the worker holding the producer lock builds,
+# it publishes every snapshot and the other workers attach to them instead.
+# slots (a semaphore, see regions.build_slots) caps how many builds run at once across refreshers
+# interval None is a refresher that is never started, it only rebuilds when refresh() is called
+# (e.g. from an on_refresh listener of another one)
+class SnapshotRefresher:
+    def __init__(self, name, build, interval, warm_start=None, share=None, slots=None):
+        self.name = name
+        self.build = build
+        self.interval = interval
+        self.warm_start = warm_start
+        self.share = share
+        self.slots = slots
+        self.snapshot = None
+        self.version = 0
+        self._next_refresh = 0
+        self._lock = threading.Lock()  # one build at a time
+        self._stop = threading.Event()
+        self._thread = None
+        _refreshers[name] = self
+
+    def start(self):
+        if self.interval is None:
+            raise ValueError(f"{self.name} has no interval, call refresh() instead")
+        if self._thread is None:
+            self._next_refresh = time.time() + (self._restore() if self.warm_start else 0)
+            self._thread = threading.Thread(target=self._run, name=f"{self.name}-refresher", daemon=True)
+            self._thread.start()
+        return self
+
+    def _restore(self):
+        # seconds until the restored snapshot is due a refresh
+        if self.share is not None and self.share.published_version() is not None:
+            return 0  # the published snapshot is newer, or as new, attach to that instead
+        try:
+            snapshot = self.warm_start()
+        except Exception as e:
+            print(f"@ {self.name} warm start failed: {e} @")
+            return 0
+        if snapshot is None:
+            return 0
+        with self._lock:
+            self.version += 1
+            snapshot["version"] = self.version
+            snapshot.setdefault("built_at", time.time())
+            snapshot["restored"] = True
+            self.snapshot = snapshot
+        age = time.time() - snapshot["built_at"]
+        print(f"@ {self.name} snapshot restored from disk, {age:.0f}s old @")
+        self._notify(snapshot)
+        return max(0.0, self.interval - age)
+
+    def stop(self):
+        self._stop.set()
+
+    def current(self):
+        return self.snapshot
+
+    def refresh(self):
+        with self._lock:
+            try:
+                with self.slots or nullcontext():
+                    start = time.time()  # not counting the wait for a slot
+                    snapshot = self.build()
+            except Exception as e:
+                # keep serving the last good snapshot
+                print(f"@ {self.name} refresh failed: {e} @")
+                metrics.snapshot_failures_total.inc(page=self.name)
+                return self.snapshot
+            self.version += 1
+            snapshot["version"] = self.version
+            snapshot["built_at"] = time.time()
+            self.snapshot = snapshot  # swap
+            metrics.snapshot_seconds.observe(time.time() - start, page=self.name)
+            if "data" in snapshot:
+                metrics.snapshot_rows.set(len(snapshot["data"]), page=self.name)
+            print(f"@ {self.name} snapshot v{self.version} ready in {time.time() - start:.1f}s @")
+            if self.share is not None:
+                try:
+                    self.share.publish(snapshot)
+                except OSError as e:
+                    print(f"@ could not publish {self.name} snapshot: {e} @")
+        self._notify(snapshot)
+        return snapshot
+
+    def _follow(self):
+        # swap in the producer's newest snapshot, if there is a newer one
+        snapshot = self.share.attach(self.version)
+        if snapshot is None:
+            return
+        with self._lock:
+            self.version = snapshot["version"]
+            self.snapshot = snapshot
+        print(f"@ {self.name} attached to published snapshot v{self.version} @")
+        self._notify(snapshot)
+
+    def _lead(self):
+        was_leading = self.share.leading
+        if not self.share.lead():
+            return False
+        if not was_leading:
+            # taking over: carry on the version numbers, and don't rebuild a snapshot that is still fresh
+            self._follow()
+            self.version = max(self.version, self.share.published_version() or 0)
+            if self.snapshot is not None:
+                self._next_refresh = max(self._next_refresh, self.snapshot["built_at"] + self.interval)
+        return True
+
+    def _notify(self, snapshot):
+        for listener in _listeners[self.name]:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                print(f"@ {self.name} refresh listener failed: {e} @")
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.share is not None and not self._lead():
+                self._follow()
+                self._stop.wait(self.share.poll_seconds)
+                continue
+            wait = self._next_refresh - time.time()
+            if wait > 0:
+                self._stop.wait(wait)
+                continue
+            self.refresh()
+            self._next_refresh = time.time() + self.interval
@@ -0,0 +1,125 @@
+import json
+import os
+import re
+import threading
+from concurrent.futures import Future
+
+# the cities one deployment serves. berlin is built in, REGIONS_FILE (json) adds more or
+# changes it, refresh rates default to FLOW_REFRESH_SECONDS / INCIDENT_REFRESH_SECONDS:
+#
+# {"hamburg": {"bbox": "9.73,53.39,10.33,53.74", "center": [53.55, 10.0], "zoom": 11,
+#              "flow_refresh_seconds": 600, "incident_refresh_seconds": 900}}
+#
+# the pages serve a region at /flow/<region> and /incidents/<region>, plain /flow and
+# /incidents are DEFAULT_REGION. every region gets its own fetcher, clustering pipeline and
+# refresher (a "feed"), started the first time someone asks for the region. the default
+# region's feeds keep the plain page names ("flow", "incidents") for the snapshot cache,
+# metrics and map urls, other regions' are "<page>.<region>"
+
+REGION_NAME = re.compile(r"^[a-z0-9_-]+$")
+BERLIN = {"bbox": "13.08836,52.33812,13.761,52.6755", "center": [52.4500, 13.4050], "zoom": 11}
+
+
+class Region:
+    def __init__(self, name, bbox, center=None, zoom=11, flow_refresh_seconds=None, incident_refresh_seconds=None):
+        if not REGION_NAME.match(name):
+            raise ValueError(f"region names are lowercase letters, digits, _ and -: {name!r}")
+        west, south, east, north = (float(v) for v in bbox.split(","))
+        self.name = name
+        self.bounding_box = bbox
+        self.center = list(center) if center else [(south + north) / 2, (west + east) / 2]
+        self.zoom = zoom
+        self.flow_refresh_seconds = int(flow_refresh_seconds or os.getenv("FLOW_REFRESH_SECONDS", 300))
+        self.incident_refresh_seconds = int(incident_refresh_seconds or os.getenv("INCIDENT_REFRESH_SECONDS", 300))
+
+    def __repr__(self):
+        return f"Region({self.name!r}, {self.bounding_box!r})"
+
+
+def load_regions(path=None):
+    config = {"berlin": dict(BERLIN)}
+    if path:
+        with open(path) as f:
+            for name, settings in json.load(f).items():
+                config[name] = dict(config.get(name, {}), **settings)
+    return {name: Region(name, **settings) for name, settings in config.items()}
+
+
+_regions = load_regions(os.getenv("REGIONS_FILE"))
+default_region = os.getenv("DEFAULT_REGION", "berlin")
+if default_region not in _regions:
+    raise ValueError(f"DEFAULT_REGION {default_region!r} is not a configured region ({', '.join(_regions)})")
+
+
+def get_region(name=None):
+    # None is the default region, an unknown name is None
+    return _regions.get(name or default_region)
+
+
+def all_regions():
+    return list(_regions.values())
+
+
+def feed_name(page, region):
+    return page if region.name == default_region else f"{page}.{region.name}"
+
+
+# at most REGION_BUILDS snapshot builds (fetch + cluster) run at once across every page and
+# region, the rest wait their turn instead of all hitting the api and the clustering workers together
+build_slots = threading.BoundedSemaphore(int(os.getenv("REGION_BUILDS", 2)))
+
+
+# one feed per region for a page: start(region) builds it (and starts its refresher) the first
+# time the region is asked for. concurrent first requests share that one start, so a region
+# that is not loaded yet is only fetched and clustered once. starting one region doesn't hold
+# up requests for the others
+class RegionFeeds:
+    def __init__(self, page, start):
+        self.page = page
+        self.start = start
+        self._feeds = {}
+        self._starting = {}  # region name -> future of the feed being started
+        self._lock = threading.Lock()
+        _feeds[page] = self
+
+    def get(self, region):
+        feed = self._feeds.get(region.name)
+        if feed is not None:
+            return feed
+        owner = False
+        with self._lock:
+            feed = self._feeds.get(region.name)
+            if feed is not None:
+                return feed
+            future = self._starting.get(region.name)
+            if future is None:
+                future = self._starting[region.name] = Future()
+                owner = True
+        if not owner:
+            return future.result()
+
+        print(f"@ starting {self.page} feed for {region.name} @")
+        try:
+            feed = self.start(region)
+        except Exception as e:
+            with self._lock:
+                del self._starting[region.name]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._feeds[region.name] = feed
+            del self._starting[region.name]
+        future.set_result(feed)
+        return feed
+
+    def started(self):
+        with self._lock:
+            return dict(self._feeds)
+
+
+_feeds = {}
+
+
+def get_feeds(page):
+    # another page's feeds (the incident impact map needs the flow feed of its region)
+    return _feeds.get(page)
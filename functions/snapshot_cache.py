@@ -0,0 +1,270 @@
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from geometry import SegmentGeometry
+from map_cache import map_cache
+from refresher import on_refresh
+
+# the last processed snapshot of each page on disk, so a restart can serve it straight away
+# instead of fetching and clustering first.
+#
+# snapshot_cache/<page>/<bbox>/<sourceUpdated>-<saved ns>/
+#     frames/<name>/c<i>.npy, geometry_*.npy   each frame, one file per column (memory mapped on load)
+#     snapshot.json                            everything else that is plain json (color maps, times)
+#     maps/<view>.html                         the rendered maps, put back into the map cache
+#
+# entries older than max_age are never loaded, and the oldest entries are deleted once the
+# whole cache is bigger than max_bytes. a loaded snapshot is just the starting point, the
+# refresher revalidates against the api once the snapshot is refresh_seconds old
+
+SAFE_NAME = re.compile(r"[^0-9A-Za-z_.-]+")
+
+
+def safe_name(name):
+    return SAFE_NAME.sub("_", str(name))
+
+
+def write_frame(directory, frame):
+    # strings as categorical codes, tz aware times as int64 ns utc
+    os.makedirs(directory, exist_ok=True)
+    meta = {"rows": len(frame), "columns": {}}
+    for column in frame.columns:
+        values = frame[column]
+        name = f"c{len(meta['columns'])}"
+        if pd.api.types.is_datetime64_any_dtype(values):
+            times = values if values.dt.tz is not None else values.dt.tz_localize("UTC")
+            array = times.dt.tz_convert(None).to_numpy().astype("datetime64[ns]").view(np.int64)
+            info = {"kind": "datetime"}
+        elif isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object or pd.api.types.is_string_dtype(values):
+            values = values.astype("category")
+            array = values.cat.codes.to_numpy()
+            info = {"kind": "category", "categories": [str(c) for c in values.cat.categories]}
+        else:
+            array = values.to_numpy()
+            info = {"kind": "values"}
+        np.save(os.path.join(directory, f"{name}.npy"), array)
+        meta["columns"][column] = dict(info, file=name)
+    geometry = frame.attrs.get("geometry")
+    if geometry is not None:
+        for part in ("lat", "lng", "offsets"):
+            np.save(os.path.join(directory, f"geometry_{part}.npy"), getattr(geometry, part))
+        meta["geometry"] = True
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def read_frame(directory):
+    with open(os.path.join(directory, "meta.json")) as f:
+        meta = json.load(f)
+    columns = {}
+    for column, info in meta["columns"].items():
+        values = np.load(os.path.join(directory, f"{info['file']}.npy"), mmap_mode="r")
+        if info["kind"] == "category":
+            columns[column] = pd.Categorical.from_codes(np.asarray(values), categories=info["categories"])
+        elif info["kind"] == "datetime":
+            columns[column] = pd.to_datetime(np.asarray(values), unit="ns", utc=True)
+        else:
+            columns[column] = values
+    frame = pd.DataFrame(columns, copy=False)
+    if meta.get("geometry"):
+        parts = [np.load(os.path.join(directory, f"geometry_{part}.npy"), mmap_mode="r") for part in ("lat", "lng", "offsets")]
+        frame.attrs["geometry"] = SegmentGeometry(*parts)
+    return frame
+
+
+def _to_json(value):
+    # dict keys can be ints (cluster -> color), kept as [key, value] pairs
+    if isinstance(value, dict):
+        return {"items": [[_to_json(k), _to_json(v)] for k, v in value.items()]}
+    if isinstance(value, (np.integer, np.floating, np.bool_)):
+        return value.item()
+    return value
+
+
+def _from_json(value):
+    if isinstance(value, dict) and "items" in value:
+        return {_from_json(k): _from_json(v) for k, v in value["items"]}
+    return value
+
+
+def write_entry(entry, snapshot, maps=None):
+    # frames and plain values of the snapshot, anything else (indexes...) is rebuilt on load.
+    # written next to entry and renamed, so readers never see half of one
+    tmp_dir = os.path.join(os.path.dirname(entry), f".{uuid.uuid4().hex[:8]}.tmp")
+    os.makedirs(tmp_dir)
+    values = {"saved_at": time.time(), "frames": []}
+    for key, value in snapshot.items():
+        if isinstance(value, pd.DataFrame):
+            write_frame(os.path.join(tmp_dir, "frames", safe_name(key)), value)
+            values["frames"].append(key)
+        elif isinstance(value, (dict, str, int, float, bool, np.integer, np.floating)) or value is None:
+            values[key] = _to_json(value)
+    os.makedirs(os.path.join(tmp_dir, "maps"))
+    for view, html in (maps or {}).items():
+        with open(os.path.join(tmp_dir, "maps", f"{safe_name(view)}.html"), "w", encoding="utf-8") as f:
+            f.write(html)
+    with open(os.path.join(tmp_dir, "snapshot.json"), "w") as f:
+        json.dump({"snapshot": values, "maps": list(maps or {})}, f)
+    os.replace(tmp_dir, entry)
+
+
+def read_entry(entry):
+    # (snapshot, {view: html}, saved_at), frames memory mapped
+    with open(os.path.join(entry, "snapshot.json")) as f:
+        stored = json.load(f)
+    values = stored["snapshot"]
+    snapshot = {key: _from_json(value) for key, value in values.items() if key not in ("saved_at", "frames")}
+    for key in values["frames"]:
+        snapshot[key] = read_frame(os.path.join(entry, "frames", safe_name(key)))
+    maps = {}
+    for view in stored["maps"]:
+        with open(os.path.join(entry, "maps", f"{safe_name(view)}.html"), encoding="utf-8") as f:
+            maps[view] = f.read()
+    return snapshot, maps, values["saved_at"]
+
+
+def _size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(directory) for name in files)
+
+
+class SnapshotCache:
+    def __init__(self, root, max_age, max_bytes):
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def save(self, page, bounding_box, snapshot, maps=None):
+        # maps is {view name: html}
+        page_dir = os.path.join(self.root, safe_name(page), safe_name(bounding_box))
+        entry = os.path.join(page_dir, f"{safe_name(snapshot.get('source_updated') or 'unknown')}-{time.time_ns()}")
+        write_entry(entry, snapshot, maps)
+        with self._lock:
+            self._evict(keep=entry)
+        return entry
+
+    def load(self, page, bounding_box):
+        # (snapshot, {view: html}) from the newest entry younger than max_age, or None
+        page_dir = os.path.join(self.root, safe_name(page), safe_name(bounding_box))
+        for entry in reversed(self._entries(page_dir)):
+            try:
+                snapshot, maps, saved_at = read_entry(entry)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"@ could not load cached snapshot {entry}: {e} @")
+                continue
+            if time.time() - saved_at > self.max_age:
+                return None  # the newest is too old, so is everything before it
+            return snapshot, maps
+        return None
+
+    def _entries(self, page_dir):
+        # oldest first, by the save time in the name
+        if not os.path.isdir(page_dir):
+            return []
+        names = [name for name in os.listdir(page_dir) if not name.startswith(".")]
+        return [os.path.join(page_dir, name) for name in sorted(names, key=lambda name: int(name.rsplit("-", 1)[-1]))]
+
+    def _evict(self, keep):
+        # drop expired entries, then the oldest until the cache fits (never the one just written)
+        entries = []
+        for page in os.listdir(self.root):
+            for bbox in os.listdir(os.path.join(self.root, page)):
+                entries.extend(self._entries(os.path.join(self.root, page, bbox)))
+        entries.sort(key=lambda entry: int(entry.rsplit("-", 1)[-1]))
+        now = time.time_ns()
+        sizes = {entry: _size(entry) for entry in entries}
+        total = sum(sizes.values())
+        for entry in entries:
+            if entry == keep:
+                continue
+            expired = now - int(entry.rsplit("-", 1)[-1]) > self.max_age * 1e9
+            if expired or total > self.max_bytes:
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= sizes[entry]
+
+
+def map_name(view, show_gray):
+    return f"{view}-gray" if show_gray else view
+
+
+def render_maps(page, snapshot, views, render):
+    # through the map cache, so saving, publishing and serving a snapshot render each map once
+    # (and every copy of it has the same url)
+    maps = {}
+    for view, show_gray in views:
+        key = (page, view, show_gray, snapshot["version"])
+        rendered = map_cache.get_or_render(key, lambda: render(snapshot, view, show_gray))
+        maps[map_name(view, show_gray)] = rendered.encodings["identity"].decode("utf-8")
+    return maps
+
+
+def seed_maps(page, views, version, maps):
+    # saved maps back into the map cache, under the keys the page's callback looks up
+    for view, show_gray in views:
+        html = maps.get(map_name(view, show_gray))
+        if html is not None:
+            map_cache.get_or_render((page, view, show_gray, version), lambda: html)
+
+
+def warm_start(page, bounding_box, views, prepare=None):
+    # hooks a page's refresher (named page) up to the cache: returns its warm_start function,
+    # and from then on saves every new snapshot. prepare(snapshot) rebuilds whatever is not saved.
+    # maps are not saved with it, they are still rendered on first request: the map pages
+    # carry no data and have stable ids (map_layers.stable_ids), so after a restart they come
+    # out the same and keep their urls. maps of an entry that has them (written by a
+    # snapshot_share producer) go back into the map cache for each (view, show_gray) in views
+    cache = get_snapshot_cache()
+    if cache is None:
+        return None
+    restored_maps = {}
+
+    def load():
+        loaded = cache.load(page, bounding_box)
+        if loaded is None:
+            return None
+        snapshot, maps = loaded
+        restored_maps.update(maps)
+        if prepare is not None:
+            prepare(snapshot)
+        return snapshot
+
+    def on_snapshot(snapshot):
+        if snapshot.get("restored"):
+            seed_maps(page, views, snapshot["version"], restored_maps)
+            restored_maps.clear()
+            return
+        if snapshot.get("attached"):
+            return  # published by another worker, which saves it (see snapshot_share.py)
+        try:
+            cache.save(page, bounding_box, snapshot)
+        except OSError as e:
+            print(f"@ could not save {page} snapshot: {e} @")
+
+    on_refresh(page, on_snapshot)
+    return load
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_snapshot_cache():
+    # SNAPSHOT_CACHE_DIR="" turns the warm start off
+    global _cache
+    root = os.getenv("SNAPSHOT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "snapshot_cache"))
+    if not root:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = SnapshotCache(
+                os.path.abspath(root),
+                max_age=float(os.getenv("SNAPSHOT_CACHE_MAX_AGE", 6 * 3600)),
+                max_bytes=int(os.getenv("SNAPSHOT_CACHE_MB", 512)) * 1024 * 1024,
+            )
+        return _cache
@@ -0,0 +1,100 @@
+import os
+import shutil
+import uuid
+from snapshot_cache import read_entry, render_maps, safe_name, seed_maps, write_entry
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # windows, every worker builds its own snapshots
+
+# one producer per page when the app runs in several worker processes (gunicorn -w 4 ...).
+# workers race for a lock file, the one holding it fetches / clusters / renders and
+# publishes every snapshot as a numbered version:
+#
+# SNAPSHOT_SHARE_DIR/<page>/<bbox>/v00000042/   same layout as a snapshot_cache.py entry
+# SNAPSHOT_SHARE_DIR/<page>/<bbox>/current      "v00000042", swapped in after the version is complete
+#
+# every other worker polls `current` and attaches to new versions: frames memory mapped
+# (the page cache is shared, so no copy per worker) and maps straight into its map cache.
+# the maps are the same html in every worker, so their urls work whichever worker serves them.
+# when the producer dies its lock is released and the next worker to poll takes over
+
+
+class SnapshotShare:
+    def __init__(self, root, page, bounding_box, views, render, prepare=None, poll_seconds=2, keep=3):
+        self.page = page
+        self.dir = os.path.join(root, safe_name(page), safe_name(bounding_box))
+        self.views = views
+        self.render = render
+        self.prepare = prepare
+        self.poll_seconds = poll_seconds
+        self.keep = keep  # versions kept on disk, older ones may still be mapped by a slow worker
+        self._lock_file = None
+        os.makedirs(self.dir, exist_ok=True)
+
+    @property
+    def leading(self):
+        return self._lock_file is not None or fcntl is None
+
+    def lead(self):
+        # True once this process is the producer, it stays that until it exits
+        if self.leading:
+            return True
+        lock_file = open(os.path.join(self.dir, "producer.lock"), "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        print(f"@ {self.page} snapshots are built by this worker (pid {os.getpid()}) @")
+        return True
+
+    def published_version(self):
+        try:
+            with open(os.path.join(self.dir, "current")) as f:
+                return int(f.read().strip().lstrip("v"))
+        except (OSError, ValueError):
+            return None
+
+    def publish(self, snapshot):
+        version = snapshot["version"]
+        entry = os.path.join(self.dir, f"v{version:08d}")
+        if os.path.exists(entry):
+            shutil.rmtree(entry)  # left by a producer that died before switching to it
+        write_entry(entry, snapshot, render_maps(self.page, snapshot, self.views, self.render))
+        pointer = os.path.join(self.dir, f".current-{uuid.uuid4().hex[:8]}")
+        with open(pointer, "w") as f:
+            f.write(f"v{version:08d}")
+        os.replace(pointer, os.path.join(self.dir, "current"))
+
+        versions = sorted(name for name in os.listdir(self.dir) if name.startswith("v"))
+        for name in versions[:-self.keep]:
+            shutil.rmtree(os.path.join(self.dir, name), ignore_errors=True)
+
+    def attach(self, after_version):
+        # the published snapshot if it is newer than after_version, else None
+        version = self.published_version()
+        if version is None or version <= after_version:
+            return None
+        try:
+            snapshot, maps, _ = read_entry(os.path.join(self.dir, f"v{version:08d}"))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"@ could not attach to {self.page} snapshot v{version}: {e} @")
+            return None
+        if self.prepare is not None:
+            self.prepare(snapshot)
+        snapshot["version"] = version
+        snapshot["attached"] = True
+        seed_maps(self.page, self.views, version, maps)
+        return snapshot
+
+
+def share_snapshots(page, bounding_box, views, render, prepare=None):
+    # SNAPSHOT_SHARE_DIR turns this on, it has to be the same folder for every worker
+    root = os.getenv("SNAPSHOT_SHARE_DIR")
+    if not root:
+        return None
+    return SnapshotShare(os.path.abspath(root), page, bounding_box, views, render, prepare,
+                         poll_seconds=float(os.getenv("SNAPSHOT_POLL_SECONDS", 2)))
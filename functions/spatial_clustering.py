@@ -0,0 +1,85 @@
+import time
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import BallTree, sort_graph_by_row_values
+from geometry import EARTH_RADIUS_M
+
+
+# dbscan in meters on real distances (haversine) instead of on raw lat/lng degrees, where
+# 0.01 is ~1.1km north-south but only ~0.7km east-west in berlin.
+# points go into a BallTree once and the neighbours within max_eps_m are kept as a sparse
+# distance matrix, so any eps <= max_eps_m and any min_samples can be tried without
+# another neighbour search
+class SpatialIndex:
+    def __init__(self, lat, lng, max_eps_m):
+        self.points = np.radians(np.column_stack([np.asarray(lat, dtype=float), np.asarray(lng, dtype=float)]))
+        self.tree = BallTree(self.points, metric="haversine") if len(self.points) else None
+        self.max_eps_m = max_eps_m
+        self._graph = None
+
+    def __len__(self):
+        return len(self.points)
+
+    def graph(self, eps_m=None):
+        # csr matrix of distances in meters for every pair closer than eps_m (self included, as 0)
+        eps_m = self.max_eps_m if eps_m is None else eps_m
+        if eps_m > self.max_eps_m:
+            self.max_eps_m = eps_m
+            self._graph = None
+        if self._graph is None:
+            self._graph = self._build_graph(self.max_eps_m)
+        if eps_m == self.max_eps_m:
+            return self._graph
+
+        # drop the longer edges, keeping explicit zeros (duplicate points, self)
+        graph = self._graph
+        keep = graph.data <= eps_m
+        rows = np.repeat(np.arange(len(self)), np.diff(graph.indptr))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(rows[keep], minlength=len(self)))])
+        return csr_matrix((graph.data[keep], graph.indices[keep], indptr), shape=graph.shape)
+
+    def _build_graph(self, eps_m):
+        if self.tree is None:
+            return csr_matrix((0, 0))
+        indices, distances = self.tree.query_radius(self.points, r=eps_m / EARTH_RADIUS_M, return_distance=True)
+        counts = np.fromiter((len(i) for i in indices), dtype=np.int64, count=len(indices))
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        graph = csr_matrix(
+            (np.concatenate(distances) * EARTH_RADIUS_M, np.concatenate(indices), indptr),
+            shape=(len(self), len(self)),
+        )
+        return sort_graph_by_row_values(graph, warn_when_not_sorted=False)
+
+    def fit(self, eps_m, min_samples):
+        # the fitted DBSCAN, for its core_sample_indices_ too
+        return DBSCAN(eps=eps_m, min_samples=min_samples, metric="precomputed").fit(self.graph(eps_m))
+
+    def dbscan(self, eps_m, min_samples):
+        if len(self) == 0:
+            return np.array([], dtype=int)
+        return self.fit(eps_m, min_samples).labels_
+
+    def sweep(self, eps_values, min_samples_values):
+        # every eps / min_samples combination off the same neighbour graph
+        rows = []
+        labels = {}
+        self.graph(max(eps_values))
+        for eps_m in eps_values:
+            for min_samples in min_samples_values:
+                start = time.perf_counter()
+                result = self.dbscan(eps_m, min_samples)
+                labels[(eps_m, min_samples)] = result
+                rows.append({
+                    "eps_m": eps_m,
+                    "min_samples": min_samples,
+                    "clusters": len(set(result.tolist()) - {-1}),
+                    "noise": int((result == -1).sum()),
+                    "seconds": time.perf_counter() - start,
+                })
+        return pd.DataFrame(rows), labels
+
+
+def haversine_dbscan(lat, lng, eps_m, min_samples):
+    return SpatialIndex(lat, lng, eps_m).dbscan(eps_m, min_samples)
@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import BallTree
+from geometry import EARTH_RADIUS_M
+
+# incidents matched to the flow segments around them, for how much traffic an incident is
+# holding up. the segments' points go into a haversine BallTree once per flow snapshot
+# (every shape point with full geometry, else one point per segment) and every incident
+# asks for the points within radius_m in one query_radius call. a segment matches once,
+# at its closest point
+
+
+class SegmentIndex:
+    def __init__(self, flow_data):
+        geometry = flow_data.attrs.get("geometry")
+        if geometry is not None and len(geometry.counts) == len(flow_data):
+            lat, lng = geometry.lat, geometry.lng
+            self.segment_of = np.repeat(np.arange(len(flow_data)), geometry.counts)
+        else:
+            lat, lng = flow_data['lat'].to_numpy(dtype=float), flow_data['lng'].to_numpy(dtype=float)
+            self.segment_of = np.arange(len(flow_data))
+        points = np.radians(np.column_stack([lat, lng]))
+        self.tree = BallTree(points, metric="haversine") if len(points) else None
+        self.segments = len(flow_data)
+
+    def within(self, lat, lng, radius_m):
+        # (incident row, segment row, meters) for every segment within radius_m of an incident,
+        # sorted by incident then distance
+        lat = np.asarray(lat, dtype=float)
+        if self.tree is None or len(lat) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+        points = np.radians(np.column_stack([lat, np.asarray(lng, dtype=float)]))
+        indices, distances = self.tree.query_radius(points, r=radius_m / EARTH_RADIUS_M, return_distance=True)
+        counts = np.fromiter((len(i) for i in indices), dtype=np.int64, count=len(indices))
+        incident = np.repeat(np.arange(len(lat)), counts)
+        segment = self.segment_of[np.concatenate(indices).astype(np.int64)]
+        meters = np.concatenate(distances) * EARTH_RADIUS_M
+
+        # closest point per (incident, segment)
+        order = np.lexsort((meters, segment, incident))
+        incident, segment, meters = incident[order], segment[order], meters[order]
+        first = np.r_[True, (incident[1:] != incident[:-1]) | (segment[1:] != segment[:-1])]
+        incident, segment, meters = incident[first], segment[first], meters[first]
+        order = np.lexsort((meters, incident))
+        return incident[order], segment[order], meters[order]
+
+
+def incident_impact(incident_count, flow_data, incident, segment, meters):
+    # per incident: matched segments, closest one, their mean / max jam factor and mean
+    # speed as a share of free flow speed. NaN where nothing is close enough
+    jam = flow_data['jam_factor'].to_numpy(dtype=float)[segment]
+    speed = flow_data['speed'].to_numpy(dtype=float)[segment]
+    free_flow = flow_data['free_flow_speed'].to_numpy(dtype=float)[segment]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ratio = np.where(free_flow > 0, speed / free_flow, np.nan)
+
+    pairs = pd.DataFrame({"incident": incident, "jam": jam, "ratio": ratio, "meters": meters})
+    grouped = pairs.groupby("incident")
+    impact = pd.DataFrame({
+        "nearby_segments": grouped.size(),
+        "nearest_m": grouped["meters"].min(),
+        "mean_jam": grouped["jam"].mean(),
+        "max_jam": grouped["jam"].max(),
+        "speed_ratio": grouped["ratio"].mean(),
+    }).reindex(np.arange(incident_count))
+    impact["nearby_segments"] = impact["nearby_segments"].fillna(0).astype(int)
+    return impact.reset_index(drop=True)
+
+
+def join_incidents(incident_data, flow_data, radius_m, index=None):
+    # incident_data with the impact columns added (a copy), and the matched pairs
+    if index is None:
+        index = SegmentIndex(flow_data)
+    incident, segment, meters = index.within(incident_data['lat'], incident_data['lng'], radius_m)
+    impact = incident_impact(len(incident_data), flow_data, incident, segment, meters)
+    joined = incident_data.reset_index(drop=True).copy()
+    for column in impact.columns:
+        joined[column] = impact[column].to_numpy()
+    return joined, pd.DataFrame({"incident": incident, "segment": segment, "meters": meters})
@@ -0,0 +1,199 @@
+import json
+import re
+import numpy as np
+import pandas as pd
+from geometry import SegmentGeometry
+
+RESULTS_START = re.compile(r'"results"\s*:\s*\[')
+SOURCE_UPDATED = re.compile(r'"sourceUpdated"\s*:\s*"([^"]*)"')
+WHITESPACE = re.compile(r"[\s,]*")
+
+
+# streaming versions of parse_flow_response / parse_incident_response. the body is
+# walked one result at a time with raw_decode, so the full json tree and the list of
+# row dicts never exist at once. every column goes straight into a typed buffer
+
+
+def iter_results(text):
+    # yields each element of the top level "results" array, one at a time
+    match = RESULTS_START.search(text)
+    if match is None:
+        return
+    decoder = json.JSONDecoder()
+    position = match.end()
+    while True:
+        position = WHITESPACE.match(text, position).end()
+        if position >= len(text):
+            # cut off between two results, json.loads would fail on it too
+            raise json.JSONDecodeError("results array is not closed", text, position)
+        if text[position] == "]":
+            if not text.rstrip().endswith("}"):
+                raise json.JSONDecodeError("response is not closed", text, len(text))
+            return
+        result, position = decoder.raw_decode(text, position)
+        yield result
+
+
+# numpy array that doubles when full, like a list but with one dtype and no boxing
+class ColumnBuffer:
+    def __init__(self, dtype, capacity=1024):
+        self.values = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, value):
+        if self.size == len(self.values):
+            self.values = np.resize(self.values, len(self.values) * 2)
+        self.values[self.size] = value
+        self.size += 1
+
+    def array(self):
+        return self.values[:self.size]
+
+
+# strings stored as int codes plus one copy of each distinct value, ends up as a pandas categorical
+class CategoryBuffer:
+    def __init__(self, capacity=1024):
+        self.codes = ColumnBuffer(np.int32, capacity)
+        self.categories = {}
+
+    def append(self, value):
+        code = self.categories.get(value)
+        if code is None:
+            code = self.categories[value] = len(self.categories)
+        self.codes.append(code)
+
+    def array(self):
+        return pd.Categorical.from_codes(self.codes.array(), categories=list(self.categories))
+
+
+# same idea for the shape points of every segment, see SegmentGeometry
+class GeometryBuffer:
+    def __init__(self, capacity=4096):
+        self.lat = ColumnBuffer(np.float64, capacity)
+        self.lng = ColumnBuffer(np.float64, capacity)
+        self.offsets = ColumnBuffer(np.int64)
+        self.offsets.append(0)
+
+    def append(self, location):
+        for link in location.get("shape", {}).get("links", []):
+            for point in link.get("points", []):
+                self.lat.append(point.get("lat", 0))
+                self.lng.append(point.get("lng", 0))
+        self.offsets.append(self.lat.size)
+
+    def geometry(self):
+        return SegmentGeometry(self.lat.array(), self.lng.array(), self.offsets.array())
+
+
+def _first_point(location):
+    shape = location.get("shape", {}).get("links", [{}])
+    point = shape[0].get("points", [{}])[0] if shape else {}
+    return point.get("lat", 0), point.get("lng", 0)
+
+
+def _text(body):
+    return body.decode("utf-8") if isinstance(body, (bytes, bytearray)) else body
+
+
+def parse_flow_stream(body, full_geometry=False):
+    text = _text(body)
+    match = SOURCE_UPDATED.search(text)
+    source_updated = match.group(1) if match else "Unknown Time"
+
+    description = CategoryBuffer()
+    length = ColumnBuffer(np.float64)
+    speed = ColumnBuffer(np.float64)
+    free_flow_speed = ColumnBuffer(np.float64)
+    jam_factor = ColumnBuffer(np.float64)
+    lat = ColumnBuffer(np.float64)
+    lng = ColumnBuffer(np.float64)
+    geometry = GeometryBuffer() if full_geometry else None
+
+    for result in iter_results(text):
+        location = result.get("location", {})
+        current_flow = result.get("currentFlow", {})
+        description.append(location.get("description", "Unknown Location"))
+        length.append(location.get("length", 0))
+        speed.append(current_flow.get("speed", 0))
+        free_flow_speed.append(current_flow.get("freeFlow", 0))
+        jam_factor.append(current_flow.get("jamFactor", 0))
+        first_lat, first_lng = _first_point(location)
+        lat.append(first_lat)
+        lng.append(first_lng)
+        if geometry is not None:
+            geometry.append(location)
+
+    rows = lat.size
+    if rows == 0:
+        return pd.DataFrame()
+    traffic_data = pd.DataFrame({
+        "type": pd.Categorical(["flow"] * rows),
+        "description": description.array(),
+        "length": length.array(),
+        "speed": speed.array(),
+        "free_flow_speed": free_flow_speed.array(),
+        "jam_factor": jam_factor.array(),
+        "lat": lat.array(),
+        "lng": lng.array(),
+        "time_updated": pd.Categorical([source_updated] * rows),
+    })
+    if geometry is not None:
+        traffic_data.attrs["geometry"] = geometry.geometry()
+    return traffic_data
+
+
+def parse_incident_stream(body, full_geometry=False, cutoff_time=None):
+    text = _text(body)
+
+    description = CategoryBuffer()
+    criticality = CategoryBuffer()
+    incident_type = CategoryBuffer()
+    start_time = []
+    end_time = []
+    road_closed = ColumnBuffer(np.bool_)
+    lat = ColumnBuffer(np.float64)
+    lng = ColumnBuffer(np.float64)
+    geometry = GeometryBuffer() if full_geometry else None
+
+    for result in iter_results(text):
+        location = result.get("location", {})
+        incident_details = result.get("incidentDetails", {})
+        description.append(incident_details.get("description", {}).get("value", "Unknown Incident"))
+        criticality.append(incident_details.get("criticality", "Unknown"))
+        incident_type.append(incident_details.get("type", "Unknown"))
+        start_time.append(incident_details.get("startTime", "1970-01-01T00:00:00Z"))
+        end_time.append(incident_details.get("endTime", "1970-01-01T00:00:00Z"))
+        road_closed.append(incident_details.get("roadClosed", False))
+        first_lat, first_lng = _first_point(location)
+        lat.append(first_lat)
+        lng.append(first_lng)
+        if geometry is not None:
+            geometry.append(location)
+
+    if lat.size == 0:
+        return pd.DataFrame()
+    # timestamps are parsed in one go instead of fromisoformat per row
+    incident_data = pd.DataFrame({
+        "type": pd.Categorical(["incidents"] * lat.size),
+        "description": description.array(),
+        "criticality": criticality.array(),
+        "incident_type": incident_type.array(),
+        "start_time": pd.to_datetime(start_time, utc=True, format="ISO8601"),
+        "end_time": pd.to_datetime(end_time, utc=True, format="ISO8601"),
+        "road_closed": road_closed.array(),
+        "lat": lat.array(),
+        "lng": lng.array(),
+    })
+    geometry = geometry.geometry() if geometry is not None else None
+
+    if cutoff_time is not None:
+        # include cutoff for load time purposes
+        keep = ((incident_data["end_time"] >= cutoff_time) | (incident_data["start_time"] >= cutoff_time)).to_numpy()
+        incident_data = incident_data[keep].reset_index(drop=True)
+        for column in ("description", "criticality", "incident_type"):
+            incident_data[column] = incident_data[column].cat.remove_unused_categories()
+        if geometry is not None:
+            geometry = geometry.take(keep)
+    if geometry is not None:
+        incident_data.attrs["geometry"] = geometry
+    return incident_data
@@ -1,8 +1,15 @@
 import os
+import sys
+
+# py test_traffic_fetcher.py --fake runs against a local FakeHereServer instead of the live api
+if "--fake" in sys.argv:
+    from fake_here import FakeHereServer
+    os.environ["HERE_BASE_URL"] = FakeHereServer(2000, 200).start().url
 from traffic_fetcher import fetch_flow_data, fetch_incident_data
+from regions import get_region
 
 
-bounding_box = "13.08836,52.33812,13.761,52.6755" 
+bounding_box = get_region().bounding_box  # DEFAULT_REGION, see regions.py
 traffic_data = fetch_flow_data(bounding_box)
 print(traffic_data.head())
 print(traffic_data, "\n")
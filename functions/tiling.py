@@ -0,0 +1,117 @@
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+from geometry import SegmentGeometry
+
+
+def parse_bbox(bounding_box):
+    # "west,south,east,north" like the HERE in=bbox: parameter
+    if isinstance(bounding_box, str):
+        return tuple(float(v) for v in bounding_box.split(","))
+    return tuple(bounding_box)
+
+
+def format_bbox(box):
+    return ",".join(f"{v:.6f}" for v in box)
+
+
+def split_bbox(bounding_box, tile_size):
+    # grid of equal tiles no bigger than tile_size degrees on a side
+    west, south, east, north = parse_bbox(bounding_box)
+    nx = max(1, math.ceil((east - west) / tile_size - 1e-9))
+    ny = max(1, math.ceil((north - south) / tile_size - 1e-9))
+    width = (east - west) / nx
+    height = (north - south) / ny
+    return [
+        (west + i * width, south + j * height, west + (i + 1) * width, south + (j + 1) * height)
+        for j in range(ny)
+        for i in range(nx)
+    ]
+
+
+# fetches a big bbox as a grid of smaller ones on a bounded thread pool. a tile that
+# comes back with max_results rows (probably cut off) or slower than slow_seconds (not
+# counting the client's quota / retry waits) is split into quarters and fetched again, and
+# the starting tile size for the next call halves. after regrow_after fetches in a row
+# without that it doubles again, up to max_tile_size (by default the size it started at).
+# otherwise the grid stays as it is, so every refresh asks for the same tiles and the client
+# can revalidate them (see here_client.py). the merged frame's attrs["source_updated"] is the
+# newest sourceUpdated of its tiles
+class TiledFetcher:
+    def __init__(self, fetch, dedupe_on, tile_size=None, min_tile_size=0.02, max_tile_size=None,
+                 max_workers=None, max_results=5000, slow_seconds=10, regrow_after=12):
+        self.fetch_tile = fetch
+        self.dedupe_on = dedupe_on
+        self.min_tile_size = min_tile_size
+        start_size = tile_size or float(os.getenv("HERE_TILE_DEG", 0.25))
+        self.max_tile_size = max_tile_size or start_size
+        self.tile_size = min(self.max_tile_size, start_size)
+        self.max_workers = max_workers or int(os.getenv("HERE_TILE_WORKERS", 4))
+        self.max_results = max_results
+        self.slow_seconds = slow_seconds
+        self.regrow_after = regrow_after
+        self.clean_fetches = 0  # fetches in a row without a cut off or slow tile
+
+    def fetch(self, bounding_box):
+        tiles = split_bbox(bounding_box, self.tile_size)
+        frames = []
+        splits = 0
+        overloaded_tiles = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            pending = {pool.submit(self._timed_fetch, tile): tile for tile in tiles}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tile = pending.pop(future)
+                    frame, seconds = future.result()
+                    size = max(tile[2] - tile[0], tile[3] - tile[1])
+                    overloaded = len(frame) >= self.max_results or seconds > self.slow_seconds
+                    overloaded_tiles += overloaded
+                    if overloaded and size / 2 >= self.min_tile_size:
+                        splits += 1
+                        for sub_tile in split_bbox(tile, size / 2):
+                            pending[pool.submit(self._timed_fetch, sub_tile)] = sub_tile
+                    else:
+                        frames.append(frame)
+
+        # smaller tiles next time if any were cut off or slow, even ones too small to split.
+        # a while without that and they grow back, one step at a time
+        if overloaded_tiles:
+            self.tile_size = max(self.min_tile_size, self.tile_size / 2)
+            self.clean_fetches = 0
+        else:
+            self.clean_fetches += 1
+            if self.clean_fetches >= self.regrow_after and self.tile_size < self.max_tile_size:
+                self.tile_size = min(self.max_tile_size, self.tile_size * 2)
+                self.clean_fetches = 0
+
+        # the newest sourceUpdated of this bbox's own tiles (iso timestamps, so the largest string)
+        source_updated = max((frame.attrs.get("source_updated") or "" for frame in frames), default="") or None
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            empty = pd.DataFrame()
+            empty.attrs["source_updated"] = source_updated
+            return empty
+        # segments crossing a tile border come back from both tiles
+        geometries = [frame.attrs.get("geometry") for frame in frames]
+        merged = pd.concat(frames, ignore_index=True)
+        keep = ~merged.duplicated(subset=self.dedupe_on).to_numpy()
+        merged = merged[keep].reset_index(drop=True)
+        merged.attrs = {}
+        # concat turns categoricals with different categories into objects, put them back
+        for column, dtype in frames[0].dtypes.items():
+            if isinstance(dtype, pd.CategoricalDtype) and column in merged:
+                merged[column] = merged[column].astype("category")
+        if all(geometry is not None for geometry in geometries):
+            merged.attrs["geometry"] = SegmentGeometry.concat(geometries).take(keep)
+        merged.attrs["source_updated"] = source_updated
+        print(f"{len(tiles)} tiles ({splits} split), {len(merged)} rows after dedupe, next tile size {self.tile_size:.3f}")
+        return merged
+
+    def _timed_fetch(self, tile):
+        # the time the api took, without what the client spent waiting on the quota / backoff
+        start = time.perf_counter()
+        frame = self.fetch_tile(format_bbox(tile))
+        return frame, time.perf_counter() - start - frame.attrs.get("waited_seconds", 0)
@@ -1,102 +1,117 @@
-import requests
 import pandas as pd
-import os
-from dotenv import load_dotenv
-import json
 from datetime import datetime, timedelta, timezone
+from functools import partial
+from here_client import get_client
+from geometry import SegmentGeometry
+from stream_parser import parse_flow_stream, parse_incident_stream
 
-load_dotenv()
+INCIDENT_HOURS = 24  # incidents that ended longer ago than this are dropped
 
-API_KEY = os.getenv("HERE_API_KEY")
-
-def fetch_flow_data(bounding_box):
-    base_url = "https://data.traffic.hereapi.com/v7/"
+# full_geometry=True keeps every point of every segment as a SegmentGeometry in
+# frame.attrs["geometry"] (row i is segment i), not just the first point in lat/lng.
+# streaming=True (default) parses the body straight into typed columns, see stream_parser.py
+def fetch_flow_data(bounding_box, full_geometry=False, streaming=True):
     endpoint = "flow"
     params = {
-        "apiKey": API_KEY,
         "in": "bbox:"+bounding_box, # location box
         "locationReferencing": "shape",
     }
-    all_data = []
-
-    # print(params)
-    response = requests.get(base_url + endpoint, params=params)
-    print(f"Fetching {endpoint} data: {response.status_code}")
-    # print(response.json())
-    if response.status_code == 200:
-        response_json = response.json()
+    # raises HereApiError once retries are used up instead of returning an empty frame
+    if streaming:
+        parse = parse_flow_stream_with_geometry if full_geometry else parse_flow_stream
+    else:
+        parse = parse_flow_with_geometry if full_geometry else parse_flow_response
+    traffic_data = get_client().fetch(endpoint, params, parse, raw=streaming)
+    print("flow data fetched, passing...")
+    return traffic_data
 
-        for result in response_json.get("results", []):
-            # get location and FLOW!
-            location = result.get("location", {})
-            current_flow = result.get("currentFlow", {})
-            shape = location.get("shape", {}).get("links", [{}])
+def parse_flow_response(response_json, full_geometry=False):
+    endpoint = "flow"
+    all_data = []
+    results = response_json.get("results", [])
+    for result in results:
+        # get location and FLOW!
+        location = result.get("location", {})
+        current_flow = result.get("currentFlow", {})
+        shape = location.get("shape", {}).get("links", [{}])
 
-            # add to entry (row)
-            traffic_entry = {
-                "type": endpoint,
-                "description": location.get("description", "Unknown Location"),
-                "length": location.get("length", 0),
-                "speed": current_flow.get("speed", 0),
-                "free_flow_speed": current_flow.get("freeFlow", 0),
-                "jam_factor": current_flow.get("jamFactor", 0),
-                "lat": shape[0].get("points", [{}])[0].get("lat", 0) if shape else 0,
-                "lng": shape[0].get("points", [{}])[0].get("lng", 0) if shape else 0,
-                "time_updated": response_json.get("sourceUpdated", "Unknown Time"),
-            }
+        # add to entry (row)
+        traffic_entry = {
+            "type": endpoint,
+            "description": location.get("description", "Unknown Location"),
+            "length": location.get("length", 0),
+            "speed": current_flow.get("speed", 0),
+            "free_flow_speed": current_flow.get("freeFlow", 0),
+            "jam_factor": current_flow.get("jamFactor", 0),
+            "lat": shape[0].get("points", [{}])[0].get("lat", 0) if shape else 0,
+            "lng": shape[0].get("points", [{}])[0].get("lng", 0) if shape else 0,
+            "time_updated": response_json.get("sourceUpdated", "Unknown Time"),
+        }
 
-            all_data.append(traffic_entry)
-    else:
-        print(f"Failed to fetch {endpoint} data: {response.status_code}")
-        print(response.text)
-    print("flow data fetched, passing...")
-    return pd.DataFrame(all_data)
+        all_data.append(traffic_entry)
+    traffic_data = pd.DataFrame(all_data)
+    if full_geometry:
+        traffic_data.attrs["geometry"] = SegmentGeometry.from_results(results)
+    return traffic_data
 
-def fetch_incident_data(bounding_box):
-    base_url = "https://data.traffic.hereapi.com/v7/"
+def fetch_incident_data(bounding_box, full_geometry=False, streaming=True):
     endpoint = "incidents"
     params = {
-        "apiKey": API_KEY,
         "in": "bbox:" + bounding_box,  # location box
         "locationReferencing": "shape",
     }
+    if streaming:
+        parse = parse_incident_stream_with_geometry if full_geometry else parse_incident_body
+    else:
+        parse = parse_incident_with_geometry if full_geometry else parse_incident_response
+    incident_data = get_client().fetch(endpoint, params, parse, raw=streaming)
+    print("incident data fetched, passing...")
+    return incident_data
+
+def parse_incident_response(response_json, full_geometry=False):
+    endpoint = "incidents"
     all_data = []
-    current_time = datetime.utcnow().replace(tzinfo=timezone.utc)
-    cutoff_time = current_time - timedelta(hours=24)
+    results = response_json.get("results", [])
 
-    response = requests.get(base_url + endpoint, params=params)
-    print(f"Fetching {endpoint} data: {response.status_code}")
-    if response.status_code == 200:
-        response_json = response.json()
+    for result in results:
+        location = result.get("location", {})
+        incident_details = result.get("incidentDetails", {})
+        shape = location.get("shape", {}).get("links", [{}])
 
-        for result in response_json.get("results", []):
-            location = result.get("location", {})
-            incident_details = result.get("incidentDetails", {})
-            shape = location.get("shape", {}).get("links", [{}])
+        incident_entry = {
+            "type": endpoint,
+            "description": incident_details.get("description", {}).get("value", "Unknown Incident"),
+            "criticality": incident_details.get("criticality", "Unknown"),
+            "incident_type": incident_details.get("type", "Unknown"),
+            "start_time": incident_details.get("startTime", "1970-01-01T00:00:00Z"),
+            "end_time": incident_details.get("endTime", "1970-01-01T00:00:00Z"),
+            "road_closed": incident_details.get("roadClosed", False),
+            "lat": shape[0].get("points", [{}])[0].get("lat", 0) if shape else 0,
+            "lng": shape[0].get("points", [{}])[0].get("lng", 0) if shape else 0,
+        }
+        all_data.append(incident_entry)
+    incident_data = pd.DataFrame(all_data)
+    if incident_data.empty:
+        return incident_data
 
-            # fix goofy timestamps
-            start_time_str = incident_details.get("startTime", "1970-01-01T00:00:00Z")
-            end_time_str = incident_details.get("endTime", "1970-01-01T00:00:00Z")
-            start_time = datetime.fromisoformat(start_time_str.replace("Z", "+00:00"))
-            end_time = datetime.fromisoformat(end_time_str.replace("Z", "+00:00"))
-            
-            # include cutoff for load time purposes
-            if end_time >= cutoff_time or start_time >= cutoff_time:
-                incident_entry = {
-                    "type": endpoint,
-                    "description": incident_details.get("description", {}).get("value", "Unknown Incident"),
-                    "criticality": incident_details.get("criticality", "Unknown"),
-                    "incident_type": incident_details.get("type", "Unknown"),
-                    "start_time": start_time,
-                    "end_time": end_time,
-                    "road_closed": incident_details.get("roadClosed", False),
-                    "lat": shape[0].get("points", [{}])[0].get("lat", 0) if shape else 0,
-                    "lng": shape[0].get("points", [{}])[0].get("lng", 0) if shape else 0,
-                }
+    # timestamps parsed in one go, then the cutoff for load time purposes
+    incident_data["start_time"] = pd.to_datetime(incident_data["start_time"], utc=True, format="ISO8601")
+    incident_data["end_time"] = pd.to_datetime(incident_data["end_time"], utc=True, format="ISO8601")
+    cutoff_time = incident_cutoff()
+    keep = ((incident_data["end_time"] >= cutoff_time) | (incident_data["start_time"] >= cutoff_time)).to_numpy()
+    incident_data = incident_data[keep].reset_index(drop=True)
+    if full_geometry:
+        incident_data.attrs["geometry"] = SegmentGeometry.from_results(results).take(keep)
+    return incident_data
 
-                all_data.append(incident_entry)
-    else:
-        print(f"Failed to fetch {endpoint} data: {response.status_code}")
-        print(response.text)
-    print("incident data fetched, passing...")
-    return pd.DataFrame(all_data)
\ No newline at end of file
+def parse_incident_body(body, full_geometry=False):
+    return parse_incident_stream(body, full_geometry=full_geometry, cutoff_time=incident_cutoff())
+
+def incident_cutoff():
+    return datetime.now(timezone.utc) - timedelta(hours=INCIDENT_HOURS)
+
+# made once so the client's revalidation cache sees the same parser every time
+parse_flow_with_geometry = partial(parse_flow_response, full_geometry=True)
+parse_incident_with_geometry = partial(parse_incident_response, full_geometry=True)
+parse_flow_stream_with_geometry = partial(parse_flow_stream, full_geometry=True)
+parse_incident_stream_with_geometry = partial(parse_incident_body, full_geometry=True)
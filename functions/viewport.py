@@ -0,0 +1,267 @@
+import json
+import threading
+from concurrent.futures import Future
+import numpy as np
+import pandas as pd
+from map_layers import encode_points
+
+# points for the part of the map the browser is looking at, instead of every point in the bbox.
+# a PointPyramid is built once per snapshot: points sorted along a z-order curve so that every
+# grid cell at every zoom level is one contiguous run of points, and per level the cells with
+# their count / mean value / center. a pan or zoom then only looks up the cells in view:
+# - zoomed out (too many points in view) it answers with the cells as bins
+# - zoomed in it answers with the points themselves
+# bins are BIN_PX screen pixels wide at their zoom level (web mercator, 256px tiles)
+
+BIN_PX = 32
+MIN_ZOOM = 5
+MAX_ZOOM = 16  # finest bin level, deeper zooms use its cells to find the points
+MAX_POINTS = 3000  # more than this in view and it sends bins
+HEAT_DETAIL = 2  # heat cells are this many levels finer than the map zoom (8px)
+
+
+def world_xy(lat, lng):
+    # web mercator position as a fraction of the world, 0..1 from the top left
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -85.05, 85.05))
+    x = (np.asarray(lng, dtype=float) + 180) / 360
+    y = 0.5 - np.log(np.tan(np.pi / 4 + lat / 2)) / (2 * np.pi)
+    return np.clip(x, 0, 1 - 1e-12), np.clip(y, 0, 1 - 1e-12)
+
+
+def cells_per_side(zoom):
+    return 2 ** zoom * 256 // BIN_PX
+
+
+def _spread_bits(v):
+    # 0b1011 -> 0b01000101, for interleaving x and y into a z-order code
+    v = v.astype(np.uint64)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+class PointPyramid:
+    def __init__(self, lat, lng, values=None, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        lat = np.asarray(lat, dtype=float)
+        lng = np.asarray(lng, dtype=float)
+        x, y = world_xy(lat, lng)
+        side = cells_per_side(max_zoom)
+        cx = (x * side).astype(np.int64)
+        cy = (y * side).astype(np.int64)
+        codes = _spread_bits(cx) | (_spread_bits(cy) << np.uint64(1))
+        self.order = np.argsort(codes, kind="stable")  # position in the curve -> row in the data
+        codes = codes[self.order]
+        self.lat = lat[self.order]
+        self.lng = lng[self.order]
+        self.values = None if values is None else np.asarray(values, dtype=float)[self.order]
+        cx, cy = cx[self.order], cy[self.order]
+        self.levels = {zoom: self._level(codes, cx, cy, max_zoom - zoom) for zoom in range(min_zoom, max_zoom + 1)}
+
+    def _level(self, codes, cx, cy, shift):
+        # cells at one zoom level, in row-major order for the viewport lookup
+        cell_codes = codes >> np.uint64(2 * shift)
+        starts = np.flatnonzero(np.r_[True, cell_codes[1:] != cell_codes[:-1]]) if len(codes) else np.array([], dtype=int)
+        ends = np.r_[starts[1:], len(codes)]
+        counts = ends - starts
+        x = cx[starts] >> shift
+        y = cy[starts] >> shift
+        row_major = np.lexsort((x, y))
+        side = cells_per_side(self.max_zoom - shift)
+        level = {
+            "side": side,
+            "key": (y * side + x)[row_major],
+            "start": starts[row_major],
+            "end": ends[row_major],
+            "count": counts[row_major],
+            "lat": (np.add.reduceat(self.lat, starts) / counts)[row_major] if len(starts) else np.array([]),
+            "lng": (np.add.reduceat(self.lng, starts) / counts)[row_major] if len(starts) else np.array([]),
+            "value": None,
+            "sum": None,
+        }
+        if self.values is not None and len(starts):
+            # nan values (missing jam factor) don't count towards the mean
+            valid = ~np.isnan(self.values)
+            sums = np.add.reduceat(np.where(valid, self.values, 0), starts)
+            valid_counts = np.add.reduceat(valid.astype(np.int64), starts)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                level["value"] = (sums / valid_counts)[row_major]
+            level["sum"] = sums[row_major]
+        return level
+
+    def cells_in_view(self, level, west, south, east, north):
+        if west > east or south > north:
+            return np.array([], dtype=np.int64)
+        side = level["side"]
+        (x0, x1), (y1, y0) = [((v * side).astype(np.int64)) for v in world_xy([south, north], [west, east])]
+        rows = np.arange(y0, y1 + 1)
+        lo = np.searchsorted(level["key"], rows * side + x0)
+        hi = np.searchsorted(level["key"], rows * side + x1, side="right")
+        sizes = hi - lo
+        # concatenated ranges lo[i]..hi[i]
+        return np.repeat(lo - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+
+    def query(self, west, south, east, north, zoom, max_points=MAX_POINTS):
+        # ("bins", {lat, lng, count, value}) or ("points", data row numbers)
+        zoom = int(min(max(np.floor(zoom), self.min_zoom), self.max_zoom + 1))
+        level = self.levels[min(zoom, self.max_zoom)]
+        cells = self.cells_in_view(level, west, south, east, north)
+        in_view = int(level["count"][cells].sum())
+
+        if zoom > self.max_zoom or in_view <= max_points:
+            starts, ends = level["start"][cells], level["end"][cells]
+            sizes = ends - starts
+            positions = np.repeat(starts - np.cumsum(sizes) + sizes, sizes) + np.arange(sizes.sum())
+            lat, lng = self.lat[positions], self.lng[positions]
+            positions = positions[(lat >= south) & (lat <= north) & (lng >= west) & (lng <= east)]
+            if len(positions) > max_points:
+                positions = positions[np.linspace(0, len(positions) - 1, max_points).astype(int)]
+            return "points", self.order[positions]
+
+        bins = {key: level[key][cells] for key in ("lat", "lng", "count")}
+        bins["value"] = None if level["value"] is None else level["value"][cells]
+        return "bins", bins
+
+
+class ViewportSource:
+    # one map layer's data: the pyramid plus how its points and bins are drawn.
+    # colors is a series of point colors, popups builds the popups for a slice of data,
+    # bin_colors maps the bins' mean values to colors
+    def __init__(self, data, colors, popups=None, value_column=None, label="points", bin_colors=None,
+                 max_points=MAX_POINTS):
+        self.data = data
+        self.colors = np.asarray(colors, dtype=object)
+        self.popups = popups
+        self.value_column = value_column
+        self.label = label
+        self.bin_colors = bin_colors
+        self.max_points = max_points
+        values = data[value_column] if value_column else None
+        self.pyramid = PointPyramid(data['lat'], data['lng'], values)
+
+    def query(self, west, south, east, north, zoom):
+        # json for the ViewportPointLayer in map_layers.py
+        kind, result = self.pyramid.query(west, south, east, north, zoom, self.max_points)
+        if kind == "points":
+            subset = self.data.iloc[result]
+            popups = self.popups(subset) if self.popups else None
+            return encode_points(subset['lat'], subset['lng'], self.colors[result], popups)
+
+        counts, values = result["count"], result["value"]
+        popups = pd.Series(counts).astype(str) + f" {self.label}"
+        if values is not None:
+            popups = popups + "<br><b>Mean " + self.value_column.replace("_", " ") + ":</b> " + \
+                pd.Series(values).map("{:.1f}".format)
+        colors = self.bin_colors(values) if self.bin_colors else ["blue"] * len(counts)
+        radius = np.minimum(4 + 2 * np.log2(np.maximum(counts, 1)), 18).round(1)
+        return encode_points(result["lat"], result["lng"], colors, popups, radius=radius)
+
+
+class HeatSource:
+    # intensity grid for a heatmap: the pyramid's per cell sum of weights, a little finer than
+    # the map zoom so the browser's blur still looks smooth. mask (e.g. dbscan label != -1)
+    # zeroes points out instead of filtering the frame, so every variant shares the same arrays
+    def __init__(self, lat, lng, weights, mask=None):
+        weights = np.nan_to_num(np.clip(np.asarray(weights, dtype=float), 0, None))
+        if mask is not None:
+            weights = np.where(mask, weights, 0)
+        self.pyramid = PointPyramid(lat, lng, weights)
+
+    def query(self, west, south, east, north, zoom):
+        # json for the ViewportHeatLayer in map_layers.py, padded so the blur at the edges
+        # still has its neighbours
+        pyramid = self.pyramid
+        pad_x, pad_y = (east - west) * 0.15, (north - south) * 0.15
+        level = pyramid.levels[int(min(max(np.floor(zoom) + HEAT_DETAIL, pyramid.min_zoom), pyramid.max_zoom))]
+        cells = pyramid.cells_in_view(level, west - pad_x, south - pad_y, east + pad_x, north + pad_y)
+        cells = cells[level["sum"][cells] > 0] if level["sum"] is not None else cells[:0]
+        return json.dumps({
+            "lat": np.round(level["lat"][cells], 6).tolist(),
+            "lng": np.round(level["lng"][cells], 6).tolist(),
+            "weight": np.round(level["sum"][cells], 2).tolist(),
+        }, separators=(",", ":"))
+
+
+# sources register here by name (one per page), resolve(layer, hours) returns the ViewportSource
+# for the current snapshot or None. map_server answers /maps/points/<name>/<layer>.json from it.
+# hours (or None) is a time relative to the snapshot for sources that filter by time.
+# layers are the ones the source knows, anything else is answered empty
+_resolvers = {}
+_layers = {}
+_built = {}  # (name, layer) -> (version, future of the source)
+_lock = threading.Lock()
+
+
+def register_viewport_source(name, resolve, layers):
+    _resolvers[name] = resolve
+    _layers[name] = set(layers)
+
+
+def get_viewport_source(name, layer, hours=None):
+    if not known_layer(name, layer):
+        return None
+    return _resolvers[name](layer, hours)
+
+
+def known_layer(name, layer):
+    # the url is made up by the client, only registered names / layers go into metrics labels
+    return layer in _layers.get(name, ())
+
+
+def cached_source(name, layer, version, build):
+    # built once per snapshot and layer, the first pan after a refresh pays for it.
+    # requests for a layer that is being built wait for that build, other layers don't
+    key = (name, layer)
+    owner = False
+    with _lock:
+        cached = _built.get(key)
+        if cached is None or cached[0] != version:
+            cached = _built[key] = (version, Future())
+            owner = True
+    future = cached[1]
+    if not owner:
+        return future.result()
+
+    try:
+        source = build()
+    except Exception as e:
+        with _lock:
+            if _built.get(key) is cached:
+                del _built[key]
+        future.set_exception(e)
+        raise
+    future.set_result(source)
+    return source
+
+
+def parse_view(args):
+    # west, south, east, north, zoom from the query string, None if any are missing or bad
+    try:
+        view = [float(args[key]) for key in ("west", "south", "east", "north", "zoom")]
+    except (KeyError, ValueError):
+        return None
+    view[0], view[2] = max(view[0], -180.0), min(view[2], 180.0)  # leaflet wraps past the antimeridian
+    return view if all(np.isfinite(view)) else None
+
+
+def empty_view(view):
+    # reversed bounds (or a view entirely past the antimeridian after clamping) contain nothing
+    west, south, east, north = view[:4]
+    return west > east or south > north
+
+
+def parse_hours(args, limit=48):
+    # whole hours relative to the snapshot from ?hours=, None if missing or bad
+    try:
+        hours = int(args["hours"])
+    except (KeyError, ValueError):
+        return None
+    return min(max(hours, -limit), limit)
+
+
+def points_json(source, view):
+    if source is None or empty_view(view):
+        return json.dumps({"lat": [], "lng": [], "color": [], "palette": [], "weight": []})
+    return source.query(*view)
@@ -1,32 +1,40 @@
 import dash
-from dash import html, dcc, Input, Output
-import pandas as pd
-from sklearn.cluster import KMeans, DBSCAN
+from dash import html, dcc, Input, Output, State, ClientsideFunction
+import numpy as np
 import folium
-from folium.plugins import HeatMap
 import sys
 import os
+from functools import partial
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 module_dir = os.path.join(current_dir, '../', 'functions')
 sys.path.append(module_dir)
 from traffic_fetcher import fetch_flow_data 
+from map_layers import add_client_layer, add_viewport_heatmap, add_viewport_layer, build_popups, jam_colors, stable_ids
+from viewport import HeatSource, ViewportSource, cached_source, register_viewport_source
+from refresher import SnapshotRefresher
+from tiling import TiledFetcher
+from history_store import get_history_store, segment_ids
+from clustering_pipeline import ClusterPipeline, flow_features
+from map_cache import map_cache
+from snapshot_cache import warm_start
+from snapshot_share import share_snapshots
+from client_store import ClientStore, snapshot_token
+from regions import RegionFeeds, all_regions, build_slots, feed_name, get_region
 
-dash.register_page(__name__, path="/flow")
+# /flow is the default region, /flow/<region> any other one from regions.py
+dash.register_page(__name__, path="/flow", path_template="/flow/<region>")
 print('\n\n@@ start flow page @@')
 
-# fetch traffic data
-bounding_box = "13.08836,52.33812,13.761,52.6755"  # berlin germany (HERE api most data i think)
-traffic_data = fetch_flow_data(bounding_box)
+full_geometry = os.getenv("FULL_GEOMETRY", "0") == "1"  # place points half way along the road
+# dbscan on real distances, eps in meters (the old 0.01 degrees was ~1.1km north-south, ~0.7km east-west)
+dbscan_eps_m = float(os.getenv("FLOW_DBSCAN_EPS_M", 1000))
 
-if not traffic_data.empty:
-    # k means on the location and jam factor
-    kmeans = KMeans(n_clusters=3, random_state=0)
-    traffic_data['kmeans_cluster'] = kmeans.fit_predict(traffic_data[['lat', 'lng', 'jam_factor']])
-
-    # dbscan to eliminate noise/enhance
-    dbscan = DBSCAN(eps=0.01, min_samples=5).fit(traffic_data[['lat', 'lng']])
-    traffic_data['dbscan_cluster'] = dbscan.labels_
+def cluster_flow_data(traffic_data, pipeline=None):
+    # k means on the location and jam factor, dbscan on location to eliminate noise/enhance.
+    # both carry over from the last refresh so cluster ids (and colors) stay put.
+    # runs in a clustering worker process. pipeline is the region's, default region's if None
+    result = (pipeline or flow_pipeline).run(traffic_data, segment_ids(traffic_data))
 
     noise_count = (traffic_data['dbscan_cluster'] == -1).sum()
     cluster_count = traffic_data['dbscan_cluster'].nunique() - (1 if -1 in traffic_data['dbscan_cluster'].unique() else 0)
@@ -35,173 +43,296 @@ if not traffic_data.empty:
     print(f" - Total Points: {len(traffic_data)}")
     print(f" - Noise Points: {noise_count}")
     print(f" - Clusters Formed: {cluster_count}")
+    return result["colors"]
 
-    # average the jam for the clusters
-    kmeans_avg_jam_factors = traffic_data.groupby('kmeans_cluster')['jam_factor'].mean().sort_values()
-
-    # k means to color the clusters
-    kmeans_sorted_clusters = kmeans_avg_jam_factors.index.tolist()
-    kmeans_cluster_colors = {kmeans_sorted_clusters[0]: 'green',  # lowest jam factor
-                              kmeans_sorted_clusters[1]: 'orange',  # medium jam factor
-                              kmeans_sorted_clusters[2]: 'red'}     # highest jam factor
-
-    def create_clustered_dot_map(data, show_gray=True):
-        # filter noise
-        if not show_gray:
-            data = data[data['dbscan_cluster'] != -1]  # data without the noise
-
-        m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
-        
-        for _, row in data.iterrows():
-            # kmeans color or noise/gray, default blue if error
-            color = 'gray' if row['dbscan_cluster'] == -1 else kmeans_cluster_colors.get(row['kmeans_cluster'], 'blue')
-            popup_content = (
-                f"<b>Location:</b> {row['description']}<br>"
-                f"<b>Speed:</b> {row['speed']} km/h<br>"
-                f"<b>Jam Factor:</b> {row['jam_factor']}<br>"
-                f"<b>KMeans Cluster:</b> {row['kmeans_cluster']}<br>"
-                f"<b>DBSCAN Cluster:</b> {row['dbscan_cluster']}"
-            )
-            popup = folium.Popup(popup_content, max_width=400, min_width=200)
-
-            folium.CircleMarker(
-                location=[row['lat'], row['lng']],
-                radius=5,
-                color=color,
-                fill=True,
-                fill_opacity=0.7,
-                popup=popup
-            ).add_to(m)
-        return m._repr_html_()
-
-    def create_clustered_heatmap(data):
-        clustered_data = data[data['dbscan_cluster'] != -1]  # Exclude noise (-1 cluster)
-        m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
-        heat_data = [
-            [row['lat'], row['lng'], row['jam_factor']]
-            for _, row in clustered_data.iterrows()
-            if row['jam_factor'] > 0
-        ]
-        HeatMap(heat_data, min_opacity=0.5, radius=15, blur=10).add_to(m)
-        return m._repr_html_()
-
-    def create_dot_map(data):
-        m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
-        for _, row in data.iterrows():
-            popup_content = (
-                f"<b>Location:</b> {row['description']}<br>"
-                f"<b>Speed:</b> {row['speed']} km/h<br>"
-                f"<b>Free Flow Speed:</b> {row['free_flow_speed']} km/h<br>"
-                f"<b>Jam Factor:</b> {row['jam_factor']}"
+# dot maps don't carry their points, the map asks /maps/points/<feed>/<layer>.json for the ones
+# in view (see viewport.py) so zoomed out it only draws bins
+def create_viewport_dot_map(region, layer):
+    m = folium.Map(location=region.center, zoom_start=region.zoom)
+    add_viewport_layer(m, f"points/{feed_name('flow', region)}/{layer}.json")
+    return stable_ids(m.get_root().render())
+
+def clustered_dot_popups(data):
+    return build_popups(data, [
+        ("Location", 'description', ""),
+        ("Speed", 'speed', " km/h"),
+        ("Jam Factor", 'jam_factor', ""),
+        ("KMeans Cluster", 'kmeans_cluster', ""),
+        ("DBSCAN Cluster", 'dbscan_cluster', ""),
+    ])
+
+def dot_popups(data):
+    return build_popups(data, [
+        ("Location", 'description', ""),
+        ("Speed", 'speed', " km/h"),
+        ("Free Flow Speed", 'free_flow_speed', " km/h"),
+        ("Jam Factor", 'jam_factor', ""),
+    ])
+
+def build_flow_source(snapshot, layer):
+    data = snapshot["data"]
+    if layer == "heatmap":
+        return HeatSource(data['lat'], data['lng'], data['jam_factor'])
+    if layer == "clustered_heatmap":
+        # exclude noise (-1 cluster) with a mask on the labels
+        return HeatSource(data['lat'], data['lng'], data['jam_factor'], mask=data['dbscan_cluster'].to_numpy() != -1)
+    if layer == "dot":
+        colors = np.full(len(data), 'blue')
+        return ViewportSource(data, colors, dot_popups, 'jam_factor', "segments", jam_colors)
+
+    # filter noise
+    if layer != "clustered_dot-gray":
+        data = data[data['dbscan_cluster'] != -1]  # data without the noise
+
+    # kmeans color or noise/gray, default blue if error
+    colors = data['kmeans_cluster'].map(snapshot["kmeans_cluster_colors"]).fillna('blue')
+    colors = colors.where(data['dbscan_cluster'] != -1, 'gray')
+    return ViewportSource(data, colors, clustered_dot_popups, 'jam_factor', "segments", jam_colors)
+
+flow_layers = ("clustered_dot", "clustered_dot-gray", "dot", "clustered_heatmap", "heatmap")
+
+def flow_viewport_source(feed, layer, hours=None):
+    # flow has no time filter, hours is ignored
+    snapshot = feed["refresher"].current()
+    if snapshot is None or snapshot["data"].empty or layer not in flow_layers:
+        return None
+    return cached_source(feed["name"], layer, snapshot["version"], lambda: build_flow_source(snapshot, layer))
+
+# heatmaps come from a per snapshot intensity grid too (viewport.HeatSource), the map asks
+# /maps/points/<feed>/<heatmap layer>.json for the cells in view
+def create_viewport_heatmap(region, layer):
+    m = folium.Map(location=region.center, zoom_start=region.zoom)
+    add_viewport_heatmap(m, f"points/{feed_name('flow', region)}/{layer}.json", min_opacity=0.5, radius=15, blur=10)
+    return stable_ids(m.get_root().render())
+
+# keep every fetch on disk for looking back over time, see history_store.py
+def save_history(traffic_data, bounding_box):
+    history = get_history_store()
+    if history is None:
+        return
+    try:
+        history.append_flow(traffic_data, bounding_box)
+    except Exception as e:
+        # a bad row (a time that does not parse...) loses this fetch's history, not the snapshot
+        print(f"@ could not save history: {e!r} @")
+
+# fetch and cluster one snapshot, runs on the refresher thread. maps are rendered
+# later, on first request, through the shared map cache
+def build_flow_snapshot(feed):
+    region = feed["region"]
+    traffic_data = feed["fetcher"].fetch(region.bounding_box)
+    source_updated = traffic_data.attrs.get("source_updated")  # names the on disk copy, see snapshot_cache.py
+    if "geometry" in traffic_data.attrs:
+        traffic_data['lat'], traffic_data['lng'] = traffic_data.attrs["geometry"].midpoints()
+    save_history(traffic_data, region.bounding_box)
+    if traffic_data.empty:
+        return {"data": traffic_data, "source_updated": source_updated, "region": region.name}
+    kmeans_cluster_colors = cluster_flow_data(traffic_data, feed["pipeline"])
+    return {"data": traffic_data, "kmeans_cluster_colors": kmeans_cluster_colors, "source_updated": source_updated,
+            "region": region.name}
+
+def render_flow_map(snapshot, selected_view, show_gray):
+    traffic_data = snapshot["data"]
+    if traffic_data.empty:
+        # no traffic data
+        return {
+            "clustered_dot": "<h3>No clustered dot map data available.</h3>",
+            "clustered_heatmap": "<h3>No clustered heatmap data available.</h3>",
+            "dot": "<h3>No dot map data available.</h3>",
+            "heatmap": "<h3>No heatmap data available.</h3>",
+        }[selected_view]
+
+    region = get_region(snapshot.get("region"))
+    print(f'@ rendering flow map {selected_view} for {region.name} @')
+    if selected_view == "clustered_dot":
+        return create_viewport_dot_map(region, "clustered_dot-gray" if show_gray else "clustered_dot")
+    elif selected_view == "dot":
+        return create_viewport_dot_map(region, "dot")
+    return create_viewport_heatmap(region, selected_view)
+
+# up to client_points_max segments the page keeps every point in the browser (client_store.py)
+# and switches views, hides noise and recolors there, refreshes only send the rows that changed.
+# bigger snapshots are left on the server and the browser switches between the rendered maps
+client_points_max = int(os.getenv("CLIENT_POINTS_MAX", 20000))
+client_poll_seconds = 10  # how often an open page asks for a newer snapshot
+flow_client_columns = [
+    ("lat", "lat", 1e6), ("lng", "lng", 1e6),
+    ("jam", "jam_factor", 10), ("speed", "speed", 10), ("free_flow", "free_flow_speed", 10),
+    ("kmeans", "kmeans_cluster", 1), ("dbscan", "dbscan_cluster", 1),
+    ("description", "description", None),
+]
+# how assets/client_maps.js and map_layers.ClientPointLayer draw each view, popups are
+# (label, column, suffix) like build_popups
+flow_client_views = {
+    "clustered_dot": {"kind": "dot", "color": "kmeans", "palette": "kmeans", "noise": "dbscan", "toggle": True, "popup": [
+        ["Location", "description", ""], ["Speed", "speed", " km/h"], ["Jam Factor", "jam", ""],
+        ["KMeans Cluster", "kmeans", ""], ["DBSCAN Cluster", "dbscan", ""],
+    ]},
+    "dot": {"kind": "dot", "popup": [
+        ["Location", "description", ""], ["Speed", "speed", " km/h"], ["Free Flow Speed", "free_flow", " km/h"],
+        ["Jam Factor", "jam", ""],
+    ]},
+    "clustered_heatmap": {"kind": "heat", "weight": "jam", "noise": "dbscan"},
+    "heatmap": {"kind": "heat", "weight": "jam"},
+}
+
+def create_client_map(region):
+    m = folium.Map(location=region.center, zoom_start=region.zoom)
+    add_client_layer(m, feed_name("flow", region))
+    return stable_ids(m.get_root().render())
+
+def flow_store_update(feed, snapshot, client_version):
+    # what the browser at client_version needs for snapshot, see assets/client_maps.js
+    token = snapshot_token(snapshot)
+    data = snapshot["data"]
+    if data.empty or len(data) > client_points_max:
+        maps = {}
+        for view, show_gray in flow_views:
+            rendered = map_cache.get_or_render(
+                (feed["name"], view, show_gray, snapshot["version"]),
+                lambda: render_flow_map(snapshot, view, show_gray),
             )
-            popup = folium.Popup(popup_content, max_width=400, min_width=200)
-
-            folium.CircleMarker(
-                location=[row['lat'], row['lng']],
-                radius=5,
-                color='blue',
-                fill=True,
-                fill_opacity=0.7,
-                popup=popup
-            ).add_to(m)
-        return m._repr_html_()
-
-    def create_heatmap(data):
-        m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
-        heat_data = [
-            [row['lat'], row['lng'], row['jam_factor']]
-            for _, row in data.iterrows()
-            if row['jam_factor'] > 0
-        ]
-        HeatMap(heat_data, min_opacity=0.5, radius=15, blur=10).add_to(m)
-        return m._repr_html_()
-
-    # preload maps for speedy rendering
-    print('@ preloading maps @')
-    preloaded_maps = {
-        "clustered_dot_with_gray": create_clustered_dot_map(traffic_data, show_gray=True),  # w/ noise
-        "clustered_dot_without_gray": create_clustered_dot_map(traffic_data, show_gray=False),  # w/o
-        "clustered_heatmap": create_clustered_heatmap(traffic_data),  
-        "dot": create_dot_map(traffic_data),  
-        "heatmap": create_heatmap(traffic_data),  
-    }   
-    print('@ preloading complete @')
-else:
-    # no traffic data
-    preloaded_maps = {
-        "clustered_dot": "<h3>No clustered dot map data available.</h3>",
-        "clustered_heatmap": "<h3>No clustered heatmap data available.</h3>",
-        "dot": "<h3>No dot map data available.</h3>",
-        "heatmap": "<h3>No heatmap data available.</h3>",
-    }
+            maps[view + "-gray" if show_gray else view] = dash.get_relative_path(rendered.url)
+        return {"mode": "maps", "version": token, "maps": maps, "views": flow_client_views,
+                "no_view": dash.get_relative_path(no_view_page.url)}
+    update = dict(feed["store"].payload(token, data, client_version))
+    update.update(
+        mode="points", page=feed["name"], views=flow_client_views,
+        map=dash.get_relative_path(feed["client_map"].url), no_view=dash.get_relative_path(no_view_page.url),
+        palettes={"kmeans": {str(cluster): color for cluster, color in snapshot["kmeans_cluster_colors"].items()}},
+    )
+    return update
+
+flow_views = [("clustered_dot", False), ("clustered_dot", True), ("dot", False), ("clustered_heatmap", False), ("heatmap", False)]
+
+def start_flow_feed(region):
+    # everything one region needs, see regions.py. the names (refresher, pipeline, cache and
+    # share folders, viewport source) are the feed name, so regions never mix
+    name = feed_name("flow", region)
+    feed = {"region": region, "name": name, "store": ClientStore(flow_client_columns, segment_ids)}
+    # the bbox is fetched as concurrent tiles, border segments are dropped by their first point
+    feed["fetcher"] = TiledFetcher(partial(fetch_flow_data, full_geometry=full_geometry), dedupe_on=["description", "length", "lat", "lng"])
+    # kmeans clusters are colored by their average jam, lowest green
+    feed["pipeline"] = ClusterPipeline(
+        name, flow_features,
+        params=dict(kmeans_columns=['lat', 'lng', 'jam_factor'], dbscan_columns=['lat', 'lng'], n_clusters=3,
+                    eps=dbscan_eps_m, min_samples=5, haversine=True),
+        color_by='jam_factor', colors=['green', 'orange', 'red'],
+    )
+    feed["client_map"] = map_cache.pin(create_client_map(region))
+    # first snapshot is built in the background too, the page serves a loading message until then.
+    # after a restart the last snapshot saved to disk is served straight away instead
+    feed["refresher"] = SnapshotRefresher(
+        name, partial(build_flow_snapshot, feed), region.flow_refresh_seconds,
+        warm_start=warm_start(name, region.bounding_box, flow_views),
+        share=share_snapshots(name, region.bounding_box, flow_views, render_flow_map),
+        slots=build_slots,
+    ).start()
+    register_viewport_source(name, partial(flow_viewport_source, feed), flow_layers)
+    return feed
+
+loading_page = map_cache.pin("<h3>Traffic flow data is still loading, try again shortly.</h3>")
+no_view_page = map_cache.pin("<h3>No data available for the selected view.</h3>")
+# the default region starts with the app, the others on their first request
+flow_feeds = RegionFeeds("flow", start_flow_feed)
+default_feed = flow_feeds.get(get_region())
+bounding_box = default_feed["region"].bounding_box
+flow_fetcher, flow_pipeline, flow_refresher = default_feed["fetcher"], default_feed["pipeline"], default_feed["refresher"]
 print("@@ flow load complete @@")
 
-layout = html.Div(
-    [
-        html.H1([
-            html.A(id='text-center my3', children='Data Mining Techniques Group 5', href="/", style={"text-decoration": "none", "color": "white"})
-        ], style={"text-decoration": "none"}),
-        html.Div(
-            dcc.Dropdown(
-                id="map-view-dropdown",
-                options=[
-                    {"label": "Clustered Dot Map", "value": "clustered_dot"},
-                    {"label": "Dot Map", "value": "dot"},
-                    {"label": "Clustered Heatmap", "value": "clustered_heatmap"},
-                    {"label": "Heatmap", "value": "heatmap"},
+def unknown_region_layout(region):
+    return html.Div([
+        html.H3(f"Unknown region: {region}"),
+        html.P(["Try ", *[html.A(r.name, href=f"/flow/{r.name}", style={"margin-right": "10px"}) for r in all_regions()]]),
+    ], style={"text-align": "center"})
+
+def layout(region=None, **kwargs):
+    # region comes from /flow/<region>, None on /flow
+    if get_region(region) is None:
+        return unknown_region_layout(region)
+    return html.Div(
+        [
+            html.H1([
+                html.A(id='text-center my3', children='Data Mining Techniques Group 5', href="/", style={"text-decoration": "none", "color": "white"})
+            ], style={"text-decoration": "none"}),
+            html.Div(
+                dcc.Dropdown(
+                    id="map-view-dropdown",
+                    options=[
+                        {"label": "Clustered Dot Map", "value": "clustered_dot"},
+                        {"label": "Dot Map", "value": "dot"},
+                        {"label": "Clustered Heatmap", "value": "clustered_heatmap"},
+                        {"label": "Heatmap", "value": "heatmap"},
+                    ],
+                    value="clustered_dot", 
+                    className="mb-3"
+                ),
+                style={"width": "50%", "margin": "auto"}
+            ),
+            html.Div(
+                id="map-container",
+                children=[
+                    html.Iframe(
+                        id="map-iframe",
+                        width="100%",
+                        height="700"
+                    )
                 ],
-                value="clustered_dot", 
-                className="mb-3"
+                style={"margin": "auto", "width": "95%", "height": "75%"}
             ),
-            style={"width": "50%", "margin": "auto"}
-        ),
-        html.Div(
-            id="map-container",
-            children=[
-                html.Iframe(
-                    id="map-iframe",
-                    srcDoc=preloaded_maps["clustered_dot_with_gray"],  # Default to clustered dot map with gray points
-                    width="100%",
-                    height="700"
-                )
-            ],
-            style={"margin": "auto", "width": "95%", "height": "75%"}
-        ),
-        html.Div(
-            id="gray-points-toggle-container",
-            children=[
-                dcc.Checklist(
-                    id="gray-points-toggle",
-                    options=[{"label": "Show Gray Points (Noise)", "value": "show_gray"}],
-                    value=[],  # default to not showing noise points
-                    style={"margin": "auto", "text-align": "center"}
-                )
-            ],
-            style={"display": "block"}  # show toggle for noise points
-        ),
-    ],
-)
+            html.Div(
+                id="gray-points-toggle-container",
+                children=[
+                    dcc.Checklist(
+                        id="gray-points-toggle",
+                        options=[{"label": "Show Gray Points (Noise)", "value": "show_gray"}],
+                        value=[],  # default to not showing noise points
+                        style={"margin": "auto", "text-align": "center"}
+                    )
+                ],
+                style={"display": "block"}  # show toggle for noise points
+            ),
+            # the snapshot as the browser has it: what the server sent last, the merged points and their version
+            dcc.Store(id="flow-store-update"),
+            dcc.Store(id="flow-points"),
+            dcc.Store(id="flow-version"),
+            dcc.Interval(id="flow-poll", interval=client_poll_seconds * 1000),
+            dcc.Store(id="flow-region", data=get_region(region).name),
+        ],
+    )
 
-# update map on selection
+# newer snapshot for the browser, nothing when it is up to date. the page asks on load and then
+# every client_poll_seconds, sending only the version it has
 @dash.callback(
-    [Output("map-iframe", "srcDoc"),
-     Output("gray-points-toggle-container", "style")],
-    [Input("map-view-dropdown", "value"), Input("gray-points-toggle", "value")]
+    Output("flow-store-update", "data"),
+    [Input("flow-poll", "n_intervals")],
+    [State("flow-version", "data"), State("flow-region", "data")]
+)
+def update_flow_store(_, client_version, region=None):
+    # the first request for a region starts its feed, see regions.RegionFeeds
+    region = get_region(region)
+    if region is None:
+        return dash.no_update
+    feed = flow_feeds.get(region)
+    snapshot = feed["refresher"].current()
+    if snapshot is None:
+        if client_version == "loading":
+            return dash.no_update
+        return {"mode": "loading", "version": "loading", "url": dash.get_relative_path(loading_page.url)}
+    if client_version == snapshot_token(snapshot):
+        return dash.no_update
+    return flow_store_update(feed, snapshot, client_version)
+
+dash.clientside_callback(
+    ClientsideFunction(namespace="traffic", function_name="merge"),
+    [Output("flow-points", "data"), Output("flow-version", "data")],
+    [Input("flow-store-update", "data")],
+    [State("flow-points", "data")]
+)
+
+# switching views and the noise toggle never leave the browser
+dash.clientside_callback(
+    ClientsideFunction(namespace="traffic", function_name="draw"),
+    [Output("map-iframe", "src"), Output("gray-points-toggle-container", "style")],
+    [Input("flow-points", "data"), Input("map-view-dropdown", "value"), Input("gray-points-toggle", "value")]
 )
-def update_map_view(selected_view, gray_toggle):
-    # show the noise points
-    show_gray = "show_gray" in gray_toggle
-    
-    if selected_view == "clustered_dot":
-        # show/hide noise points toggle
-        return (
-            preloaded_maps["clustered_dot_with_gray"] if show_gray else preloaded_maps["clustered_dot_without_gray"],
-            {"display": "block"}
-        )
-    elif selected_view == "clustered_heatmap":
-        return preloaded_maps["clustered_heatmap"], {"display": "none"} 
-    elif selected_view == "dot":
-        return preloaded_maps["dot"], {"display": "none"}
-    elif selected_view == "heatmap":
-        return preloaded_maps["heatmap"], {"display": "none"}  
-    return "<h3>No data available for the selected view.</h3>", {"display": "none"}
\ No newline at end of file
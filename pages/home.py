@@ -1,8 +1,25 @@
 import dash
 from dash import html
+import sys
+import os
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from regions import all_regions, default_region
 
 dash.register_page(__name__, path='/')
 
+# the other configured regions (see regions.py), the buttons above are the default one
+other_regions = [
+    html.P([
+        f"{region.name}: ",
+        html.A("flow", href=f"./flow/{region.name}"), " / ",
+        html.A("incidents", href=f"./incidents/{region.name}"),
+    ])
+    for region in all_regions() if region.name != default_region
+]
+
 layout = html.Div(className="home-header", children=[
     # html.H1([
     #     html.A(id='text-box', children='Data Mining Techniques Group 5', href="/")
@@ -22,6 +39,7 @@ layout = html.Div(className="home-header", children=[
             ])
         ]),
 
+        *other_regions,
         html.P("Use any of the navigation links to continue.")
     ])
     
@@ -1,189 +1,482 @@
 import dash
-from dash import html, dcc, Input, Output
+from dash import html, dcc, Input, Output, State, ClientsideFunction
 import pandas as pd
-from sklearn.cluster import KMeans, DBSCAN
-from sklearn.preprocessing import MinMaxScaler
+import numpy as np
 import folium
 import sys
 import os
+from functools import partial
 
 # Setup paths
 current_dir = os.path.dirname(os.path.abspath(__file__))
 module_dir = os.path.join(current_dir, '../', 'functions')
 sys.path.append(module_dir)
 from traffic_fetcher import fetch_incident_data
+from map_layers import add_client_layer, add_viewport_layer, build_popups, jam_colors, stable_ids
+from viewport import ViewportSource, cached_source, register_viewport_source
+from intervals import IntervalIndex, epoch_seconds
+from spatial_join import SegmentIndex, join_incidents
+from refresher import SnapshotRefresher, get_refresher, on_refresh
+from tiling import TiledFetcher
+from history_store import get_history_store, incident_ids
+from clustering_pipeline import ClusterPipeline, incident_features
+from map_cache import map_cache
+from snapshot_cache import warm_start
+from snapshot_share import share_snapshots
+from regions import RegionFeeds, all_regions, build_slots, feed_name, get_feeds, get_region
+from client_store import ClientStore, snapshot_token
 
-dash.register_page(__name__, path="/incidents")
+# /incidents is the default region, /incidents/<region> any other one from regions.py
+dash.register_page(__name__, path="/incidents", path_template="/incidents/<region>")
 print('\n\n@@ start incidents page @@')
 
-bounding_box = "13.08836,52.33812,13.761,52.6755"
-incident_data = fetch_incident_data(bounding_box)
-
-if not incident_data.empty:
-    # get and label criticality for clustering
-    if 'criticality' in incident_data.columns:
-        criticality_mapping = {"minor": 1, "moderate": 2, "major": 3}
-        incident_data['criticality_value'] = incident_data['criticality'].map(criticality_mapping).fillna(0)
-    else:
-        incident_data['criticality_value'] = 0  # default if missing (but shouldnt be)
-
-    # keep lat and long so it does not get modified
-    incident_data['original_lat'] = incident_data['lat']
-    incident_data['original_lng'] = incident_data['lng']
-
-    # normalize the values used in clustering
-    scaler = MinMaxScaler()
-    incident_data[['lat', 'lng', 'criticality_value']] = scaler.fit_transform(
-        incident_data[['lat', 'lng', 'criticality_value']]
-    )
+full_geometry = os.getenv("FULL_GEOMETRY", "0") == "1"  # place points half way along the road
+impact_radius_m = float(os.getenv("IMPACT_RADIUS_M", 200))  # flow segments this close count towards an incident's impact
+incident_columns = ['lat', 'lng', 'criticality_value']
 
-    # cluster w kmeans
-    kmeans = KMeans(n_clusters=3, random_state=0)
-    incident_data['kmeans_cluster'] = kmeans.fit_predict(
-        incident_data[['lat', 'lng', 'criticality_value']]
-    )
+def cluster_incident_data(incident_data, pipeline=None):
+    # criticality as a number, normalize the values used in clustering, then kmeans and dbscan
+    # for noise etc. the scaler and both models carry over from the last refresh.
+    # runs in a clustering worker process, lat / lng on incident_data are left as they are.
+    # pipeline is the region's, default region's if None
+    (pipeline or incident_pipeline).run(incident_data, incident_ids(incident_data))
+
+# the incident maps don't carry their points, the map asks /maps/points/<feed>/<layer>.json
+# for the ones in view (see viewport.py) so zoomed out it only draws bins
+def create_viewport_incident_map(region, layer):
+    m = folium.Map(location=region.center, zoom_start=region.zoom)
+    add_viewport_layer(m, f"points/{feed_name('incidents', region)}/{layer}.json")
+    return stable_ids(m.get_root().render())
+
+def combined_popups(data):
+    return build_popups(data, [
+        ("Location", 'description', ""),
+        ("Criticality", 'criticality', ""),
+        ("Type", 'incident_type', ""),
+        ("Start Time", 'start_time', ""),
+        ("End Time", 'end_time', ""),
+        ("KMeans Cluster", 'kmeans_cluster', ""),
+        ("DBSCAN Cluster", 'dbscan_cluster', ""),
+        ("Normalized Criticality", data['criticality_value'].map('{:.2f}'.format), ""),
+    ])
+
+def raw_popups(data):
+    return build_popups(data, [
+        ("Location", 'description', ""),
+        ("Criticality", 'criticality', ""),
+        ("Type", 'incident_type', ""),
+        ("Start Time", 'start_time', ""),
+        ("End Time", 'end_time', ""),
+    ])
+
+def active_rows(snapshot, hours):
+    # rows of the incidents active `hours` from the snapshot time, off the interval index
+    return np.sort(snapshot["intervals"].active_at(snapshot["built_at"] + hours * 3600))
+
+criticality_colors = {
+    "low": "green",
+    "minor": "yellow",
+    "major": "orange",
+    "critical": "red",
+}
+
+# clustered layer colored by criticality, raw layer without color or clustering to show difference.
+# with hours only the incidents active then, on the labels from the last clustering
+def build_incident_source(snapshot, layer, hours=None):
+    data = snapshot["data"]
+    if hours is not None:
+        data = data.iloc[active_rows(snapshot, hours)]
+    if layer == "raw":
+        return ViewportSource(data, np.full(len(data), 'blue'), raw_popups, label="incidents")
+
+    if layer != "combined-gray":
+        data = data[data['dbscan_cluster'] != -1]  # skip these points if toggle is off
+
+    # use criticality for the coloring ( blue default if error)
+    colors = data['criticality'].astype(str).map(criticality_colors).fillna('blue')
+    colors = colors.where(data['dbscan_cluster'] != -1, 'gray')
+    return ViewportSource(data, colors, combined_popups, label="incidents")
+
+incident_layers = ("combined", "combined-gray", "raw")
+
+def incident_viewport_source(feed, layer, hours=None):
+    snapshot = feed["refresher"].current()
+    if snapshot is None or snapshot["data"].empty or layer not in incident_layers:
+        return None
+    key = layer if hours is None else f"{layer}@{hours}"
+    return cached_source(feed["name"], key, snapshot["version"], lambda: build_incident_source(snapshot, layer, hours))
+
+# keep every fetch on disk for looking back over time, see history_store.py
+def save_history(incident_data, bounding_box):
+    history = get_history_store()
+    if history is None:
+        return
+    try:
+        history.append_incidents(incident_data, bounding_box)
+    except Exception as e:
+        # a bad row (a time that does not parse...) loses this fetch's history, not the snapshot
+        print(f"@ could not save history: {e!r} @")
+
+# fetch and cluster one snapshot, runs on the refresher thread. maps are rendered
+# later, on first request, through the shared map cache
+def build_incident_snapshot(feed):
+    region = feed["region"]
+    incident_data = feed["fetcher"].fetch(region.bounding_box)
+    if "geometry" in incident_data.attrs:
+        incident_data['lat'], incident_data['lng'] = incident_data.attrs["geometry"].midpoints()
+    save_history(incident_data, region.bounding_box)
+    snapshot = {"data": incident_data, "source_updated": incident_data.attrs.get("source_updated"),
+                "region": region.name}
+    if not incident_data.empty:
+        cluster_incident_data(incident_data, feed["pipeline"])
+    add_intervals(snapshot)
+    return snapshot
+
+def add_intervals(snapshot):
+    # not saved with the snapshot on disk, rebuilt after a restore too
+    data = snapshot["data"]
+    if not data.empty:
+        snapshot["intervals"] = IntervalIndex(data['start_time'], data['end_time'])
+
+# incident impact: every incident joined to the flow segments within impact_radius_m of it
+# (see spatial_join.py) of the same region, rebuilt whenever either page has a new snapshot there.
+# the segment index is kept per flow snapshot so an incident refresh only pays for the query
+def flow_segment_index(feed, flow):
+    segment_index = feed["segment_index"]
+    if segment_index.get("version") != flow["version"]:
+        segment_index.update(version=flow["version"], index=SegmentIndex(flow["data"]))
+    return segment_index["index"]
+
+def build_impact_snapshot(feed):
+    incidents = feed["refresher"].current()
+    flow_refresher = get_refresher(feed_name("flow", feed["region"]))
+    flow = flow_refresher.current() if flow_refresher else None
+    if incidents is None or flow is None or incidents["data"].empty or flow["data"].empty:
+        return {"data": pd.DataFrame()}
+    flow_data = flow["data"]
+    joined, pairs = join_incidents(incidents["data"], flow_data, impact_radius_m, flow_segment_index(feed, flow))
+    # the matched segments, with how close they are to the nearest incident
+    nearest = pairs.groupby("segment")["meters"].min()
+    segments = flow_data.iloc[nearest.index.to_numpy()].reset_index(drop=True)
+    segments["nearest_m"] = nearest.to_numpy()
+    print(f"incident impact: {(joined['nearby_segments'] > 0).sum()}/{len(joined)} incidents near "
+          f"{len(segments)} flow segments")
+    return {"data": joined, "segments": segments, "segment_rows": nearest.index.to_numpy(), "pairs": pairs,
+            "incidents": incidents}
+
+def refresh_impact(feed, snapshot):
+    feed["impact"].refresh()
+
+def create_impact_map(region):
+    m = folium.Map(location=region.center, zoom_start=region.zoom)
+    add_viewport_layer(m, f"points/{feed_name('impact', region)}/segments.json", radius=3)
+    add_viewport_layer(m, f"points/{feed_name('impact', region)}/incidents.json", radius=7, fill_opacity=0.9)
+    # the data comes from each worker's own impact snapshot, the page is the same everywhere
+    return stable_ids(m.get_root().render())
+
+def format_optional(values, fmt="{:.1f}"):
+    return values.map(fmt.format).where(values.notna(), "-")
+
+def impact_popups(data):
+    return build_popups(data, [
+        ("Location", 'description', ""),
+        ("Criticality", 'criticality', ""),
+        ("Type", 'incident_type', ""),
+        ("Nearby Segments", 'nearby_segments', ""),
+        ("Nearest Segment", format_optional(data['nearest_m'], "{:.0f}"), " m"),
+        ("Mean Jam Factor", format_optional(data['mean_jam']), ""),
+        ("Max Jam Factor", format_optional(data['max_jam']), ""),
+        ("Speed / Free Flow", format_optional(data['speed_ratio'] * 100, "{:.0f}"), " %"),
+    ])
+
+def impact_segment_popups(data):
+    return build_popups(data, [
+        ("Location", 'description', ""),
+        ("Speed", 'speed', " km/h"),
+        ("Free Flow Speed", 'free_flow_speed', " km/h"),
+        ("Jam Factor", 'jam_factor', ""),
+        ("Nearest Incident", data['nearest_m'].map("{:.0f}".format), " m"),
+    ])
+
+# incidents colored by the jam around them (gray when no segment is close enough), and the
+# segments they were matched to. with hours only the incidents active then and their segments
+def build_impact_source(impact, layer, hours=None):
+    data = impact["data"]
+    rows = None if hours is None else active_rows(impact["incidents"], hours)
+    if layer == "incidents":
+        if rows is not None:
+            data = data.iloc[rows]
+        return ViewportSource(data, jam_colors(data['mean_jam']), impact_popups, 'mean_jam', "incidents", jam_colors)
+    segments = impact["segments"]
+    if rows is not None:
+        pairs = impact["pairs"]
+        active = np.unique(pairs["segment"].to_numpy()[np.isin(pairs["incident"].to_numpy(), rows)])
+        segments = segments[np.isin(impact["segment_rows"], active)]
+    return ViewportSource(segments, jam_colors(segments['jam_factor']), impact_segment_popups, 'jam_factor',
+                          "segments", jam_colors)
+
+impact_layers = ("incidents", "segments")
+
+def impact_viewport_source(feed, layer, hours=None):
+    impact = feed["impact"].current()
+    if impact is None or impact["data"].empty or layer not in impact_layers:
+        return None
+    key = layer if hours is None else f"{layer}@{hours}"
+    return cached_source(feed_name("impact", feed["region"]), key, impact["version"], lambda: build_impact_source(impact, layer, hours))
+
+def render_incident_map(snapshot, selected_view, show_gray):
+    incident_data = snapshot["data"]
+    if incident_data.empty: # if errors or whatnot still shows page w/o crashing
+        if selected_view == "raw":
+            return "<h3>No incident data available for raw map.</h3>"
+        if show_gray:
+            return "<h3>No incident data available for combined map with gray points.</h3>"
+        return "<h3>No incident data available for combined map without gray points.</h3>"
 
-    # dbscan for noise etc
-    dbscan = DBSCAN(eps=0.1, min_samples=3).fit(
-        incident_data[['lat', 'lng', 'criticality_value']]
+    region = get_region(snapshot.get("region"))
+    if selected_view == "combined":
+        return create_viewport_incident_map(region, "combined-gray" if show_gray else "combined")
+    return create_viewport_incident_map(region, "raw")
+
+incident_views = [("combined", False), ("combined", True), ("raw", False)]
+
+# like the flow page: up to client_points_max incidents the page keeps every point in the browser
+# (client_store.py) and switches views, hides noise and filters by time there, refreshes only send
+# the rows that changed. bigger snapshots are left on the server as rendered maps. the impact map
+# is always the server's, the browser only picks its url
+client_points_max = int(os.getenv("CLIENT_POINTS_MAX", 20000))
+client_poll_seconds = 10  # how often an open page asks for a newer snapshot
+slider_hours = 24  # the time slider goes from -slider_hours to +slider_hours around the fetch
+incident_client_columns = [
+    ("lat", "lat", 1e6), ("lng", "lng", 1e6),
+    ("kmeans", "kmeans_cluster", 1), ("dbscan", "dbscan_cluster", 1),
+    ("criticality_value", "criticality_value", 100),
+    # epoch seconds for the time filter, NaN is open ended
+    ("start", "start_seconds", 1), ("end", "end_seconds", 1),
+    ("description", "description", None), ("criticality", "criticality", None), ("type", "incident_type", None),
+    ("start_time", "start_time", None), ("end_time", "end_time", None),
+]
+# how assets/client_maps.js and map_layers.ClientPointLayer draw each view, popups are
+# (label, column, suffix) like build_popups, time the start and end columns of the time filter
+incident_client_views = {
+    "combined": {"kind": "dot", "color": "criticality", "palette": "criticality", "noise": "dbscan", "toggle": True,
+                 "time": ["start", "end"], "popup": [
+        ["Location", "description", ""], ["Criticality", "criticality", ""], ["Type", "type", ""],
+        ["Start Time", "start_time", ""], ["End Time", "end_time", ""], ["KMeans Cluster", "kmeans", ""],
+        ["DBSCAN Cluster", "dbscan", ""], ["Normalized Criticality", "criticality_value", ""],
+    ]},
+    "raw": {"kind": "dot", "time": ["start", "end"], "popup": [
+        ["Location", "description", ""], ["Criticality", "criticality", ""], ["Type", "type", ""],
+        ["Start Time", "start_time", ""], ["End Time", "end_time", ""],
+    ]},
+}
+
+def create_client_map(region):
+    m = folium.Map(location=region.center, zoom_start=region.zoom)
+    add_client_layer(m, feed_name("incidents", region))
+    return stable_ids(m.get_root().render())
+
+def client_frame(data):
+    # the time filter's columns as epoch seconds, clipped to what fits the browser's int32 columns
+    # (an end after 2038 is as good as open ended for a slider of a day either way)
+    return data.assign(
+        start_seconds=np.clip(epoch_seconds(data['start_time']), -2**31, 2**31 - 1),
+        end_seconds=np.clip(epoch_seconds(data['end_time']), -2**31, 2**31 - 1),
     )
-    incident_data['dbscan_cluster'] = dbscan.labels_
-
-    # predefine colors for display based on cluster it was put in
-    kmeans_cluster_colors = {0: 'green', 1: 'orange', 2: 'red'}
-
-    # create clustered map with coloring based on which cluster it was in
-    def create_combined_incident_map(data, show_gray=True):
-        criticality_color_mapping = {
-            "low": "green",
-            "minor": "yellow",
-            "major": "orange",
-            "critical": "red",
-        }
-        m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
-        for _, row in data.iterrows():
-            if not show_gray and row['dbscan_cluster'] == -1:
-                continue  # skip these points if toggle is off
-
-            # use criticality for the coloring ( blue default if error)
-            criticality_color = criticality_color_mapping.get(row['criticality'], 'blue')
-            color = 'gray' if row['dbscan_cluster'] == -1 else criticality_color
-
-            popup_content = (
-                f"<b>Location:</b> {row['description']}<br>"
-                f"<b>Criticality:</b> {row['criticality']}<br>"
-                f"<b>Type:</b> {row['incident_type']}<br>"
-                f"<b>Start Time:</b> {row['start_time']}<br>"
-                f"<b>End Time:</b> {row['end_time']}<br>"
-                f"<b>KMeans Cluster:</b> {row['kmeans_cluster']}<br>"
-                f"<b>DBSCAN Cluster:</b> {row['dbscan_cluster']}<br>"
-                f"<b>Normalized Criticality:</b> {row['criticality_value']:.2f}"
-            )
-            popup = folium.Popup(popup_content, max_width=400, min_width=200)
-            folium.CircleMarker(
-                location=[row['original_lat'], row['original_lng']],
-                radius=5,
-                color=color,
-                fill=True,
-                fill_opacity=0.7,
-                popup=popup
-            ).add_to(m)
-        return m._repr_html_()
-
-    # raw map without color or clustering to show difference
-    def create_raw_incident_map(data):
-        m = folium.Map(location=[52.4500, 13.4050], zoom_start=11)
-        for _, row in data.iterrows():
-            color = 'blue'
-
-            popup_content = (
-                f"<b>Location:</b> {row['description']}<br>"
-                f"<b>Criticality:</b> {row['criticality']}<br>"
-                f"<b>Type:</b> {row['incident_type']}<br>"
-                f"<b>Start Time:</b> {row['start_time']}<br>"
-                f"<b>End Time:</b> {row['end_time']}"
+
+def impact_ready(feed):
+    impact = feed["impact"].current()
+    return impact is not None and not impact["data"].empty
+
+def incident_token(feed, snapshot):
+    # the impact page's url changes when the impact becomes available, so that is part of it too
+    return snapshot_token(snapshot) + ("" if impact_ready(feed) else "/no-impact")
+
+def incident_store_update(feed, snapshot, token, client_version):
+    # what the browser at client_version needs for snapshot, see assets/client_maps.js
+    data = snapshot["data"]
+    impact_page = feed["impact_map"] if impact_ready(feed) else no_impact_page
+    views = dict(incident_client_views, impact={"kind": "page", "url": dash.get_relative_path(impact_page.url)})
+    extra = {"views": views, "no_view": dash.get_relative_path(no_view_page.url), "built_at": snapshot["built_at"]}
+    if "intervals" in snapshot:
+        # how many incidents are active at each step of the slider, for its label
+        extra["active"] = {str(hours): len(active_rows(snapshot, hours)) for hours in range(-slider_hours, slider_hours + 1)}
+    if data.empty or len(data) > client_points_max:
+        maps = {}
+        for view, show_gray in incident_views:
+            rendered = map_cache.get_or_render(
+                (feed["name"], view, show_gray, snapshot["version"]),
+                lambda: render_incident_map(snapshot, view, show_gray),
             )
-            popup = folium.Popup(popup_content, max_width=400, min_width=200)
-            folium.CircleMarker(
-                location=[row['original_lat'], row['original_lng']],
-                radius=5,
-                color=color,
-                fill=True,
-                fill_opacity=0.7,
-                popup=popup
-            ).add_to(m)
-        return m._repr_html_()
-
-    # preload the maps so its speedy!
-    preloaded_incident_maps = {
-        "combined_with_gray": create_combined_incident_map(incident_data, show_gray=True),
-        "combined_without_gray": create_combined_incident_map(incident_data, show_gray=False),
-        "raw": create_raw_incident_map(incident_data),
-    }
-else: # if errors or whatnot still shows page w/o crashing
-    preloaded_incident_maps = {
-        "combined_with_gray": "<h3>No incident data available for combined map with gray points.</h3>",
-        "combined_without_gray": "<h3>No incident data available for combined map without gray points.</h3>",
-        "raw": "<h3>No incident data available for raw map.</h3>",
-    }
-
-layout = html.Div(
-    [
-        html.H1([
-            html.A(id='text-center my3', children='Data Mining Techniques Group 5', href="/", style={"text-decoration": "none", "color": "white"})
-        ], style={"text-decoration": "none"}),
-        html.Div(
-            dcc.Dropdown(
-                id="incident-map-dropdown",
-                options=[
-                    {"label": "Combined Incident Map", "value": "combined"},
-                    {"label": "Raw Incident Map", "value": "raw"}
+            maps[view + "-gray" if show_gray else view] = dash.get_relative_path(rendered.url)
+        return dict(extra, mode="maps", version=token, maps=maps)
+    update = dict(feed["store"].payload(token, client_frame(data), client_version))
+    update.update(extra, mode="points", page=feed["name"], map=dash.get_relative_path(feed["client_map"].url),
+                  palettes={"criticality": criticality_colors})
+    return update
+
+def start_incident_feed(region):
+    # everything one region needs, see regions.py. named like the flow feeds: "incidents" and
+    # "impact" for the default region, "incidents.<region>" and "impact.<region>" for the others
+    name = feed_name("incidents", region)
+    feed = {"region": region, "name": name, "segment_index": {},
+            "store": ClientStore(incident_client_columns, incident_ids)}
+    # the bbox is fetched as concurrent tiles, incidents on a border come back from both
+    feed["fetcher"] = TiledFetcher(partial(fetch_incident_data, full_geometry=full_geometry), dedupe_on=["description", "start_time", "lat", "lng"])
+    feed["client_map"] = map_cache.pin(create_client_map(region))
+    feed["impact_map"] = map_cache.pin(create_impact_map(region))
+    feed["pipeline"] = ClusterPipeline(
+        name, incident_features,
+        params=dict(kmeans_columns=incident_columns, dbscan_columns=incident_columns, scale_columns=incident_columns, n_clusters=3, eps=0.1, min_samples=3),
+        keep_scaled=['criticality_value'],
+    )
+    # first snapshot is built in the background, the page shows a loading message until then.
+    # after a restart the last snapshot saved to disk is served straight away instead
+    feed["refresher"] = SnapshotRefresher(
+        name, partial(build_incident_snapshot, feed), region.incident_refresh_seconds,
+        warm_start=warm_start(name, region.bounding_box, incident_views, prepare=add_intervals),
+        share=share_snapshots(name, region.bounding_box, incident_views, render_incident_map, prepare=add_intervals),
+        slots=build_slots,
+    )
+    register_viewport_source(name, partial(incident_viewport_source, feed), incident_layers)
+    # not on a timer and never started: no interval, it is rebuilt by the listeners below after every
+    # flow or incident refresh of the region (set up before the incident refresher starts, so a
+    # restored snapshot is joined straight away too)
+    feed["impact"] = SnapshotRefresher(feed_name("impact", region), partial(build_impact_snapshot, feed), None)
+    on_refresh(feed_name("flow", region), partial(refresh_impact, feed))
+    on_refresh(name, partial(refresh_impact, feed))
+    register_viewport_source(feed_name("impact", region), partial(impact_viewport_source, feed), impact_layers)
+    feed["refresher"].start()
+    return feed
+
+# the default region starts with the app, the others on their first request
+incident_feeds = RegionFeeds("incidents", start_incident_feed)
+default_feed = incident_feeds.get(get_region())
+bounding_box = default_feed["region"].bounding_box
+incident_fetcher, incident_pipeline = default_feed["fetcher"], default_feed["pipeline"]
+incident_refresher, impact_refresher = default_feed["refresher"], default_feed["impact"]
+no_impact_page = map_cache.pin("<h3>The impact map needs both flow and incident data, try again shortly.</h3>")
+loading_page = map_cache.pin("<h3>Traffic incident data is still loading, try again shortly.</h3>")
+no_view_page = map_cache.pin("<h3>No data available for the selected view.</h3>")
+
+def unknown_region_layout(region):
+    return html.Div([
+        html.H3(f"Unknown region: {region}"),
+        html.P(["Try ", *[html.A(r.name, href=f"/incidents/{r.name}", style={"margin-right": "10px"}) for r in all_regions()]]),
+    ], style={"text-align": "center"})
+
+def layout(region=None, **kwargs):
+    # region comes from /incidents/<region>, None on /incidents
+    if get_region(region) is None:
+        return unknown_region_layout(region)
+    return html.Div(
+        [
+            html.H1([
+                html.A(id='text-center my3', children='Data Mining Techniques Group 5', href="/", style={"text-decoration": "none", "color": "white"})
+            ], style={"text-decoration": "none"}),
+            html.Div(
+                dcc.Dropdown(
+                    id="incident-map-dropdown",
+                    options=[
+                        {"label": "Combined Incident Map", "value": "combined"},
+                        {"label": "Raw Incident Map", "value": "raw"},
+                        {"label": "Incident Impact Map", "value": "impact"},
+                    ],
+                    value="combined",
+                    className="mb-3"
+                ),
+                style={"width": "50%", "margin": "auto"}
+            ),
+            html.Div(
+                id="incident-map-container",
+                children=[
+                    html.Iframe(
+                        id="incident-map-iframe",
+                        width="100%",
+                        height="750"
+                    )
                 ],
-                value="combined",
-                className="mb-3"
+                style={"margin": "auto", "width": "95%", "height": "75%"}
             ),
-            style={"width": "50%", "margin": "auto"}
-        ),
-        html.Div(
-            id="incident-map-container",
-            children=[
-                html.Iframe(
-                    id="incident-map-iframe",
-                    srcDoc=preloaded_incident_maps["combined_with_gray"],
-                    width="100%",
-                    height="750"
-                )
-            ],
-            style={"margin": "auto", "width": "95%", "height": "75%"}
-        ),
-        html.Div(
-            id="gray-points-toggle-container-incidents",
-            children=[
-                dcc.Checklist(
-                    id="gray-points-toggle-incidents",
-                    options=[{"label": "Show Gray Points (Noise)", "value": "show_gray"}],
-                    value=[""],  # default to not showing gray points
-                    style={"margin": "auto", "text-align": "center"}
-                )
-            ],
-            style={"display": "block"}
-        ),
-    ],
-)
+            html.Div(
+                id="gray-points-toggle-container-incidents",
+                children=[
+                    dcc.Checklist(
+                        id="gray-points-toggle-incidents",
+                        options=[{"label": "Show Gray Points (Noise)", "value": "show_gray"}],
+                        value=[""],  # default to not showing gray points
+                        style={"margin": "auto", "text-align": "center"}
+                    )
+                ],
+                style={"display": "block"}
+            ),
+            html.Div(
+                [
+                    dcc.Checklist(
+                        id="time-filter-toggle-incidents",
+                        options=[{"label": "Only incidents active at the selected time", "value": "filter_time"}],
+                        value=[],  # default to every incident of the last 24h
+                        style={"text-align": "center"}
+                    ),
+                    # hours from the time the data was fetched
+                    dcc.Slider(
+                        id="time-slider-incidents",
+                        min=-slider_hours, max=slider_hours, step=1, value=0,
+                        marks={-slider_hours: f"-{slider_hours}h", -slider_hours // 2: f"-{slider_hours // 2}h", 0: "now",
+                               slider_hours // 2: f"+{slider_hours // 2}h", slider_hours: f"+{slider_hours}h"},
+                    ),
+                    html.Div(id="time-label-incidents", style={"text-align": "center"}),
+                ],
+                style={"width": "50%", "margin": "auto"}
+            ),
+            # the snapshot as the browser has it: what the server sent last, the merged points and their version
+            dcc.Store(id="incident-store-update"),
+            dcc.Store(id="incident-points"),
+            dcc.Store(id="incident-version"),
+            dcc.Interval(id="incident-poll", interval=client_poll_seconds * 1000),
+            dcc.Store(id="incident-region", data=get_region(region).name),
+        ],
+    )
 
+# newer snapshot for the browser, nothing when it is up to date. the page asks on load and then
+# every client_poll_seconds, sending only the version it has
 @dash.callback(
-    [Output("incident-map-iframe", "srcDoc"),
-     Output("gray-points-toggle-container-incidents", "style")],
-    [Input("incident-map-dropdown", "value"), Input("gray-points-toggle-incidents", "value")]
+    Output("incident-store-update", "data"),
+    [Input("incident-poll", "n_intervals")],
+    [State("incident-version", "data"), State("incident-map-dropdown", "value"), State("incident-region", "data")]
 )
-def update_incident_map(selected_view, gray_toggle):
-    show_gray = "show_gray" in gray_toggle
+def update_incident_store(_, client_version, selected_view=None, region=None):
+    # the first request for a region starts its feed, see regions.RegionFeeds
+    region = get_region(region)
+    if region is None:
+        return dash.no_update
+    feed = incident_feeds.get(region)
+    if selected_view == "impact":
+        flow_feeds = get_feeds("flow")
+        if flow_feeds is not None:
+            flow_feeds.get(region)  # the impact needs the region's flow too, its refresh rebuilds the impact
+    snapshot = feed["refresher"].current()
+    if snapshot is None:
+        if client_version == "loading":
+            return dash.no_update
+        return {"mode": "loading", "version": "loading", "url": dash.get_relative_path(loading_page.url)}
+    token = incident_token(feed, snapshot)
+    if client_version == token:
+        return dash.no_update
+    return incident_store_update(feed, snapshot, token, client_version)
 
-    if selected_view == "combined":
-        return (
-            preloaded_incident_maps["combined_with_gray"] if show_gray else preloaded_incident_maps["combined_without_gray"],
-            {"display": "block"}  # show the toggle on block, otherwise none for hiding
-        )
-    elif selected_view == "raw":
-        return preloaded_incident_maps["raw"], {"display": "none"}  # hide the toggle on none
-    return "<h3>No data available for the selected view.</h3>", {"display": "none"}
+dash.clientside_callback(
+    ClientsideFunction(namespace="traffic", function_name="merge"),
+    [Output("incident-points", "data"), Output("incident-version", "data")],
+    [Input("incident-store-update", "data")],
+    [State("incident-points", "data")]
+)
+
+# switching views, the noise toggle and the time filter never leave the browser
+dash.clientside_callback(
+    ClientsideFunction(namespace="traffic", function_name="drawAt"),
+    [Output("incident-map-iframe", "src"), Output("gray-points-toggle-container-incidents", "style"),
+     Output("time-label-incidents", "children")],
+    [Input("incident-points", "data"), Input("incident-map-dropdown", "value"), Input("gray-points-toggle-incidents", "value"),
+     Input("time-filter-toggle-incidents", "value"), Input("time-slider-incidents", "value")]
+)
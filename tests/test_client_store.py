@@ -0,0 +1,126 @@
+import base64
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from client_store import ClientStore, ClientTable, pack
+
+COLUMNS = [("lat", "lat", 1e6), ("lng", "lng", 1e6), ("jam", "jam_factor", 10), ("description", "description", None)]
+TYPES = {"i1": np.int8, "i2": np.int16, "i4": np.int32}
+
+
+# the browser's side (assets/client_maps.js), step for step
+def unpack(packed):
+    values = np.frombuffer(base64.b64decode(packed["data"]), dtype=np.dtype(TYPES[packed["type"]]).newbyteorder("<"))
+    values = values.astype(np.int64)
+    if "start" not in packed:
+        return values
+    return np.concatenate([[packed["start"]], packed["start"] + np.cumsum(values)]).astype(np.int64)
+
+
+def decode_column(column):
+    if "names" in column:
+        return [column["names"][code] for code in unpack(column["codes"])]
+    values = unpack(column["values"]) / column["scale"]
+    if "missing" in column:
+        values[unpack(column["missing"])] = np.nan
+    return values.tolist()
+
+
+def apply_delta(base, remove, insert, rows, count):
+    removed = set(remove.tolist())
+    kept = [value for row, value in enumerate(base) if row not in removed]
+    out, next_insert, taken = [], 0, 0
+    for i in range(count):
+        if next_insert < len(insert) and insert[next_insert] == i:
+            out.append(rows[next_insert])
+            next_insert += 1
+        else:
+            out.append(kept[taken])
+            taken += 1
+    return out
+
+
+def merge(update, points):
+    columns = {name: decode_column(column) for name, column in update["columns"].items()}
+    if "base" in update:
+        assert points["version"] == update["base"]
+        remove, insert = unpack(update["remove"]), unpack(update["insert"])
+        columns = {name: apply_delta(points["columns"][name], remove, insert, values, update["rows"])
+                   for name, values in columns.items()}
+    for values in columns.values():
+        assert len(values) == update["rows"]
+    return {"version": update["version"], "columns": columns}
+
+
+def as_rows(points):
+    names = sorted(points["columns"])
+    return [tuple("nan" if isinstance(v, float) and np.isnan(v) else v for v in row)
+            for row in zip(*(points["columns"][name] for name in names))]
+
+
+def road_frame(rng, n):
+    return pd.DataFrame({
+        "lat": np.round(rng.uniform(52.34, 52.67, n), 5),
+        "lng": np.round(rng.uniform(13.09, 13.76, n), 5),
+        "jam_factor": np.round(rng.uniform(0, 10, n), 1),
+        "description": rng.choice(["A100", "Unter den Linden", "Karl-Marx-Allee", "B96"], n),
+    })
+
+
+def ids(frame):
+    return pd.util.hash_pandas_object(frame[["description", "lat", "lng"]], index=False).to_numpy().view(np.int64)
+
+
+def refresh(rng, frame):
+    # some jam factors change, some go missing, a few segments go away and new ones appear
+    frame = frame.copy()
+    changed = rng.random(len(frame)) < 0.05
+    frame.loc[changed, "jam_factor"] = np.round(rng.uniform(0, 10, changed.sum()), 1)
+    frame.loc[rng.random(len(frame)) < 0.01, "jam_factor"] = np.nan
+    frame = frame[rng.random(len(frame)) > 0.02]
+    return pd.concat([frame, road_frame(rng, 30)], ignore_index=True).sample(frac=1, random_state=1)
+
+
+def test_pack_round_trip():
+    rng = np.random.default_rng(3)
+    for values in (np.arange(1000) * 7 + 52_000_000, rng.integers(-100, 100, 50), rng.integers(-2**31, 2**31 - 1, 50),
+                   np.array([5]), np.array([], dtype=np.int64)):
+        assert np.array_equal(unpack(pack(values)), values)
+
+
+def test_deltas_merge_to_the_full_snapshot():
+    rng = np.random.default_rng(21)
+    store = ClientStore(COLUMNS, ids)
+    frame = road_frame(rng, 3000)
+    points = merge(store.payload("1", frame), None)
+    deltas = 0
+    for version in range(2, 8):
+        frame = refresh(rng, frame)
+        token = str(version)
+        update = store.payload(token, frame, client_token=points["version"])
+        deltas += "base" in update
+        points = merge(update, points)
+        full = merge(store.payload(token, frame), None)
+        assert as_rows(points) == as_rows(full)
+        # and the full snapshot is the frame itself
+        expected = ClientTable(frame, ids(frame), COLUMNS)
+        assert len(full["columns"]["lat"]) == len(frame)
+        np.testing.assert_array_equal(np.round(np.array(full["columns"]["lat"]) * 1e6), expected.values["lat"])
+        assert sorted(full["columns"]["description"]) == sorted(frame["description"])
+    assert deltas == 6
+
+
+def test_unknown_base_sends_everything():
+    rng = np.random.default_rng(5)
+    store = ClientStore(COLUMNS, ids, keep=2)
+    frame = road_frame(rng, 200)
+    store.payload("1", frame)
+    store.payload("2", refresh(rng, frame))
+    store.payload("3", refresh(rng, frame))  # "1" is gone
+    assert "base" not in store.payload("3", frame, client_token="1")
+    assert "base" not in store.payload("3", frame, client_token="3")
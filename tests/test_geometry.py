@@ -0,0 +1,29 @@
+import os
+import sys
+import numpy as np
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from geometry import SegmentGeometry
+
+
+def test_midpoints_of_an_empty_segment_in_the_middle():
+    # segment 1 has no points, segment 2 is a straight line north
+    geometry = SegmentGeometry(
+        lat=[52.50, 52.51, 52.60, 52.62],
+        lng=[13.40, 13.40, 13.30, 13.30],
+        offsets=[0, 2, 2, 4],
+    )
+    lat, lng = geometry.midpoints()
+    np.testing.assert_allclose(lat, [52.505, 0, 52.61], atol=1e-6)
+    np.testing.assert_allclose(lng, [13.40, 0, 13.30], atol=1e-6)
+
+
+def test_midpoints_with_single_point_and_empty_segments():
+    geometry = SegmentGeometry(lat=[52.5, 52.7], lng=[13.4, 13.2], offsets=[0, 0, 1, 1, 2])
+    lat, lng = geometry.midpoints()
+    np.testing.assert_allclose(lat, [0, 52.5, 0, 52.7])
+    np.testing.assert_allclose(lng, [0, 13.4, 0, 13.2])
+    lat, lng = SegmentGeometry([], [], [0, 0]).midpoints()
+    np.testing.assert_allclose(lat, [0])
@@ -0,0 +1,148 @@
+import os
+import socket
+import sys
+import time
+import pytest
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from fake_here import FakeHereServer
+from here_client import HereApiError, HereClient, TokenBucket
+from stream_parser import parse_flow_stream
+
+BBOX = {"in": "bbox:13.3,52.4,13.5,52.6", "locationReferencing": "shape"}
+
+
+@pytest.fixture(scope="module")
+def server():
+    fake = FakeHereServer(500, 20).start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def fake(server):
+    server.failures = []
+    server.requests = 0
+    return server
+
+
+class CountingParser:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, body):
+        self.calls += 1
+        return parse_flow_stream(body)
+
+
+def client_for(fake, **kwargs):
+    kwargs.setdefault("backoff", 0.001)
+    return HereClient("secret", base_url=fake.url, **kwargs)
+
+
+def test_unchanged_tiles_are_revalidated(fake):
+    client = client_for(fake)
+    parse = CountingParser()
+    first = client.fetch("flow", BBOX, parse, raw=True)
+    second = client.fetch("flow", BBOX, parse, raw=True)
+    assert parse.calls == 1
+    assert [call["status"] for call in client.calls] == [200, 304]
+    assert len(first) == len(second) > 0
+    assert first.attrs["source_updated"] == second.attrs["source_updated"] == fake.feeds["flow"].source_updated
+    # callers get their own copy of the cached parse
+    second["speed"] = 0
+    assert (client.fetch("flow", BBOX, parse, raw=True)["speed"] > 0).any()
+
+    fake.advance()
+    third = client.fetch("flow", BBOX, parse, raw=True)
+    assert parse.calls == 2
+    assert third.attrs["source_updated"] == fake.feeds["flow"].source_updated != first.attrs["source_updated"]
+
+
+def test_only_the_most_recent_tiles_are_kept(fake):
+    client = client_for(fake, max_cached=1)
+    parse = CountingParser()
+    other = dict(BBOX, **{"in": "bbox:13.5,52.4,13.7,52.6"})
+    for params in (BBOX, other, BBOX):
+        client.fetch("flow", params, parse, raw=True)
+    assert parse.calls == 3
+    assert [call["status"] for call in client.calls] == [200, 200, 200]
+
+
+def test_retries_server_errors(fake):
+    fake.failures = [(503, {}), (500, {}), (429, {})]
+    client = client_for(fake, max_retries=4)
+    frame = client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    assert len(frame) > 0
+    assert [call["status"] for call in client.calls] == [503, 500, 429, 200]
+    assert [call["attempt"] for call in client.calls] == [0, 1, 2, 3]
+
+
+def test_gives_up_after_max_retries(fake):
+    fake.failures = [(503, {})] * 3
+    client = client_for(fake, max_retries=2)
+    with pytest.raises(HereApiError, match="503"):
+        client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    assert fake.requests == 3
+
+
+def test_client_errors_are_not_retried(fake):
+    fake.failures = [(403, {})]
+    client = client_for(fake)
+    with pytest.raises(HereApiError, match="403"):
+        client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    assert fake.requests == 1
+
+
+def test_retry_after_is_honoured_up_to_max_backoff(fake):
+    fake.failures = [(429, {"Retry-After": "1"})]
+    client = client_for(fake, max_backoff=30)
+    start = time.perf_counter()
+    frame = client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    assert time.perf_counter() - start >= 1
+    assert frame.attrs["waited_seconds"] >= 1
+
+    fake.failures = [(503, {"Retry-After": "3600"})]
+    client = client_for(fake, max_backoff=0.2)
+    start = time.perf_counter()
+    frame = client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    assert 0.2 <= time.perf_counter() - start < 2
+    assert 0.2 <= frame.attrs["waited_seconds"] < 2
+
+
+def test_backoff_grows_and_is_capped():
+    client = HereClient("secret", backoff=0.5, max_backoff=4)
+    for attempt in range(8):
+        delays = [client._delay(attempt, None) for _ in range(50)]
+        assert 0 <= min(delays) and max(delays) <= min(4, 0.5 * 2 ** attempt)
+    assert client._delay(0, "2") >= 2
+
+
+def test_connection_errors_hide_the_api_key():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]  # nothing listens here once it is closed
+    client = HereClient("secret", base_url=f"http://127.0.0.1:{port}/v7/", max_retries=1, backoff=0.001)
+    with pytest.raises(HereApiError) as error:
+        client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    assert "secret" not in str(error.value)
+    assert len(client.calls) == 2
+
+
+def test_token_bucket_limits_the_rate():
+    bucket = TokenBucket(rate=20, burst=2)
+    start = time.perf_counter()
+    waited = sum(bucket.take() for _ in range(6))
+    elapsed = time.perf_counter() - start
+    # the burst goes at once, the other 4 at 20 a second
+    assert 0.18 <= elapsed < 0.5
+    assert 0.15 <= waited < 0.5
+
+
+def test_quota_waits_are_reported(fake):
+    client = client_for(fake, rate_limit=10, burst=1)
+    client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    frame = client.fetch("flow", BBOX, parse_flow_stream, raw=True)
+    assert 0.05 <= frame.attrs["waited_seconds"] < 0.5
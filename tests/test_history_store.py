@@ -0,0 +1,141 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from history_store import HistoryStore, segment_ids
+
+BBOX = "13.08836,52.33812,13.761,52.6755"
+NOW = pd.Timestamp.now(tz="UTC").floor("min")
+
+
+def flow_fetch(rng, n, minutes_ago):
+    return pd.DataFrame({
+        "description": [f"Street {i}" for i in range(n)],
+        "length": np.full(n, 120.0),
+        "speed": rng.uniform(5, 80, n).round(1),
+        "free_flow_speed": np.full(n, 60.0),
+        "jam_factor": rng.uniform(0, 10, n).round(1),
+        "lat": 52.4 + np.arange(n) * 1e-3,
+        "lng": np.full(n, 13.4),
+        "time_updated": (NOW - pd.Timedelta(minutes=minutes_ago)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+    })
+
+
+def incident_fetch(n, start_hours_ago=3):
+    return pd.DataFrame({
+        "description": [f"accident on Street {i}" for i in range(n)],
+        "criticality": ["minor"] * n,
+        "incident_type": ["accident"] * n,
+        "start_time": [NOW - pd.Timedelta(hours=start_hours_ago)] * n,
+        "end_time": [NOW + pd.Timedelta(hours=1)] * n,
+        "road_closed": [False] * n,
+        "lat": 52.5 + np.arange(n) * 1e-3,
+        "lng": np.full(n, 13.3),
+    })
+
+
+def rows_on_disk(store, kind):
+    return sum(store.meta(chunk)["rows"] for day in store._days(kind, BBOX) for chunk in store._chunks(day))
+
+
+def test_flow_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    store = HistoryStore(str(tmp_path))
+    fetches = [flow_fetch(rng, 50, minutes) for minutes in (20, 10, 0)]
+    for fetch in fetches:
+        assert store.append_flow(fetch, BBOX) is not None
+
+    read = store.read("flow", BBOX, NOW - pd.Timedelta(hours=1), NOW)
+    assert len(read) == 150
+    assert read["time_updated"].nunique() == 3
+    expected = pd.concat(fetches, ignore_index=True)
+    np.testing.assert_allclose(np.sort(read["jam_factor"]), np.sort(expected["jam_factor"]))
+    assert sorted(read["description"].astype(str).unique()) == sorted(expected["description"].unique())
+    # only the asked for time range
+    assert len(store.read("flow", BBOX, NOW - pd.Timedelta(minutes=15), NOW)) == 100
+
+    segments = segment_ids(fetches[0])[[3, 7]]
+    history = store.jam_factor(BBOX, segments, NOW - pd.Timedelta(hours=1), NOW)
+    assert len(history) == 6
+    assert list(history["segment_id"]) == [min(segments)] * 3 + [max(segments)] * 3
+    for fetch, (_, row) in zip(fetches, history[history["segment_id"] == segments[0]].iterrows()):
+        assert row["jam_factor"] == fetch["jam_factor"][3]
+
+
+def test_same_flow_fetch_is_saved_once_across_restarts(tmp_path):
+    rng = np.random.default_rng(1)
+    fetch = flow_fetch(rng, 40, 5)
+    store = HistoryStore(str(tmp_path))
+    assert store.append_flow(fetch, BBOX) is not None
+    assert store.append_flow(fetch, BBOX) is None
+    # a new process, same sourceUpdated from the api
+    restarted = HistoryStore(str(tmp_path))
+    assert restarted.append_flow(fetch, BBOX) is None
+    assert rows_on_disk(restarted, "flow") == 40
+    assert restarted.append_flow(flow_fetch(rng, 40, 0), BBOX) is not None
+    assert rows_on_disk(restarted, "flow") == 80
+
+
+def test_incidents_only_save_changes_across_restarts(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    incidents = incident_fetch(20)
+    assert store.append_incidents(incidents, BBOX) is not None
+    assert store.append_incidents(incidents, BBOX) is None
+    changed = incidents.copy()
+    changed.loc[[2, 5], "criticality"] = "major"
+    store.append_incidents(changed, BBOX)
+    assert rows_on_disk(store, "incidents") == 22
+
+    restarted = HistoryStore(str(tmp_path))
+    assert restarted.append_incidents(changed, BBOX) is None
+    assert rows_on_disk(restarted, "incidents") == 22
+
+    active = restarted.incidents_active_at(BBOX, NOW)
+    assert len(active) == 20
+    assert (active.set_index("description").loc[["accident on Street 2", "accident on Street 5"], "criticality"] == "major").all()
+    assert restarted.incidents_active_at(BBOX, NOW - pd.Timedelta(hours=4)).empty
+
+
+def test_compaction_keeps_the_answers(tmp_path):
+    rng = np.random.default_rng(2)
+    store = HistoryStore(str(tmp_path))
+    fetches = [flow_fetch(rng, 30, minutes) for minutes in (30, 20, 10)]
+    for fetch in fetches:
+        store.append_flow(fetch, BBOX)
+    incidents = incident_fetch(10)
+    store.append_incidents(incidents, BBOX)
+    later = incidents.copy()
+    later.loc[0, "road_closed"] = True
+    store.append_incidents(later, BBOX)
+
+    segments = segment_ids(fetches[0])[[1, 4, 9]]
+    t0, t1 = NOW - pd.Timedelta(hours=1), NOW
+    flow_before = store.read("flow", BBOX, t0, t1)
+    jam_before = store.jam_factor(BBOX, segments, t0, t1)
+    active_before = store.incidents_active_at(BBOX, NOW)
+
+    day = NOW.strftime("%Y-%m-%d")
+    store.compact("flow", BBOX, day)
+    store.compact("incidents", BBOX, day)
+    for kind in ("flow", "incidents"):
+        chunks = store._chunks(store._days(kind, BBOX)[0])
+        assert [os.path.basename(chunk) for chunk in chunks] == ["compacted"]
+    # one row per incident, its newest version
+    assert rows_on_disk(store, "incidents") == 10
+    ids = np.load(os.path.join(store._chunks(store._days("flow", BBOX)[0])[0], "segment_id.npy"), mmap_mode="r")
+    assert np.all(np.diff(ids) >= 0)
+
+    flow_after = store.read("flow", BBOX, t0, t1)
+    key = ["segment_id", "time_updated"]
+    pd.testing.assert_frame_equal(
+        flow_before.sort_values(key, ignore_index=True).astype({"description": str}),
+        flow_after.sort_values(key, ignore_index=True).astype({"description": str})[flow_before.columns],
+    )
+    pd.testing.assert_frame_equal(jam_before, store.jam_factor(BBOX, segments, t0, t1))
+    active_after = store.incidents_active_at(BBOX, NOW)
+    assert sorted(active_after["incident_id"]) == sorted(active_before["incident_id"])
+    assert active_after.set_index("description").loc["accident on Street 0", "road_closed"]
@@ -0,0 +1,108 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import BallTree
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from geometry import EARTH_RADIUS_M
+from incremental_clustering import IncrementalClusterer
+
+EPS_M = 200
+MIN_SAMPLES = 5
+
+
+def berlin_points(rng, n):
+    return rng.uniform([52.34, 13.09], [52.67, 13.76], size=(n, 2))
+
+
+def assert_same_clustering(points, labels, eps_m=EPS_M):
+    # same clustering as a full dbscan: same noise, same core point clusters, and every
+    # border point in the cluster of one of its core neighbours
+    radians = np.radians(points)
+    full = DBSCAN(eps=eps_m / EARTH_RADIUS_M, min_samples=MIN_SAMPLES, metric="haversine").fit(radians)
+    expected = full.labels_
+    core = np.zeros(len(points), dtype=bool)
+    core[full.core_sample_indices_] = True
+
+    assert np.array_equal(labels == -1, expected == -1)
+    pairs = set(zip(labels[core].tolist(), expected[core].tolist()))
+    assert len(pairs) == len({a for a, _ in pairs}) == len({b for _, b in pairs})
+    to_expected = dict(pairs)
+
+    neighbours = BallTree(radians, metric="haversine").query_radius(radians, r=eps_m / EARTH_RADIUS_M)
+    for row in np.flatnonzero(~core & (labels >= 0)):
+        around = neighbours[row][core[neighbours[row]]]
+        assert to_expected[labels[row]] in set(expected[around].tolist())
+
+
+def test_incremental_dbscan_matches_full_dbscan():
+    rng = np.random.default_rng(0)
+    points = berlin_points(rng, 20000)
+    keys = np.arange(len(points))
+    clusterer = IncrementalClusterer(["lat", "lng"], ["lat", "lng"], eps=EPS_M, min_samples=MIN_SAMPLES,
+                                     haversine=True, refit_every=100)
+    for step in range(8):
+        if step:
+            moved = rng.choice(len(points), len(points) // 100, replace=False)
+            points[moved] += rng.normal(0, 0.003, (len(moved), 2))
+        data = pd.DataFrame(points, columns=["lat", "lng"])
+        clusterer.update(data, keys)
+        assert clusterer.last_stats["full_refit"] == (step == 0)
+        assert_same_clustering(points, data["dbscan_cluster"].to_numpy())
+
+
+def test_incremental_dbscan_with_points_coming_and_going():
+    rng = np.random.default_rng(1)
+    points = berlin_points(rng, 3000)
+    keys = np.arange(len(points))
+    next_key = len(points)
+    clusterer = IncrementalClusterer(["lat", "lng"], ["lat", "lng"], eps=EPS_M, min_samples=MIN_SAMPLES,
+                                     haversine=True, refit_every=100)
+    for step in range(8):
+        if step:
+            keep = rng.random(len(points)) > 0.01
+            added = berlin_points(rng, 30)
+            points = np.vstack([points[keep], added])
+            keys = np.concatenate([keys[keep], np.arange(next_key, next_key + len(added))])
+            next_key += len(added)
+        data = pd.DataFrame(points, columns=["lat", "lng"])
+        clusterer.update(data, keys)
+        assert_same_clustering(points, data["dbscan_cluster"].to_numpy())
+
+
+def test_no_savings_reported_when_dbscan_reruns_everything():
+    rng = np.random.default_rng(2)
+    points = berlin_points(rng, 2000)
+    keys = np.arange(len(points))
+    clusterer = IncrementalClusterer(["lat", "lng"], ["lat", "lng"], eps=EPS_M, min_samples=MIN_SAMPLES,
+                                     haversine=True, refit_every=100)
+    clusterer.update(pd.DataFrame(points, columns=["lat", "lng"]), keys)
+    points = points + rng.normal(0, 0.003, points.shape)  # everything moved
+    clusterer.update(pd.DataFrame(points, columns=["lat", "lng"]), keys)
+    assert not clusterer.last_stats["full_refit"]
+    assert clusterer.last_stats["dbscan_rows_rerun"] == len(points)
+    assert clusterer.last_stats["saved_seconds"] == 0
+
+
+def test_incremental_path_is_taken_at_the_flow_page_settings():
+    # FLOW_DBSCAN_EPS_M default, where all of berlin is one big cluster. a refresh moves, adds
+    # or drops a few segments, only the points around them are looked up again
+    rng = np.random.default_rng(3)
+    points = berlin_points(rng, 5000)
+    keys = np.arange(len(points))
+    clusterer = IncrementalClusterer(["lat", "lng"], ["lat", "lng"], eps=1000, min_samples=MIN_SAMPLES,
+                                     haversine=True, refit_every=100)
+    for step in range(6):
+        if step:
+            moved = rng.choice(len(points), 25, replace=False)
+            points[moved] = berlin_points(rng, len(moved))
+        data = pd.DataFrame(points, columns=["lat", "lng"])
+        clusterer.update(data, keys)
+        assert_same_clustering(points, data["dbscan_cluster"].to_numpy(), eps_m=1000)
+        if step:
+            assert 0 < clusterer.last_stats["dbscan_rows_rerun"] < len(points) / 4
+    assert len(np.unique(data["dbscan_cluster"])) <= 3
@@ -0,0 +1,53 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from intervals import IntervalIndex, epoch_seconds
+
+NOW = pd.Timestamp("2024-05-01 12:00", tz="UTC")
+
+
+def random_intervals(rng, n):
+    start = NOW + pd.to_timedelta(rng.integers(-72, 24, n), unit="h")
+    end = start + pd.to_timedelta(rng.integers(0, 48, n), unit="h")
+    start, end = pd.Series(start), pd.Series(end)
+    # open ended, missing start and an end before the start
+    start[rng.random(n) < 0.1] = pd.NaT
+    end[rng.random(n) < 0.1] = pd.NaT
+    backwards = rng.random(n) < 0.05
+    end[backwards] = start[backwards] - pd.Timedelta(hours=2)
+    return start, end
+
+
+def brute_force(start, end, t):
+    start = epoch_seconds(start)
+    end = epoch_seconds(end)
+    start = np.where(np.isnan(start), -np.inf, start)
+    end = np.maximum(np.where(np.isnan(end), np.inf, end), start)
+    return np.flatnonzero((start <= t) & (t <= end))
+
+
+def test_active_at_matches_a_scan():
+    rng = np.random.default_rng(17)
+    start, end = random_intervals(rng, 2000)
+    index = IntervalIndex(start, end)
+    base = epoch_seconds([NOW])[0]
+    # whole hours hit interval ends exactly, the rest fall in between
+    times = np.concatenate([base + np.arange(-80, 80) * 3600, base + rng.uniform(-100, 100, 200) * 3600])
+    for t in times:
+        found = index.active_at(t)
+        assert len(found) == len(set(found.tolist()))
+        assert np.array_equal(np.sort(found), brute_force(start, end, t))
+        assert np.array_equal(np.flatnonzero(index.active_mask(t)), brute_force(start, end, t))
+
+
+def test_empty_and_open_ended():
+    assert len(IntervalIndex([], []).active_at(0.0)) == 0
+    index = IntervalIndex(pd.Series([pd.NaT, pd.NaT]), pd.Series([pd.NaT, NOW]))
+    t = epoch_seconds([NOW])[0]
+    assert sorted(index.active_at(t).tolist()) == [0, 1]
+    assert index.active_at(t + 1).tolist() == [0]
@@ -0,0 +1,108 @@
+import json
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import pandas as pd
+import pytest
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from fake_here import flow_payload, incident_payload, payload_bytes
+from traffic_fetcher import (incident_cutoff, parse_flow_response, parse_flow_stream, parse_incident_body,
+                             parse_incident_response)
+
+
+def odd_flow_results():
+    # missing fields, no shape, unicode and escaped quotes
+    return [
+        {"location": {"description": 'Straße des 17. Juni "West"', "length": 12},
+         "currentFlow": {"speed": 3.5, "freeFlow": 50, "jamFactor": 9.1}},
+        {"location": {"shape": {"links": []}}, "currentFlow": {}},
+        {},
+    ]
+
+
+def odd_incident_results():
+    now = datetime.now(timezone.utc)
+    return [
+        {"location": {}, "incidentDetails": {"startTime": (now - timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                                             "endTime": (now + timedelta(hours=2)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")}},
+        {"location": {"shape": {"links": [{"points": [{"lat": 52.5, "lng": 13.4}]}]}},
+         "incidentDetails": {"description": {"value": "Unfall über \\\"A100\\\""}, "roadClosed": True,
+                             "startTime": "2020-01-01T00:00:00Z", "endTime": "2099-01-01T00:00:00+01:00"}},
+    ]
+
+
+def assert_same_frame(streamed, expected):
+    # same columns, rows and values. the streaming parser keeps strings as categoricals and
+    # every number as float64, the dict parser leaves them as objects / whatever json gave
+    assert list(streamed.columns) == list(expected.columns)
+    assert len(streamed) == len(expected)
+    for column in expected.columns:
+        dtype = streamed[column].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            assert list(streamed[column].astype(object)) == list(expected[column].astype(object))
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            assert str(dtype).endswith(", UTC]")
+            assert (streamed[column] == expected[column]).all()
+        elif dtype == bool:
+            assert list(streamed[column]) == list(expected[column].astype(bool))
+        else:
+            assert dtype == np.float64
+            np.testing.assert_array_equal(streamed[column].to_numpy(), expected[column].to_numpy(dtype=float))
+
+
+def assert_same_geometry(streamed, expected):
+    for name in ("lat", "lng", "offsets"):
+        np.testing.assert_array_equal(getattr(streamed.attrs["geometry"], name), getattr(expected.attrs["geometry"], name))
+
+
+def test_flow_stream_matches_dict_parser():
+    payload = flow_payload(500, seed=3)
+    payload["results"] += odd_flow_results()
+    for body in (payload_bytes(payload), json.dumps(payload, indent=2, ensure_ascii=False).encode("utf-8")):
+        expected = parse_flow_response(json.loads(body), full_geometry=True)
+        streamed = parse_flow_stream(body, full_geometry=True)
+        assert_same_frame(streamed, expected)
+        assert_same_geometry(streamed, expected)
+        assert isinstance(streamed["description"].dtype, pd.CategoricalDtype)
+        assert streamed["time_updated"].nunique() == 1 and streamed["time_updated"][0] == payload["sourceUpdated"]
+
+
+def test_incident_stream_matches_dict_parser_and_cutoff():
+    payload = incident_payload(400, seed=4)
+    payload["results"] += odd_incident_results()
+    body = payload_bytes(payload)
+    expected = parse_incident_response(json.loads(body), full_geometry=True)
+    streamed = parse_incident_body(body, full_geometry=True)
+    assert_same_frame(streamed, expected)
+    assert_same_geometry(streamed, expected)
+
+    # incidents that ended more than INCIDENT_HOURS ago are dropped, and only those
+    cutoff = incident_cutoff()
+    assert 0 < len(streamed) < len(payload["results"])
+    assert ((streamed["end_time"] >= cutoff) | (streamed["start_time"] >= cutoff)).all()
+    ends = pd.to_datetime([result.get("incidentDetails", {}).get("endTime", "1970-01-01T00:00:00Z")
+                           for result in payload["results"]], utc=True, format="ISO8601")
+    starts = pd.to_datetime([result.get("incidentDetails", {}).get("startTime", "1970-01-01T00:00:00Z")
+                             for result in payload["results"]], utc=True, format="ISO8601")
+    assert len(streamed) == int(((ends >= cutoff) | (starts >= cutoff)).sum())
+
+
+def test_truncated_bodies_fail_like_json_loads():
+    body = payload_bytes(flow_payload(50, seed=5))
+    first_result_end = body.index(b'},{"location"') + 2
+    for cut in (len(body) - 1, len(body) // 2, first_result_end):
+        truncated = body[:cut]
+        with pytest.raises(ValueError):
+            json.loads(truncated)
+        with pytest.raises(ValueError):
+            parse_flow_stream(truncated)
+
+
+def test_empty_results():
+    for body in (b'{"sourceUpdated":"2024-05-01T12:00:00Z","results":[]}', b'{"results": [ ]}', b"{}"):
+        assert parse_flow_stream(body).empty
+        assert parse_incident_body(body).empty
@@ -0,0 +1,127 @@
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from tiling import TiledFetcher, parse_bbox, split_bbox
+
+BBOX = "13.0,52.0,14.0,53.0"
+
+
+class FakeApi:
+    # answers a tile with the points inside it (borders included, like HERE), cut off at
+    # max_results. wait is added to every call and reported as client wait like here_client does
+    def __init__(self, points, max_results=None, wait=0.0, source_updated=None):
+        self.points = points
+        self.max_results = max_results
+        self.wait = wait
+        self.source_updated = source_updated or (lambda box: "2024-05-01T12:00:00Z")
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, bounding_box):
+        west, south, east, north = parse_bbox(bounding_box)
+        with self._lock:
+            self.calls.append((west, south, east, north))
+        points = self.points
+        inside = points[(points["lat"] >= south) & (points["lat"] <= north)
+                        & (points["lng"] >= west) & (points["lng"] <= east)].reset_index(drop=True)
+        if self.max_results is not None:
+            inside = inside.iloc[:self.max_results]
+        if self.wait:
+            time.sleep(self.wait)
+        inside.attrs["source_updated"] = self.source_updated((west, south, east, north))
+        inside.attrs["waited_seconds"] = self.wait
+        return inside
+
+
+def random_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "description": [f"Street {i}" for i in range(n)],
+        "lat": np.round(rng.uniform(52.0, 53.0, n), 5),
+        "lng": np.round(rng.uniform(13.0, 14.0, n), 5),
+    })
+
+
+def test_split_covers_the_bbox():
+    tiles = split_bbox(BBOX, 0.3)
+    assert len(tiles) == 16
+    assert np.isclose(sum((e - w) * (n - s) for w, s, e, n in tiles), 1.0)
+
+
+def test_cut_off_tiles_are_split_and_shrink_the_grid():
+    points = random_points(2000)
+    api = FakeApi(points, max_results=400)
+    fetcher = TiledFetcher(api, ["description", "lat", "lng"], tile_size=0.5, max_workers=2, max_results=400)
+    merged = fetcher.fetch(BBOX)
+    # every point once, though the 0.5 tiles (~500 points each) were cut off at 400
+    assert sorted(merged["description"]) == sorted(points["description"])
+    assert fetcher.tile_size == 0.25
+    assert len(api.calls) > 4
+
+
+def test_points_on_tile_borders_are_kept_once():
+    # points exactly on the lines between tiles and on the corners come back from every tile
+    # that touches them
+    lat = [52.5, 52.5, 52.25, 52.75, 52.5, 52.1]
+    lng = [13.5, 13.25, 13.5, 13.75, 13.0, 13.9]
+    points = pd.DataFrame({"description": [f"Street {i}" for i in range(len(lat))], "lat": lat, "lng": lng})
+    api = FakeApi(points)
+    fetcher = TiledFetcher(api, ["description", "lat", "lng"], tile_size=0.25)
+    merged = fetcher.fetch(BBOX)
+    assert len(api.calls) == 16
+    assert len(merged) == len(points)
+    assert sorted(merged["description"]) == sorted(points["description"])
+
+
+def test_tiles_grow_back_after_clean_fetches():
+    points = random_points(2000)
+    api = FakeApi(points, max_results=400)
+    fetcher = TiledFetcher(api, ["description", "lat", "lng"], tile_size=0.5, max_results=400, regrow_after=3)
+    fetcher.fetch(BBOX)
+    assert fetcher.tile_size == 0.25
+    # the same tiles on every clean refresh, until regrow_after of them
+    api.points = random_points(400)
+    grids = []
+    for _ in range(3):
+        api.calls = []
+        fetcher.fetch(BBOX)
+        grids.append(sorted(api.calls))
+    assert grids[0] == grids[1] == grids[2]
+    assert fetcher.tile_size == 0.5
+    # never past the size it started at
+    for _ in range(6):
+        fetcher.fetch(BBOX)
+    assert fetcher.tile_size == 0.5
+
+
+def test_client_waits_do_not_count_as_slow():
+    points = random_points(200)
+    fetcher = TiledFetcher(FakeApi(points, wait=0.05), ["description", "lat", "lng"], tile_size=0.5, slow_seconds=0.03)
+    fetcher.fetch(BBOX)
+    assert fetcher.tile_size == 0.5
+
+    slow = FakeApi(points, wait=0.05)
+    fetcher = TiledFetcher(lambda box: _without_wait(slow(box)), ["description", "lat", "lng"], tile_size=0.5,
+                           slow_seconds=0.03, min_tile_size=0.25)
+    fetcher.fetch(BBOX)
+    assert fetcher.tile_size == 0.25
+
+
+def _without_wait(frame):
+    frame.attrs.pop("waited_seconds")
+    return frame
+
+
+def test_source_updated_is_the_newest_of_its_tiles():
+    api = FakeApi(random_points(100), source_updated=lambda box: "2024-05-01T12:05:00Z" if box[0] == 13.0 else "2024-05-01T12:00:00Z")
+    merged = TiledFetcher(api, ["description", "lat", "lng"], tile_size=0.5).fetch(BBOX)
+    assert merged.attrs["source_updated"] == "2024-05-01T12:05:00Z"
+    empty = TiledFetcher(FakeApi(random_points(0)), ["description", "lat", "lng"], tile_size=0.5).fetch(BBOX)
+    assert empty.empty and empty.attrs["source_updated"] == "2024-05-01T12:00:00Z"
@@ -0,0 +1,97 @@
+import os
+import sys
+import numpy as np
+
+current_dir = os.path.dirname(os.path.abspath(__file__))
+module_dir = os.path.join(current_dir, '../', 'functions')
+sys.path.append(module_dir)
+from viewport import PointPyramid, cells_per_side, parse_view, points_json, world_xy
+
+VIEWS = [
+    # west, south, east, north, zoom
+    (13.09, 52.34, 13.76, 52.67, 10),
+    (13.30, 52.45, 13.45, 52.55, 12),
+    (13.38, 52.50, 13.42, 52.52, 15),
+    (13.40, 52.51, 13.41, 52.515, 17),
+    (12.00, 51.00, 15.00, 54.00, 7),
+    (0.00, 0.00, 1.00, 1.00, 9),
+]
+
+
+def berlin(rng, n):
+    lat = rng.uniform(52.34, 52.67, n)
+    lng = rng.uniform(13.09, 13.76, n)
+    values = np.where(rng.random(n) < 0.1, np.nan, rng.uniform(0, 10, n))
+    return lat, lng, values
+
+
+def in_bbox(lat, lng, west, south, east, north):
+    return np.flatnonzero((lat >= south) & (lat <= north) & (lng >= west) & (lng <= east))
+
+
+def cell_of(lat, lng, zoom):
+    side = cells_per_side(zoom)
+    x, y = world_xy(lat, lng)
+    return (x * side).astype(np.int64), (y * side).astype(np.int64)
+
+
+def test_points_match_a_bbox_filter():
+    rng = np.random.default_rng(13)
+    lat, lng, values = berlin(rng, 20000)
+    pyramid = PointPyramid(lat, lng, values)
+    for west, south, east, north, zoom in VIEWS:
+        expected = in_bbox(lat, lng, west, south, east, north)
+        kind, rows = pyramid.query(west, south, east, north, zoom, max_points=len(lat))
+        assert kind == "points"
+        assert np.array_equal(np.sort(rows), expected)
+
+
+def test_bins_match_the_cells_in_view():
+    rng = np.random.default_rng(14)
+    lat, lng, values = berlin(rng, 20000)
+    pyramid = PointPyramid(lat, lng, values)
+    for west, south, east, north, zoom in VIEWS[:3]:
+        kind, bins = pyramid.query(west, south, east, north, zoom, max_points=20)
+        assert kind == "bins"
+        # every point whose cell at this zoom overlaps the view, grouped by cell
+        x, y = cell_of(lat, lng, zoom)
+        (x0, x1), (y1, y0) = cell_of([south, north], [west, east], zoom)
+        inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        cells = {}
+        for row in np.flatnonzero(inside):
+            cells.setdefault((x[row], y[row]), []).append(row)
+        assert len(bins["count"]) == len(cells)
+        assert bins["count"].sum() == inside.sum()
+        bx, by = cell_of(bins["lat"], bins["lng"], zoom)
+        for i, key in enumerate(zip(bx, by)):
+            rows = np.array(cells[key])
+            assert bins["count"][i] == len(rows)
+            np.testing.assert_allclose(bins["lat"][i], lat[rows].mean())
+            np.testing.assert_allclose(bins["lng"][i], lng[rows].mean())
+            if np.isnan(values[rows]).all():
+                assert np.isnan(bins["value"][i])
+            else:
+                np.testing.assert_allclose(bins["value"][i], np.nanmean(values[rows]))
+
+
+def test_max_points_thins_the_points():
+    rng = np.random.default_rng(15)
+    lat, lng, values = berlin(rng, 20000)
+    pyramid = PointPyramid(lat, lng, values)
+    west, south, east, north, zoom = VIEWS[3]
+    expected = in_bbox(lat, lng, west, south, east, north)
+    kind, rows = pyramid.query(west, south, east, north, 20, max_points=10)
+    assert kind == "points" and len(rows) == min(10, len(expected))
+    assert set(rows.tolist()) <= set(expected.tolist())
+
+
+def test_reversed_bounds_are_empty():
+    rng = np.random.default_rng(16)
+    lat, lng, values = berlin(rng, 1000)
+    pyramid = PointPyramid(lat, lng, values)
+    kind, rows = pyramid.query(13.76, 52.34, 13.09, 52.67, 12)
+    assert kind == "points" and len(rows) == 0
+    kind, rows = pyramid.query(13.09, 52.67, 13.76, 52.34, 12)
+    assert kind == "points" and len(rows) == 0
+    view = parse_view({"west": "190", "south": "52", "east": "200", "north": "53", "zoom": "9"})
+    assert '"lat": []' in points_json(object(), view)